@@ -1,4 +1,5 @@
-from hilltoppy import com, utils, web_service
-from hilltoppy.mountain_top import Hilltop
+from hilltoppy import com, utils, web_service, aggregate
+from hilltoppy.mountain_top import Hilltop, HilltopGroup
+from hilltoppy.jobs import ExtractionJob
 
 __version__ = '2.4.0'
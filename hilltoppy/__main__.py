@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""
+Run the hilltoppy command line tool with python -m hilltoppy.
+"""
+import sys
+from hilltoppy.cli import main
+
+sys.exit(main())
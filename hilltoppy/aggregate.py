@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+"""
+Client-side aggregation of the raw time series data from get_data using the Method, Interval, and Alignment semantics of the Hilltop server, and time weighted statistics of the irregular series without resampling them. Many series are processed at once so that the raw data only needs to be requested once for all of the daily, monthly, or annual products.
+"""
+import re
+import numpy as np
+import pandas as pd
+from typing import Union
+
+############################################
+### Parameters
+
+agg_methods = ['Average', 'Total', 'Moving Average', 'Extrema', 'EP']
+
+interpolations = ['Instant', 'Incremental', 'Discrete', 'Event', 'Quasi-continuous']
+
+_continuous = ['Instant', 'Quasi-continuous']
+
+_units = {'s': 's', 'sec': 's', 'secs': 's', 'second': 's', 'seconds': 's',
+          'min': 'min', 'mins': 'min', 'minute': 'min', 'minutes': 'min',
+          'h': 'h', 'hr': 'h', 'hrs': 'h', 'hour': 'h', 'hours': 'h',
+          'd': 'D', 'day': 'D', 'days': 'D',
+          'w': 'W', 'wk': 'W', 'week': 'W', 'weeks': 'W',
+          'mon': 'M', 'month': 'M', 'months': 'M',
+          'y': 'Y', 'yr': 'Y', 'year': 'Y', 'years': 'Y'}
+
+_unit_ns = {'s': 10**9, 'min': 60 * 10**9, 'h': 3600 * 10**9, 'D': 86400 * 10**9, 'W': 7 * 86400 * 10**9}
+
+_interval_pattern = re.compile(r'^\s*(\d+)?\s*([a-zA-Z]+)\s*$')
+
+## Weeks start on a Monday
+_week_origin = np.datetime64('1970-01-05', 'ns').astype(np.int64)
+
+
+############################################
+### Intervals
+
+
+class Interval(object):
+    """
+    A Hilltop aggregation Interval (e.g. '1 day', '15 minutes', '1 month') and Alignment as integer bins of nanosecond times. Bin k covers the times from edge(k) up to edge(k + 1).
+    """
+    def __init__(self, interval: str, alignment: str = '00:00'):
+        """
+        Parameters
+        ----------
+        interval : str
+            The aggregation interval. e.g. '1 day', '1 week', '1 month', '6 hours'.
+        alignment : str or None
+            The time of day that the intervals start in the form '00:00'.
+        """
+        match = _interval_pattern.match(str(interval))
+        if (match is None) or (match.group(2).lower() not in _units):
+            raise ValueError('agg_interval must be a number and a unit like 1 day, 15 minutes, or 1 month, not ' + str(interval))
+
+        self.n = int(match.group(1) or 1)
+        self.unit = _units[match.group(2).lower()]
+
+        if self.n < 1:
+            raise ValueError('The agg_interval must be at least 1 ' + self.unit)
+
+        if alignment is None:
+            alignment = '00:00'
+        if alignment.count(':') == 1:
+            alignment = alignment + ':00'
+        self.alignment = pd.Timedelta(alignment).value
+
+        if self.unit in _unit_ns:
+            self.step = self.n * _unit_ns[self.unit]
+            self.origin = (_week_origin if self.unit == 'W' else 0) + self.alignment
+        else:
+            self.step = None
+            self.months = self.n * (12 if self.unit == 'Y' else 1)
+
+
+    @property
+    def fixed(self):
+        """
+        Is the interval a fixed length of time (rather than calendar months or years)?
+        """
+        return self.step is not None
+
+
+    def to_timedelta(self):
+        """
+        The interval as a Timedelta. Only for the fixed intervals.
+        """
+        if not self.fixed:
+            raise ValueError('Months and years are not a fixed length of time.')
+
+        return pd.Timedelta(self.step, 'ns')
+
+
+    def bin(self, times):
+        """
+        The bins of int64 nanosecond times.
+        """
+        if self.fixed:
+            return (times - self.origin) // self.step
+
+        months = (times - self.alignment).astype('datetime64[ns]').astype('datetime64[M]').astype(np.int64)
+
+        return months // self.months
+
+
+    def edge(self, bins):
+        """
+        The int64 nanosecond start times of bins.
+        """
+        if self.fixed:
+            return self.origin + bins * self.step
+
+        return (bins * self.months).astype('datetime64[M]').astype('datetime64[ns]').astype(np.int64) + self.alignment
+
+
+############################################
+### Helper functions
+
+
+def _starts(codes):
+    """
+    The positions of the first row of each series.
+    """
+    return np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.array([], dtype=np.int64)
+
+
+def _resolve_interpolation(series, interpolation):
+    """
+    The interpolation of each series as a numpy array of str.
+    """
+    keys = [c for c in ['SiteName', 'MeasurementName'] if c in series.columns]
+
+    if interpolation is None:
+        if 'Interpolation' in series:
+            interp = series['Interpolation']
+        else:
+            interp = pd.Series('Instant', index=series.index)
+    elif isinstance(interpolation, str):
+        interp = pd.Series(interpolation, index=series.index)
+    elif isinstance(interpolation, dict):
+        interp = series['MeasurementName'].map(interpolation)
+    elif isinstance(interpolation, pd.DataFrame):
+        on = [c for c in keys if c in interpolation.columns]
+        if not on:
+            raise ValueError('The interpolation DataFrame must have a MeasurementName column (and optionally a SiteName column).')
+        lookup = interpolation.drop_duplicates(on)[on + ['Interpolation']]
+        interp = pd.Series(series[on].merge(lookup, how='left', on=on)['Interpolation'].values, index=series.index)
+    else:
+        raise TypeError('interpolation must be None, a str, a dict, or a DataFrame.')
+
+    interp = interp.map(lambda x: getattr(x, 'value', x)).fillna('Instant').astype(str).to_numpy()
+
+    bad = set(interp).difference(interpolations)
+    if bad:
+        raise ValueError('Unknown interpolation(s): ' + ', '.join(sorted(bad)) + '. Must be one of ' + ', '.join(interpolations))
+
+    return interp
+
+
+def prepare_series(data: pd.DataFrame, interpolation=None, value_col: str = 'Value'):
+    """
+    Function to sort the raw time series data into numpy arrays of the series codes, int64 nanosecond times, and float values. The rows without a numeric value are removed.
+
+    Parameters
+    ----------
+    data : DataFrame
+        The output of get_data with SiteName, MeasurementName, Time, and Value columns. Times with a time zone are used as their local times without the time zone.
+    interpolation : None, str, dict, or DataFrame
+        The Interpolation of the series. See aggregate_data.
+    value_col : str
+        The name of the value column.
+
+    Returns
+    -------
+    series : DataFrame
+        The SiteName, MeasurementName, and Interpolation of each series code.
+    codes, times, values : ndarray
+        The series code, time, and value of each row sorted by series and time.
+    """
+    keys = [c for c in ['SiteName', 'MeasurementName'] if c in data.columns]
+
+    values = pd.to_numeric(data[value_col], errors='coerce').to_numpy(dtype=float)
+    times = pd.to_datetime(data['Time'])
+
+    ## Times with a time zone are taken as their local times (like the times of get_data) rather than being converted to UTC
+    if isinstance(times.dtype, pd.DatetimeTZDtype):
+        times = times.dt.tz_localize(None)
+    times = times.to_numpy().astype('datetime64[ns]')
+
+    if keys:
+        codes = data.groupby(keys, sort=False).ngroup().to_numpy()
+    else:
+        codes = np.zeros(len(data), dtype=np.int64)
+
+    ## Sort the valid rows by series and time as plain integers
+    valid = np.flatnonzero(~np.isnan(values) & ~np.isnat(times) & (codes >= 0))
+    times = times[valid].astype(np.int64)
+    order = np.lexsort((times, codes[valid]))
+    rows = valid[order]
+    times = times[order]
+    values = values[rows]
+    codes = codes[rows]
+
+    ## Renumber the codes from 0 and keep the first row of each series
+    starts = _starts(codes)
+    codes = np.cumsum(np.r_[False, codes[1:] != codes[:-1]]) if len(codes) else codes
+
+    cols = keys + (['Interpolation'] if 'Interpolation' in data.columns else [])
+    series = data[cols].iloc[rows[starts]].reset_index(drop=True)
+    series['Interpolation'] = _resolve_interpolation(series, interpolation)
+
+    return series, codes, times, values
+
+
+def insert_edges(codes, times, values, interval: Interval):
+    """
+    Function to insert the interval edges that fall within each series with linearly interpolated values, so that no segment between consecutive values crosses an edge.
+
+    Parameters
+    ----------
+    codes, times, values : ndarray
+        The series codes, int64 nanosecond times, and values sorted by series and time (see prepare_series).
+    interval : Interval
+        The interval of the edges.
+
+    Returns
+    -------
+    codes, times, values, is_edge : ndarray
+    """
+    if len(codes) == 0:
+        return codes, times, values, np.zeros(0, dtype=bool)
+
+    starts = _starts(codes)
+    ends = np.r_[starts[1:], len(codes)] - 1
+
+    b_first = interval.bin(times[starts])
+    b_last = interval.bin(times[ends])
+
+    ## Only the edges after the first time and before the last time of each series
+    n_edges = np.maximum(b_last - b_first - (interval.edge(b_last) == times[ends]), 0)
+
+    n_total = n_edges.sum()
+    offsets = np.arange(n_total) - np.repeat(np.cumsum(n_edges) - n_edges, n_edges)
+    e_times = interval.edge(np.repeat(b_first + 1, n_edges) + offsets)
+
+    all_codes = np.concatenate([codes, np.repeat(codes[starts], n_edges)])
+    all_times = np.concatenate([times, e_times])
+    all_values = np.concatenate([values, np.full(n_total, np.nan)])
+    is_edge = np.r_[np.zeros(len(codes), dtype=bool), np.ones(n_total, dtype=bool)]
+
+    order = np.lexsort((is_edge, all_times, all_codes))
+    all_codes = all_codes[order]
+    all_times = all_times[order]
+    all_values = all_values[order]
+    is_edge = is_edge[order]
+
+    ## Interpolate between the values before and after each edge
+    idx = np.arange(len(all_codes))
+    prev = np.maximum.accumulate(np.where(is_edge, 0, idx))
+    nxt = np.minimum.accumulate(np.where(is_edge, len(idx) - 1, idx)[::-1])[::-1]
+
+    t0 = all_times[prev]
+    dt = (all_times[nxt] - t0).astype(float)
+    frac = np.divide((all_times - t0).astype(float), dt, out=np.zeros(len(dt)), where=dt > 0)
+    all_values = np.where(is_edge, all_values[prev] + (all_values[nxt] - all_values[prev]) * frac, all_values)
+
+    return all_codes, all_times, all_values, is_edge
+
+
+def segments(codes, times, values):
+    """
+    Function to get the straight line segments between consecutive values of the same series.
+
+    Parameters
+    ----------
+    codes, times, values : ndarray
+        The series codes, int64 nanosecond times, and values sorted by series and time.
+
+    Returns
+    -------
+    start : ndarray
+        The positions of the first value of each segment.
+    seconds : ndarray
+        The duration of each segment in seconds.
+    area : ndarray
+        The integral of each segment (values times seconds) using the trapezoidal rule.
+    """
+    start = np.flatnonzero(codes[1:] == codes[:-1])
+    seconds = (times[start + 1] - times[start]) / 10**9
+    area = (values[start] + values[start + 1]) * 0.5 * seconds
+
+    return start, seconds, area
+
+
+def _instant(codes, times, values, interval, agg_method):
+    """
+    Aggregate the continuous series. The values are linearly interpolated, so the Average and Total are time weighted, the Extrema are of the interpolated values from the start to the end of each interval, and EP is the value at the end of each interval.
+    """
+    codes, times, values, is_edge = insert_edges(codes, times, values, interval)
+
+    if agg_method == 'EP':
+        on_edge = is_edge | (interval.edge(interval.bin(times)) == times)
+        res = pd.DataFrame({'code': codes[on_edge], 'Time': times[on_edge], 'Value': values[on_edge]})
+        return res.drop_duplicates(['code', 'Time'])
+
+    start, seconds, area = segments(codes, times, values)
+    seg_bins = interval.bin(times[start])
+
+    ## The extrema of the straight segments are at their ends, so both ends of the segments of each interval are used. The intervals are then the same as the Average and Total
+    if agg_method == 'Extrema':
+        pos = np.concatenate([start, start + 1])
+        order = np.argsort(pos, kind='stable')
+        pos = pos[order]
+        bins = np.concatenate([seg_bins, seg_bins])[order]
+        return _extrema(codes[pos], bins, times[pos], values[pos], interval)
+
+    df = pd.DataFrame({'code': codes[start], 'bin': seg_bins, 'seconds': seconds, 'area': area})
+    res = df.groupby(['code', 'bin'], sort=False).sum()
+
+    if agg_method == 'Total':
+        value = res['area']
+    else:
+        value = res['area'] / res['seconds'].where(res['seconds'] > 0)
+
+    res = res.reset_index()
+
+    return pd.DataFrame({'code': res['code'], 'Time': interval.edge(res['bin'].to_numpy() + 1), 'Value': value.to_numpy()})
+
+
+def _extrema(codes, bins, times, values, interval):
+    """
+    The minimum and maximum (and their times) of each interval.
+    """
+    df = pd.DataFrame({'code': codes, 'bin': bins, 'time': times, 'Value': values})
+    grp = df.groupby(['code', 'bin'], sort=False)['Value']
+    i_min = grp.idxmin().to_numpy()
+    i_max = grp.idxmax().to_numpy()
+    res = grp.size().reset_index()
+
+    return pd.DataFrame({'code': res['code'], 'Time': interval.edge(res['bin'].to_numpy() + 1), 'Min': values[i_min], 'MinTime': times[i_min], 'Max': values[i_max], 'MaxTime': times[i_max]})
+
+
+def _discrete(codes, times, values, incremental, interval, agg_method):
+    """
+    Aggregate the series of separate values. The Incremental values are the total since the previous time, so they belong to the interval that ends on (or after) their time.
+    """
+    bin_times = np.where(incremental, times - 1, times)
+    bins = interval.bin(bin_times)
+
+    if agg_method == 'Extrema':
+        return _extrema(codes, bins, times, values, interval)
+
+    df = pd.DataFrame({'code': codes, 'bin': bins, 'Value': values})
+    grp = df.groupby(['code', 'bin'], sort=False)['Value']
+
+    if agg_method == 'Average':
+        res = grp.mean()
+    elif agg_method == 'Total':
+        res = grp.sum()
+    else:
+        res = grp.last()
+
+    res = res.reset_index()
+
+    return pd.DataFrame({'code': res['code'], 'Time': interval.edge(res['bin'].to_numpy() + 1), 'Value': res['Value']})
+
+
+def _moving_average(codes, times, values, interval):
+    """
+    The trailing moving average of the values over a window of one interval at each time.
+    """
+    window = interval.to_timedelta()
+    df = pd.DataFrame({'code': codes, 'Time': times.astype('datetime64[ns]'), 'Value': values})
+    res = df.groupby('code', sort=False).rolling(window, on='Time')['Value'].mean().reset_index()
+
+    return pd.DataFrame({'code': res['code'], 'Time': res['Time'].values.astype('datetime64[ns]').astype(np.int64), 'Value': res['Value']})
+
+
+############################################
+### Main functions
+
+
+def aggregate_data(data: pd.DataFrame, agg_method: str, agg_interval: str, alignment: str = '00:00', interpolation: Union[str, dict, pd.DataFrame, None] = None):
+    """
+    Function to aggregate the raw time series data from get_data locally rather than with the agg_method and agg_interval of a new GetData request. All of the series (Site and Measurement combos) are aggregated at once. How the values are aggregated depends on the Interpolation of each series: Instant (and Quasi-continuous) values are linearly interpolated, so the Average is time weighted, the Total is the time integral in value units times seconds (e.g. m3 from m3/s), and EP is the interpolated value at the end of each interval; Incremental values are totals since the previous value and belong to the interval that ends at or after their time; Discrete and Event values belong to the interval that they're in and are simply averaged or summed. The output is labelled with the end time of each interval like Hilltop.
+
+    Parameters
+    ----------
+    data : DataFrame
+        The raw data from get_data with SiteName, MeasurementName, Time, and Value columns. The non-numeric values are ignored.
+    agg_method : str
+        The aggregation method. One of Average, Total, Moving Average, Extrema, or EP. Extrema returns the Min, MinTime, Max, and MaxTime of each interval rather than the Value (for the Instant series, of the interpolated values including the values at the start and end of each interval). EP returns the value at the end of each interval (the last value for the non-continuous series). Moving Average returns the trailing average over a window of agg_interval at each time of the data.
+    agg_interval : str
+        The aggregation interval for the agg_method. e.g. '1 day', '1 week', '1 month', '1 year', '15 minutes'.
+    alignment : str or None
+        The time of day that the intervals start in the form '00:00'.
+    interpolation : None, str, dict, or DataFrame
+        The Interpolation (Instant, Incremental, Discrete, Event, or Quasi-continuous) of the series. None uses the Interpolation column of the data if there is one or Instant otherwise. A str is used for all of the series, a dict is {MeasurementName: Interpolation}, and a DataFrame (e.g. the output of get_measurement_list) has the Interpolation of each MeasurementName (and SiteName). Series without an Interpolation are treated as Instant.
+
+    Returns
+    -------
+    DataFrame
+    """
+    if agg_method not in agg_methods:
+        raise ValueError('agg_method must be one of ' + ', '.join(agg_methods))
+
+    interval = Interval(agg_interval, alignment)
+
+    series, codes, times, values = prepare_series(data, interpolation)
+    keys = [c for c in ['SiteName', 'MeasurementName'] if c in series.columns]
+    interps = series['Interpolation'].to_numpy()
+
+    if agg_method == 'Extrema':
+        cols = keys + ['Time', 'Min', 'MinTime', 'Max', 'MaxTime']
+    else:
+        cols = keys + ['Time', 'Value']
+
+    if len(codes) == 0:
+        return pd.DataFrame(columns=cols)
+
+    ## Aggregate
+    if agg_method == 'Moving Average':
+        res = _moving_average(codes, times, values, interval)
+    else:
+        cont = np.isin(interps, _continuous)[codes]
+        incremental = (interps == 'Incremental')[codes]
+        res_list = []
+        if cont.any():
+            res_list.append(_instant(codes[cont], times[cont], values[cont], interval, agg_method))
+        if not cont.all():
+            res_list.append(_discrete(codes[~cont], times[~cont], values[~cont], incremental[~cont], interval, agg_method))
+        res = pd.concat(res_list)
+
+    res = res.dropna(subset=['Min'] if agg_method == 'Extrema' else ['Value']).sort_values(['code', 'Time'], kind='stable')
+
+    ## Put the series names back
+    out = series[keys].iloc[res['code'].to_numpy()].reset_index(drop=True)
+    for col in cols[len(keys):]:
+        out[col] = res[col].to_numpy()
+
+    for col in ['Time', 'MinTime', 'MaxTime']:
+        if col in out:
+            out[col] = out[col].to_numpy().astype('datetime64[ns]')
+
+    return out
+
+
+def time_weighted_stats(data: pd.DataFrame, interpolation: Union[str, dict, pd.DataFrame, None] = None, max_gap: Union[str, pd.Timedelta, None] = None):
+    """
+    Function to calculate the time weighted statistics of each series directly from the irregular times of the raw data rather than resampling them to a fixed grid. The integral of each segment between consecutive values depends on the Interpolation of the series: Instant (and Quasi-continuous) values are linearly interpolated (the trapezoidal rule), Discrete values are held until the next value, Incremental values are the totals of the segments that end at their times, and Event values are simply summed. Segments longer than max_gap are counted as gaps and are left out of the integral (except for the Event values) and the duration.
+
+    Parameters
+    ----------
+    data : DataFrame
+        The raw data from get_data (or ExtractionJob.read) with SiteName, MeasurementName, Time, and Value columns. The non-numeric values are ignored.
+    interpolation : None, str, dict, or DataFrame
+        The Interpolation of the series. See aggregate_data.
+    max_gap : str, Timedelta, or None
+        The longest time between consecutive values that isn't a gap (e.g. '1 hour'). None has no gaps.
+
+    Returns
+    -------
+    DataFrame
+        One row per series with the From and To times, the Count, Min, and Max of the values, the time weighted Mean, the Integral, the Duration with data, the GapCount and GapDuration, and the Coverage as the ratio of the Duration to the time from From to To. The Integral of the Instant, Quasi-continuous, and Discrete series is in value units times seconds (e.g. m3 from m3/s), but for the Incremental and Event series it's the sum of the values in the value units (e.g. mm of rain), so the Mean of those series is the rate per second.
+    """
+    series, codes, times, values = prepare_series(data, interpolation)
+    keys = [c for c in ['SiteName', 'MeasurementName'] if c in series.columns]
+
+    cols = keys + ['Interpolation', 'From', 'To', 'Count', 'Min', 'Max', 'Mean', 'Integral', 'Duration', 'GapCount', 'GapDuration', 'Coverage']
+
+    if len(codes) == 0:
+        return pd.DataFrame(columns=cols)
+
+    n = len(series)
+    interps = series['Interpolation'].to_numpy()
+    starts = _starts(codes)
+    ends = np.r_[starts[1:], len(codes)] - 1
+
+    ## The integral of each segment according to the interpolation
+    start, seconds, area = segments(codes, times, values)
+    seg_codes = codes[start]
+    seg_interps = interps[seg_codes]
+    area = np.where(np.isin(seg_interps, _continuous), area, np.where(seg_interps == 'Discrete', values[start] * seconds, values[start + 1]))
+
+    if max_gap is None:
+        gap = np.zeros(len(start), dtype=bool)
+    else:
+        gap = seconds > pd.Timedelta(max_gap).total_seconds()
+
+    integral = np.bincount(seg_codes, weights=np.where(gap, 0, area), minlength=n)
+
+    ## The Event values aren't tied to the segment before them, so all of them are counted
+    event = interps == 'Event'
+    if event.any():
+        integral = np.where(event, np.bincount(codes, weights=values, minlength=n), integral)
+    duration = np.bincount(seg_codes, weights=np.where(gap, 0, seconds), minlength=n)
+    gap_count = np.bincount(seg_codes, weights=gap, minlength=n).astype(np.int64)
+    gap_duration = np.bincount(seg_codes, weights=np.where(gap, seconds, 0), minlength=n)
+
+    span = (times[ends] - times[starts]) / 10**9
+
+    ## Put it all together
+    stats = series[keys].copy()
+    stats['Interpolation'] = interps
+    stats['From'] = times[starts].astype('datetime64[ns]')
+    stats['To'] = times[ends].astype('datetime64[ns]')
+    stats['Count'] = ends - starts + 1
+    stats['Min'] = np.minimum.reduceat(values, starts)
+    stats['Max'] = np.maximum.reduceat(values, starts)
+    stats['Mean'] = np.divide(integral, duration, out=np.full(n, np.nan), where=duration > 0)
+    stats['Integral'] = integral
+    stats['Duration'] = pd.to_timedelta(duration, unit='s')
+    stats['GapCount'] = gap_count
+    stats['GapDuration'] = pd.to_timedelta(gap_duration, unit='s')
+    stats['Coverage'] = np.divide(duration, span, out=np.full(n, np.nan), where=span > 0)
+
+    return stats
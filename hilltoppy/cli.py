@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+The hilltoppy command line tool for listing the sites, measurements, and collections of a Hilltop server and for bulk exports of the time series data.
+"""
+import os
+import sys
+import time
+import argparse
+from hilltoppy.mountain_top import Hilltop, response_formats
+from hilltoppy.jobs import ExtractionJob, manifest_name, series_formats
+
+############################################
+### Parameters
+
+status_name = 'status.csv'
+
+locations = {'none': None, 'yes': True, 'latlong': 'LatLong'}
+
+
+############################################
+### Functions
+
+
+def _write_table(df, path=None):
+    """
+    Write a table as csv to stdout, or to a csv or parquet file depending on the extension of the path.
+    """
+    if (path is None) or (path == '-'):
+        df.to_csv(sys.stdout, index=False, lineterminator='\n')
+    elif path.endswith('.parquet'):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def _read_lines(path):
+    """
+    Read the non-empty lines of a text file (e.g. a list of sites).
+    """
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def _hilltop(args):
+    """
+    Create the Hilltop object from the common arguments.
+    """
+    return Hilltop(args.base_url, args.hts, timeout=args.timeout, compression=not args.no_compression, max_workers=args.workers, parse_processes=args.parse_processes)
+
+
+def _print_progress(n, total, task, record):
+    """
+    Print a line to stderr as each series of an export finishes.
+    """
+    line = '[' + str(n).rjust(len(str(total))) + '/' + str(total) + '] ' + task['SiteName'] + ' | ' + task['MeasurementName'] + ': ' + record['Status']
+    if record['Status'] == 'failed':
+        line += ' (' + str(record['Reason']) + ')'
+    else:
+        line += ' (' + str(record['Rows']) + ' rows)'
+
+    print(line, file=sys.stderr, flush=True)
+
+
+def sites(args):
+    """
+    The sites command.
+    """
+    ht = _hilltop(args)
+    site_list = ht.get_site_list(location=locations[args.location], measurement=args.measurement, collection=args.collection)
+    _write_table(site_list, args.output)
+
+    return 0
+
+
+def measurements(args):
+    """
+    The measurements command.
+    """
+    ht = _hilltop(args)
+    site_list = args.site or None
+    if args.sites_file:
+        site_list = (site_list or []) + _read_lines(args.sites_file)
+
+    if site_list is None:
+        m_df = ht.get_measurement_names(detailed=args.detailed)
+        if args.measurement:
+            m_df = m_df[m_df['MeasurementName'] == args.measurement]
+    else:
+        m_df = ht.get_measurement_list(site_list, measurement=args.measurement)
+    _write_table(m_df, args.output)
+
+    return 0
+
+
+def collections(args):
+    """
+    The collections command.
+    """
+    ht = _hilltop(args)
+    cl = ht.get_collection_list()
+    if args.collection:
+        cl = cl[cl['CollectionName'] == args.collection]
+    _write_table(cl, args.output)
+
+    return 0
+
+
+def export(args):
+    """
+    The export command. The export is an ExtractionJob in the output directory, so running the same command again resumes it.
+    """
+    ht = _hilltop(args)
+
+    try:
+        if os.path.isfile(os.path.join(args.out_dir, manifest_name)):
+            job = ExtractionJob(args.out_dir)
+            print('Resuming the export in ' + args.out_dir + '. The sites, measurements, and dates of the existing export are used.', file=sys.stderr)
+        else:
+            if args.collection:
+                cl = ht.get_collection_list()
+                site_list = cl[cl['CollectionName'] == args.collection]
+                if site_list.empty:
+                    raise ValueError('The collection ' + args.collection + ' has no sites and measurements.')
+                measurement_list = None
+            else:
+                site_list = args.site or []
+                if args.sites_file:
+                    site_list = site_list + _read_lines(args.sites_file)
+                if not site_list:
+                    site_list = ht.available_sites
+                measurement_list = args.measurement
+                if not measurement_list:
+                    raise ValueError('At least one --measurement or a --collection must be passed.')
+
+            get_data_kwargs = dict(agg_method=args.agg_method, agg_interval=args.agg_interval, alignment=args.alignment, quality_codes=args.quality_codes, apply_precision=args.apply_precision, parameters=args.parameters, response_format=args.response_format)
+            job = ExtractionJob.create(args.out_dir, site_list, measurement_list, from_date=args.from_date, to_date=args.to_date, series_format=args.format, **get_data_kwargs)
+
+        outstanding = job.outstanding(not args.no_retry_failed)
+        print('Exporting ' + str(len(outstanding)) + ' of ' + str(len(job)) + ' series with ' + str(args.workers) + ' workers to ' + args.out_dir, file=sys.stderr, flush=True)
+
+        start = time.time()
+        status = job.run(ht, retry_failed=not args.no_retry_failed, progress=None if args.quiet else _print_progress)
+    finally:
+        ht.close()
+
+    status.to_csv(os.path.join(args.out_dir, status_name), index=False)
+
+    counts = status['Status'].value_counts()
+    print(', '.join(str(counts.get(s, 0)) + ' ' + s for s in ['done', 'failed', 'pending']) + ' in ' + str(round(time.time() - start, 1)) + ' s. The status of every series is in ' + os.path.join(args.out_dir, status_name), file=sys.stderr)
+
+    return 1 if counts.get('failed', 0) else 0
+
+
+def make_parser():
+    """
+    Make the argument parser of the command line tool.
+
+    Returns
+    -------
+    argparse.ArgumentParser
+    """
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('base_url', help='The root Hilltop url (e.g. https://data.example.govt.nz/).')
+    common.add_argument('hts', help='The hts file name including the .hts extension.')
+    common.add_argument('--timeout', type=int, default=60, help='The http request timeout length in seconds.')
+    common.add_argument('--workers', type=int, default=4, help='The max number of concurrent requests to the Hilltop server.')
+    common.add_argument('--parse-processes', type=int, default=None, help='The number of processes to parse the GetData responses.')
+    common.add_argument('--no-compression', action='store_true', help="Don't request compressed responses.")
+
+    table = argparse.ArgumentParser(add_help=False)
+    table.add_argument('-o', '--output', default=None, help='The csv or parquet (.parquet) file to write. Defaults to csv on stdout.')
+
+    parser = argparse.ArgumentParser(prog='hilltoppy', description='Query a Hilltop server and export its time series data.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('sites', parents=[common, table], help='List the sites.')
+    p.add_argument('--location', choices=list(locations), default='none', help='Add the Easting and Northing (yes) or the Latitude and Longitude (latlong) of the sites.')
+    p.add_argument('--measurement', default=None, help='Only the sites with this measurement.')
+    p.add_argument('--collection', default=None, help='Only the sites in this collection.')
+    p.set_defaults(func=sites)
+
+    p = subparsers.add_parser('measurements', parents=[common, table], help='List the measurements of the hts file or the measurement summary of sites.')
+    p.add_argument('--site', action='append', default=None, help='A site to get the measurement summary. Can be repeated.')
+    p.add_argument('--sites-file', default=None, help='A text file of sites, one per line.')
+    p.add_argument('--measurement', default=None, help='Only this measurement.')
+    p.add_argument('--detailed', action='store_true', help='Add the units, data types, and interpolations of the measurements of the hts file.')
+    p.set_defaults(func=measurements)
+
+    p = subparsers.add_parser('collections', parents=[common, table], help='List the collections and their sites and measurements.')
+    p.add_argument('--collection', default=None, help='Only this collection.')
+    p.set_defaults(func=collections)
+
+    p = subparsers.add_parser('export', parents=[common], help='Export the time series data to a file per series. Running it again with the same out_dir resumes it.')
+    p.add_argument('out_dir', help='The directory of the export.')
+    p.add_argument('--site', action='append', default=None, help='A site to export. Can be repeated. Defaults to all of the sites.')
+    p.add_argument('--sites-file', default=None, help='A text file of sites, one per line.')
+    p.add_argument('--measurement', action='append', default=None, help='A measurement to export. Can be repeated.')
+    p.add_argument('--collection', default=None, help='Export the sites and measurements of a collection instead.')
+    p.add_argument('--from-date', default=None, help='The start date in the format 2001-01-01.')
+    p.add_argument('--to-date', default=None, help='The end date in the format 2001-01-01.')
+    p.add_argument('--agg-method', default=None, help='The aggregation method of the Hilltop server (e.g. Average or Total).')
+    p.add_argument('--agg-interval', default=None, help='The aggregation interval (e.g. "1 day").')
+    p.add_argument('--alignment', default='00:00', help='The start time of the aggregation intervals.')
+    p.add_argument('--quality-codes', action='store_true', help='Add the quality codes.')
+    p.add_argument('--apply-precision', action='store_true', help='Round the values to the precision of the measurements.')
+    p.add_argument('--parameters', choices=['wide', 'long'], default='wide', help='How the WQ sample parameters are written. long writes them to separate _params files.')
+    p.add_argument('--response-format', choices=[f for f in response_formats if f is not None], default=None, help='Request the simple time series as WaterML 2.0.')
+    p.add_argument('--format', choices=series_formats, default='csv', help='The file format of the series.')
+    p.add_argument('--no-retry-failed', action='store_true', help="Don't retry the series that failed in a previous run.")
+    p.add_argument('--quiet', action='store_true', help="Don't print a line as each series finishes.")
+    p.set_defaults(func=export)
+
+    return parser
+
+
+def main(argv=None):
+    """
+    Run the command line tool.
+
+    Parameters
+    ----------
+    argv : list of str or None
+        The arguments. None uses sys.argv.
+
+    Returns
+    -------
+    int
+        The exit code. 1 if any series of an export failed.
+    """
+    parser = make_parser()
+    args = parser.parse_args(argv)
+
+    try:
+        return args.func(args)
+    except (ValueError, ImportError, OSError) as err:
+        print('hilltoppy: error: ' + str(err), file=sys.stderr)
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
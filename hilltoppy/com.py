@@ -7,8 +7,100 @@ try:
     from win32com.client import Dispatch, pywintypes, makepy
 except:
     pass
-from pandas import concat, to_datetime, to_numeric, DataFrame, merge
-from hilltoppy.utils import pytime_to_datetime, time_switch
+import numpy as np
+from pandas import concat, to_datetime, to_numeric, DataFrame, Series
+from hilltoppy.utils import pytime_to_datetime, time_switch, convert_detection_limits
+
+######################################################
+#### COM backends
+
+
+class Win32Backend(object):
+    """
+    The Hilltop COM objects from win32com. Only available on Windows with Hilltop installed.
+    """
+    def Dispatch(self, prog_id):
+        return Dispatch(prog_id)
+
+
+    def strptime(self, text, fmt):
+        return pywintypes.TimeType.strptime(text, fmt)
+
+
+_backend = Win32Backend()
+
+
+def set_backend(backend=None):
+    """
+    Function to set the backend that provides the Hilltop COM objects to all of the functions in this module. A backend needs a Dispatch method that returns the COM object of a ProgID (e.g. 'Hilltop.DataRetrieval') and a strptime method that returns a time that the COM objects accept. See hilltoppy.fake_com.FakeComBackend for an in-memory backend for testing.
+
+    Parameters
+    ----------
+    backend : object or None
+        The backend. None resets it to the win32com backend.
+
+    Returns
+    -------
+    None
+    """
+    global _backend
+
+    if backend is None:
+        backend = Win32Backend()
+    _backend = backend
+
+
+def get_backend():
+    """
+    Function to get the current COM backend.
+    """
+    return _backend
+
+
+class _SeriesBuffer(object):
+    """
+    Preallocated arrays of the times and values read from a Hilltop COM object. The arrays are doubled in size when they fill up and the times are only converted to datetime64 once at the end.
+    """
+    def __init__(self, value_dtype='float64', size=4096):
+        self.n = 0
+        self.time_parts = np.empty((size, 5), dtype='int64')
+        self.values = np.empty(size, dtype=value_dtype)
+
+
+    def append(self, pytime, value):
+        n = self.n
+        if n == len(self.values):
+            self.time_parts = np.concatenate([self.time_parts, np.empty_like(self.time_parts)])
+            self.values = np.concatenate([self.values, np.empty_like(self.values)])
+
+        ## Keep any non-numeric values as they are
+        if (self.values.dtype.kind == 'f') and not isinstance(value, (int, float)):
+            self.values = self.values.astype(object)
+
+        self.time_parts[n] = (pytime.year, pytime.month, pytime.day, pytime.hour, pytime.minute)
+        self.values[n] = value
+        self.n = n + 1
+
+
+    def __len__(self):
+        return self.n
+
+
+    def times(self):
+        """
+        The times as datetime64.
+        """
+        return to_datetime(DataFrame(self.time_parts[:self.n], columns=['year', 'month', 'day', 'hour', 'minute']))
+
+
+    def to_frame(self, **columns):
+        """
+        The times and values as a DataFrame with the time and data columns and any other constant columns.
+        """
+        data = Series(self.values[:self.n], dtype=self.values.dtype)
+
+        return DataFrame({'time': self.times().to_numpy(), 'data': data, **columns})
+
 
 ######################################################
 #### COM access method
@@ -50,11 +142,11 @@ def measurement_list(hts, sites=None, mtypes=None, rem_wq_sample=True):
     DataFrame
     """
 
-    cat = Dispatch("Hilltop.Catalogue")
+    cat = _backend.Dispatch("Hilltop.Catalogue")
     if not cat.Open(hts):
         raise ValueError(cat.errmsg)
 
-    dfile = Dispatch("Hilltop.DataRetrieval")
+    dfile = _backend.Dispatch("Hilltop.DataRetrieval")
     try:
         dfile.Open(hts)
     except ValueError:
@@ -159,7 +251,7 @@ def get_data_quantity(hts, sites=None, mtypes=None, start=None, end=None, agg_pe
         sites_df = sites_df[sites_df.start_date <= end]
 
     ### Open the hts file
-    dfile = Dispatch("Hilltop.DataRetrieval")
+    dfile = _backend.Dispatch("Hilltop.DataRetrieval")
     try:
         dfile.Open(hts)
     except ValueError:
@@ -200,26 +292,20 @@ def get_data_quantity(hts, sites=None, mtypes=None, start=None, end=None, agg_pe
                 dfile.SetMode(agg_val, str(agg_n) + ' ' + agg_period)
 
             ## Extract data
-            data = []
-            time = []
             if dfile.getsinglevbs == 0:
                 t1 = dfile.value
                 if isinstance(t1, str):
                     print('site ' + site + ' has nonsense data')
                 else:
-                    data.append(t1)
-                    time.append(str(pytime_to_datetime(dfile.time)))
+                    buffer = _SeriesBuffer('float64')
+                    buffer.append(dfile.time, t1)
                     while dfile.getsinglevbs != 2:
-                        data.append(dfile.value)
-                        time.append(str(pytime_to_datetime(dfile.time)))
-                    if data:
-                        df_temp = DataFrame({'time': time, 'data': data, 'site': site, 'mtype': mtype})
-                        df_lst.append(df_temp)
+                        buffer.append(dfile.time, dfile.value)
+                    df_lst.append(buffer.to_frame(site=site, mtype=mtype))
 
     dfile.Close()
     if df_lst:
         df1 = concat(df_lst)
-        df1.loc[:, 'time'] = to_datetime(df1.loc[:, 'time'])
         df2 = df1.set_index(['mtype', 'site', 'time']).data * unit_convert[unit]
     else:
         df2 = DataFrame([], index=['mtype', 'site', 'time'])
@@ -268,8 +354,8 @@ def get_data_quality(hts, sites=None, mtypes=None, start=None, end=None, dtl_met
         sites_df = sites_df[sites_df.start_date <= end]
 
     ### Open the hts file
-    wqr = Dispatch("Hilltop.WQRetrieval")
-    dfile = Dispatch("Hilltop.DataFile")
+    wqr = _backend.Dispatch("Hilltop.WQRetrieval")
+    dfile = _backend.Dispatch("Hilltop.DataFile")
     try:
         dfile.Open(hts)
     except ValueError:
@@ -289,35 +375,32 @@ def get_data_quality(hts, sites=None, mtypes=None, start=None, end=None, dtl_met
         if start is None:
             start1 = wqr.DataStartTime
         else:
-            start1 = pywintypes.TimeType.strptime(start, '%Y-%m-%d')
+            start1 = _backend.strptime(start, '%Y-%m-%d')
         if end is None:
             end1 = wqr.DataEndTime
         else:
-            end1 = pywintypes.TimeType.strptime(end, '%Y-%m-%d')
+            end1 = _backend.strptime(end, '%Y-%m-%d')
 
         if not wqr.FromTimeRange(start1, end1):
             continue
 
         ## Extract data
-        data = []
-        time = []
+        buffer = _SeriesBuffer(object)
         sample_p = []
 
         test_params = sites_df[sites_df.site == site].mtype.unique()
         if ('WQ Sample' in test_params) & (isinstance(mtype_params, list) | isinstance(sample_params, list)):
             mtype_p = []
             while wqr.GetNext:
-                data.append(str(wqr.value.encode('ascii', 'ignore').decode()))
-                time.append(str(pytime_to_datetime(wqr.time)))
+                buffer.append(wqr.time, wqr.value.encode('ascii', 'ignore').decode())
                 sample_p.append({sp: str(wqr.params(sp).encode('ascii', 'ignore').decode()) for sp in sample_params})
                 mtype_p.append({mp: str(wqr.params(mp).encode('ascii', 'ignore').decode()) for mp in mtype_params})
         else:
             while wqr.GetNext:
-                data.append(str(wqr.value.encode('ascii', 'ignore').decode()))
-                time.append(str(pytime_to_datetime(wqr.time)))
+                buffer.append(wqr.time, wqr.value.encode('ascii', 'ignore').decode())
 
-        if data:
-            df_temp = DataFrame({'time': time, 'data': data, 'site': site, 'mtype': mtype})
+        if len(buffer):
+            df_temp = buffer.to_frame(site=site, mtype=mtype)
             if sample_p:
                 df_temp = concat([df_temp, DataFrame(sample_p), DataFrame(mtype_p)], axis=1)
             df_lst.append(df_temp)
@@ -326,44 +409,13 @@ def get_data_quality(hts, sites=None, mtypes=None, start=None, end=None, dtl_met
     wqr.close()
     if df_lst:
         data = concat(df_lst)
-        data.loc[:, 'time'] = to_datetime(data.loc[:, 'time'])
         data1 = to_numeric(data.loc[:, 'data'], errors='coerce')
         data.loc[data1.notnull(), 'data'] = data1[data1.notnull()]
         data = data.reset_index(drop=True)
 
         #### Convert detection limit values
         if dtl_method is not None:
-            less1 = data['data'].str.match('<')
-            if less1.sum() > 0:
-                less1.loc[less1.isnull()] = False
-                data2 = data.copy()
-                data2.loc[less1, 'data'] = to_numeric(data.loc[less1, 'data'].str.replace('<', ''), errors='coerce') * 0.5
-                if dtl_method == 'standard':
-                    data3 = data2
-                if dtl_method == 'trend':
-                    df1 = data2.loc[less1]
-                    count1 = data.groupby('mtype')['data'].count()
-                    count1.name = 'tot_count'
-                    count_dtl = df1.groupby('mtype')['data'].count()
-                    count_dtl.name = 'dtl_count'
-                    count_dtl_val = df1.groupby('mtype')['data'].nunique()
-                    count_dtl_val.name = 'dtl_val_count'
-                    combo1 = concat([count1, count_dtl, count_dtl_val], axis=1, join='inner')
-                    combo1['dtl_ratio'] = (combo1['dtl_count'] / combo1['tot_count']).round(2)
-
-                    ## conditionals
-                    param2 = combo1[(combo1['dtl_ratio'] > 0.4) & (combo1['dtl_val_count'] != 1)]
-                    over_40 = data['mtype'].isin(param2.index)
-
-                    ## Calc detection limit values
-                    data3 = merge(data, combo1['dtl_ratio'].reset_index(), on='mtype', how='left')
-                    data3.loc[:, 'data_dtl'] = data2['data']
-
-                    max_dtl_val = data2[over_40 & less1].groupby('mtype')['data'].transform('max')
-                    max_dtl_val.name = 'dtl_data_max'
-                    data3.loc[over_40 & less1, 'data_dtl'] = max_dtl_val
-            else:
-                data3 = data
+            data3 = convert_detection_limits(data, dtl_method, value_col='data', censor_col=None, group_cols='mtype')
         else:
             data3 = data
 
@@ -374,9 +426,62 @@ def get_data_quality(hts, sites=None, mtypes=None, start=None, end=None, dtl_met
             return data3
 
 
-def write_wq_data(hts, data):
+def _check_wq_data(data):
     """
-    Function to write water quality data to Hilltop hts files.
+    Check the structure of the water quality data dict before anything is written to the hts file.
+
+    Parameters
+    ----------
+    data : dict
+        See write_wq_data.
+
+    Returns
+    -------
+    int
+        The number of samples.
+    """
+    errors = []
+    n_samples = 0
+
+    if not isinstance(data, dict):
+        raise TypeError('data must be a dict of {site: {time: sample}}.')
+
+    for s, samples in data.items():
+        if not isinstance(samples, dict):
+            errors.append(str(s) + ': the samples must be a dict of {time: sample}')
+            continue
+        for d, q1 in samples.items():
+            loc = str(s) + ' ' + str(d)
+            try:
+                to_datetime(d)
+            except (ValueError, TypeError):
+                errors.append(loc + ': the time could not be parsed')
+            if not isinstance(q1, dict):
+                errors.append(loc + ': the sample must be a dict')
+                continue
+            other = set(q1).difference(['SiteParameter', 'Measurement'])
+            if other:
+                errors.append(loc + ': unknown keys ' + ', '.join(sorted(map(str, other))))
+            if not isinstance(q1.get('SiteParameter', {}), dict):
+                errors.append(loc + ': SiteParameter must be a dict')
+            m1 = q1.get('Measurement', {})
+            if not isinstance(m1, dict):
+                errors.append(loc + ': Measurement must be a dict')
+                continue
+            for key, val in m1.items():
+                if not isinstance(val, dict) or ('Value' not in val):
+                    errors.append(loc + ' ' + str(key) + ': the measurement must be a dict with a Value')
+            n_samples += 1
+
+    if errors:
+        raise ValueError('The water quality data has ' + str(len(errors)) + ' error(s):\n' + '\n'.join(errors))
+
+    return n_samples
+
+
+def write_wq_data(hts, data, chunk_size=None):
+    """
+    Function to write water quality data to Hilltop hts files. The whole dict is checked before anything is written, then the hts file is opened once, the samples are written grouped by site, and the data is committed once at the end (or every chunk_size samples).
 
     Parameters
     ------------
@@ -398,38 +503,53 @@ def write_wq_data(hts, data):
                                        }
                      }
          }
+    chunk_size : int or None
+        The number of samples to write between commits. None commits once after all of the samples have been written.
 
     Returns
     -------
-    None
+    int
+        The number of samples written.
     """
-    for s in data:
-        print(s)
-        dfile = Dispatch("Hilltop.WQInput")
+    n_samples = _check_wq_data(data)
+
+    if n_samples == 0:
+        return 0
+
+    dfile = _backend.Dispatch("Hilltop.WQInput")
+
+    def _open():
         try:
             dfile.Open(hts)
         except ValueError:
-            print(dfile.ErrorMsg)
-
-        for d in data[s]:
-            # print(d)
-            q1 = data[s][d]
-
-            dfile.PutSample(s, d) # Initialize the site and time
-            if 'SiteParameter' in q1:
-                sp4 = q1['SiteParameter']
-                for key, val in sp4.items():
-                    dfile.SetParam(key, val) # set the sample paremters, not associated with measurement types
-            if 'Measurement' in q1:
-                m1 = q1['Measurement']
-                for key, val in m1.items():
-                    dup = val.copy()
-                    dfile.PutMeasurement(key, dup.pop('Value')) # Set a measurement value
-                    if dup:
-                        for mp, mpval in dup.items():
-                            dfile.SetParam(mp, mpval) # sample parameters associated with the measurement parameter
+            raise ValueError(dfile.ErrorMsg)
+        if len(dfile.ErrorMsg) > 0:
+            raise ValueError(dfile.ErrorMsg)
 
+    def _commit():
         if len(dfile.ErrorMsg) > 0:
             raise ValueError(dfile.ErrorMsg)
-        else:
-            dfile.Close()   # commit data to the hts file
+        dfile.Close()   # commit data to the hts file
+
+    _open()
+
+    n = 0
+    for s in data:
+        for d, q1 in data[s].items():
+            dfile.PutSample(s, d) # Initialize the site and time
+            for key, val in q1.get('SiteParameter', {}).items():
+                dfile.SetParam(key, val) # set the sample paremters, not associated with measurement types
+            for key, val in q1.get('Measurement', {}).items():
+                dfile.PutMeasurement(key, val['Value']) # Set a measurement value
+                for mp, mpval in val.items():
+                    if mp != 'Value':
+                        dfile.SetParam(mp, mpval) # sample parameters associated with the measurement parameter
+
+            n += 1
+            if chunk_size and (n % chunk_size == 0) and (n < n_samples):
+                _commit()
+                _open()
+
+    _commit()
+
+    return n
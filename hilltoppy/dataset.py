@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-dimensional (time x site) output of the time series data as xarray Datasets and writing them to netCDF or Zarr. xarray is an optional dependency.
+"""
+import warnings
+import numpy as np
+import pandas as pd
+from typing import List, Union
+try:
+    import xarray as xr
+except ImportError:
+    xr = None
+
+############################################
+### Parameters
+
+site_coords = ['Easting', 'Northing', 'Latitude', 'Longitude']
+
+
+############################################
+### Functions
+
+
+def _check_xarray():
+    """
+    Raise an informative error when xarray isn't installed.
+    """
+    if xr is None:
+        raise ImportError('xarray must be installed for the Dataset output (e.g. pip install xarray).')
+
+
+def _series_blocks(data, value_col='Value'):
+    """
+    Split the data into the site names, site codes, times, and values of each Measurement. The results of get_data are already one DataFrame per Site and Measurement combo, so those are used directly without concatenating them first.
+    """
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+
+    for df in data:
+        if isinstance(df, tuple):
+            df = df[0]
+        if df.empty or (value_col not in df):
+            continue
+
+        sites = df['SiteName'].to_numpy()
+        measurements = df['MeasurementName'].to_numpy()
+        times = df['Time']
+        if not pd.api.types.is_datetime64_dtype(times):
+            times = pd.to_datetime(times)
+        times = times.to_numpy().astype('datetime64[ns]')
+
+        values = df[value_col]
+        if not pd.api.types.is_float_dtype(values):
+            values = pd.to_numeric(values, errors='coerce')
+        values = values.to_numpy(dtype=float)
+
+        if (sites[0] == sites).all() and (measurements[0] == measurements).all():
+            yield [sites[0]], 0, measurements[0], times, values
+        else:
+            site_codes, site_names = pd.factorize(sites)
+            m_codes, m_names = pd.factorize(measurements)
+            for i, m in enumerate(m_names):
+                mask = m_codes == i
+                yield site_names, site_codes[mask], m, times[mask], values[mask]
+
+
+def to_dataset(data: Union[pd.DataFrame, List[pd.DataFrame]], sites: pd.DataFrame = None, value_col: str = 'Value', attrs: dict = None):
+    """
+    Function to convert the time series data from get_data into an xarray Dataset with time and site dimensions and one variable per measurement. The values are put straight into the preallocated arrays of each measurement (rather than pivoting the long DataFrame), so it's best suited to the regular series of an agg_interval or aggregate_data. A site can only have one value per time, so duplicate times (e.g. the same site from two hts files) keep the last value and raise a warning.
+
+    Parameters
+    ----------
+    data : DataFrame or list of DataFrame
+        The output of get_data (or aggregate_data) with SiteName, MeasurementName, Time, and value_col columns. A list of DataFrames (e.g. one per Site and Measurement) is also accepted.
+    sites : DataFrame or None
+        The SiteList with the SiteName and the Easting and Northing and/or Latitude and Longitude, which are added as coordinates of the site dimension.
+    value_col : str
+        The name of the value column.
+    attrs : dict or None
+        The attributes of each measurement variable as {MeasurementName: {attribute name: value}} (e.g. the units).
+
+    Returns
+    -------
+    xarray.Dataset
+    """
+    _check_xarray()
+
+    blocks = list(_series_blocks(data, value_col))
+
+    if not blocks:
+        return xr.Dataset(coords={'time': np.array([], dtype='datetime64[ns]'), 'site': np.array([], dtype=object)})
+
+    times = np.unique(np.concatenate([b[3] for b in blocks]))
+    site_names = list(dict.fromkeys(s for b in blocks for s in b[0]))
+    site_pos = {s: i for i, s in enumerate(site_names)}
+
+    arrays = {}
+    filled = {}
+    duplicates = {}
+    for names, codes, m, t, v in blocks:
+        if m not in arrays:
+            arrays[m] = np.full((len(times), len(site_names)), np.nan)
+            filled[m] = np.zeros((len(times), len(site_names)), dtype=bool)
+        pos = np.array([site_pos[s] for s in names])[codes]
+        t_pos = np.searchsorted(times, t)
+
+        ## A cell can only hold one value, so count the values that land on the same cell in this block or on a cell filled by another block
+        flat = t_pos * len(site_names) + pos
+        n_dup = 0
+        if (len(flat) > 1) and not (flat[1:] > flat[:-1]).all():
+            u_flat = np.unique(flat)
+            n_dup = len(flat) - len(u_flat)
+            flat = u_flat
+        n_dup += int(filled[m].ravel()[flat].sum())
+        if n_dup:
+            duplicates[m] = duplicates.get(m, 0) + n_dup
+
+        arrays[m][t_pos, pos] = v
+        filled[m].ravel()[flat] = True
+
+    if duplicates:
+        warnings.warn('The data has duplicate Site and Time values that only keep the last value in the Dataset: ' + ', '.join(m + ' (' + str(n) + ')' for m, n in duplicates.items()) + '. Remove or aggregate the duplicates first to choose the values.')
+
+    ds = xr.Dataset({m: (('time', 'site'), arr) for m, arr in arrays.items()}, coords={'time': times, 'site': np.array(site_names, dtype=object)})
+
+    if isinstance(sites, pd.DataFrame) and ('SiteName' in sites):
+        sites1 = sites.drop_duplicates('SiteName').set_index('SiteName').reindex(site_names)
+        for col in site_coords:
+            if (col in sites1) and sites1[col].notna().any():
+                ds = ds.assign_coords({col: ('site', sites1[col].to_numpy(dtype=float))})
+
+    if attrs:
+        for m, a in attrs.items():
+            if m in ds:
+                ds[m].attrs.update({k: v for k, v in a.items() if v is not None})
+
+    return ds
+
+
+def write_dataset(data, path: str, sites: pd.DataFrame = None, **kwargs):
+    """
+    Function to write the time series data as a netCDF file or a Zarr store. Paths that end with .zarr are written as Zarr and everything else as netCDF.
+
+    Parameters
+    ----------
+    data : xarray.Dataset, DataFrame, or list of DataFrame
+        A Dataset from to_dataset (or get_data with output='xarray') or the data to pass to to_dataset.
+    path : str
+        The path of the netCDF file or Zarr store. An existing file or store is overwritten.
+    sites : DataFrame or None
+        The SiteList for the site coordinates when data isn't already a Dataset. See to_dataset.
+    **kwargs
+        Other keyword arguments passed to xarray's to_netcdf or to_zarr (e.g. engine or encoding).
+
+    Returns
+    -------
+    xarray.Dataset
+    """
+    _check_xarray()
+
+    if not isinstance(data, xr.Dataset):
+        data = to_dataset(data, sites)
+
+    if str(path).rstrip('/\\').endswith('.zarr'):
+        data.to_zarr(path, mode='w', **kwargs)
+    else:
+        data.to_netcdf(path, **kwargs)
+
+    return data
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+An in-memory fake of the Hilltop COM objects so that the com functions can be run and tested without Windows or Hilltop. Use it with com.set_backend.
+"""
+import pandas as pd
+from datetime import datetime
+
+######################################################
+#### Fake hts file
+
+
+class FakeHts(object):
+    """
+    The data of a fake hts file.
+    """
+    def __init__(self):
+        self.sites = {}
+        self.series = {}
+        self.samples = {}
+        self.commits = 0
+
+
+    def add_series(self, site: str, mtype: str, times, values, units: str = 'm3/s', data_source: str = None, divisor=1):
+        """
+        Add a time series of a measurement at a site.
+
+        Parameters
+        ----------
+        site : str
+            The site name.
+        mtype : str
+            The measurement name.
+        times : list-like
+            The times of the values.
+        values : list-like
+            The values.
+        units : str
+            The units of the measurement.
+        data_source : str or None
+            The data source name. None uses the measurement name.
+        divisor : int or float
+            The divisor of the measurement.
+
+        Returns
+        -------
+        None
+        """
+        if data_source is None:
+            data_source = mtype
+
+        ds = self.sites.setdefault(site, {}).setdefault(data_source, {})
+        ds[mtype] = {'units': units, 'divisor': divisor}
+        self.series[(site, mtype)] = (pd.to_datetime(list(times)).to_pydatetime().tolist(), list(values))
+
+
+    def add_sample(self, site: str, time, measurements: dict, params: dict = None):
+        """
+        Add a WQ sample at a site.
+
+        Parameters
+        ----------
+        site : str
+            The site name.
+        time : str or datetime
+            The time of the sample.
+        measurements : dict
+            The measurements of the sample as {measurement name: {'Value': value text, other measurement params}}.
+        params : dict or None
+            The sample parameters.
+
+        Returns
+        -------
+        None
+        """
+        time = pd.Timestamp(time).to_pydatetime()
+        sample = self.samples.setdefault(site, {}).setdefault(time, {'params': {}, 'measurements': {}})
+        sample['params'].update(params or {})
+        sample['measurements'].update({m: dict(v) for m, v in measurements.items()})
+
+        ds = self.sites.setdefault(site, {}).setdefault('WQ Sample', {})
+        ds['WQ Sample'] = {'units': '', 'divisor': 1}
+        for m in measurements:
+            ds[m] = {'units': '', 'divisor': 1}
+
+
+    def _times(self, site, mtype):
+        """
+        The times of a measurement at a site.
+        """
+        if (site, mtype) in self.series:
+            return self.series[(site, mtype)][0]
+
+        return sorted(t for t, s in self.samples.get(site, {}).items() if mtype in s['measurements'] or mtype == 'WQ Sample')
+
+
+######################################################
+#### Fake COM objects
+
+
+def _to_datetime(t):
+    """
+    Convert a time (or time string) passed to a COM method to a datetime.
+    """
+    return pd.Timestamp(t).to_pydatetime()
+
+
+class _FakeComObject(object):
+    """
+    The shared parts of the fake COM objects.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.hts = None
+        self.errmsg = ''
+
+
+    def Open(self, hts):
+        if hts not in self.backend.files:
+            self.errmsg = 'File ' + str(hts) + ' could not be opened'
+            return False
+        self.hts = self.backend.files[hts]
+        return True
+
+
+    def Close(self):
+        self.hts = None
+
+
+class FakeCatalogue(_FakeComObject):
+    """
+    Fake of the Hilltop.Catalogue object.
+    """
+    @property
+    def StartSiteEnum(self):
+        self._sites = iter(list(self.hts.sites))
+        return True
+
+
+    @property
+    def GetNextSite(self):
+        self.SiteName = next(self._sites, None)
+        if self.SiteName is None:
+            return False
+        self._data_sources = iter(list(self.hts.sites[self.SiteName]))
+        return True
+
+
+    @property
+    def GetNextDataSource(self):
+        self.DataSource = next(self._data_sources, None)
+        if self.DataSource is None:
+            return False
+        mtypes = self.hts.sites[self.SiteName][self.DataSource]
+        self._measurements = iter(list(mtypes))
+        times = sorted(t for m in mtypes for t in self.hts._times(self.SiteName, m))
+        self.DataStartTime = times[0] if times else datetime(1900, 1, 1)
+        self.DataEndTime = times[-1] if times else datetime(1900, 1, 1)
+        return True
+
+
+    @property
+    def GetNextMeasurement(self):
+        self.Measurement = next(self._measurements, None)
+        if self.Measurement is None:
+            return False
+        info = self.hts.sites[self.SiteName][self.DataSource][self.Measurement]
+        self.Units = info['units']
+        self.Divisor = info['divisor']
+        return True
+
+
+class FakeDataRetrieval(_FakeComObject):
+    """
+    Fake of the Hilltop.DataRetrieval object. The aggregation of SetMode isn't emulated.
+    """
+    def FromSite(self, site, mtype, n=1):
+        if (site, mtype) not in self.hts.series:
+            return False
+        self._times, self._values = self.hts.series[(site, mtype)]
+        self.DataStartTime = self._times[0]
+        self.DataEndTime = self._times[-1]
+        self._range = (0, len(self._times))
+        self._pos = 0
+        return True
+
+
+    def FromTimeRange(self, start, end):
+        start = _to_datetime(start)
+        end = _to_datetime(end)
+        idx = [i for i, t in enumerate(self._times) if start <= t <= end]
+        if not idx:
+            return False
+        self._range = (idx[0], idx[-1] + 1)
+        self._pos = self._range[0]
+        return True
+
+
+    def SetMode(self, agg, period):
+        self.mode = (agg, period)
+
+
+    @property
+    def getsinglevbs(self):
+        if self._pos >= self._range[1]:
+            return 2
+        self.time = self._times[self._pos]
+        self.value = self._values[self._pos]
+        self._pos += 1
+        return 0
+
+
+class FakeWQRetrieval(object):
+    """
+    Fake of the WQ retrieval object returned by Hilltop.DataFile.FromWQSite.
+    """
+    def __init__(self, hts, site, mtype):
+        self._samples = hts.samples.get(site, {})
+        self._times = hts._times(site, mtype)
+        self.mtype = mtype
+        if self._times:
+            self.DataStartTime = self._times[0]
+            self.DataEndTime = self._times[-1]
+        self._iter = iter([])
+
+
+    def FromTimeRange(self, start, end):
+        start = _to_datetime(start)
+        end = _to_datetime(end)
+        times = [t for t in self._times if start <= t <= end]
+        self._iter = iter(times)
+        return bool(times)
+
+
+    @property
+    def GetNext(self):
+        self.time = next(self._iter, None)
+        if self.time is None:
+            return False
+        self._sample = self._samples[self.time]
+        self.value = str(self._sample['measurements'][self.mtype]['Value'])
+        return True
+
+
+    def params(self, name):
+        m_params = self._sample['measurements'][self.mtype]
+        if (name in m_params) and (name != 'Value'):
+            return str(m_params[name])
+        return str(self._sample['params'].get(name, ''))
+
+
+    def close(self):
+        pass
+
+
+class FakeDataFile(_FakeComObject):
+    """
+    Fake of the Hilltop.DataFile object.
+    """
+    def FromWQSite(self, site, mtype):
+        return FakeWQRetrieval(self.hts, site, mtype)
+
+
+class FakeWQInput(object):
+    """
+    Fake of the Hilltop.WQInput object. The samples are only added to the fake hts file when Close commits them.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.hts = None
+        self.ErrorMsg = ''
+        self._pending = []
+
+
+    def Open(self, hts):
+        if hts not in self.backend.files:
+            self.ErrorMsg = 'File ' + str(hts) + ' could not be opened'
+            return False
+        self.hts = self.backend.files[hts]
+        self.ErrorMsg = ''
+        return True
+
+
+    def PutSample(self, site, time):
+        if self.hts is None:
+            self.ErrorMsg = 'No file is open'
+            return False
+        self._sample = {'site': site, 'time': time, 'measurements': {}, 'params': {}}
+        self._measurement = None
+        self._pending.append(self._sample)
+        return True
+
+
+    def SetParam(self, name, value):
+        if self._measurement is None:
+            self._sample['params'][name] = value
+        else:
+            self._sample['measurements'][self._measurement][name] = value
+        return True
+
+
+    def PutMeasurement(self, name, value):
+        self._sample['measurements'][name] = {'Value': value}
+        self._measurement = name
+        return True
+
+
+    def Close(self):
+        if self.hts is not None:
+            for sample in self._pending:
+                self.hts.add_sample(sample['site'], sample['time'], sample['measurements'], sample['params'])
+            self.hts.commits += 1
+        self._pending = []
+        self.hts = None
+
+
+######################################################
+#### Backend
+
+
+class FakeComBackend(object):
+    """
+    An in-memory backend of fake Hilltop COM objects. Add the fake hts files with add_hts and pass the backend to com.set_backend.
+    """
+    objects = {'Hilltop.Catalogue': FakeCatalogue, 'Hilltop.DataRetrieval': FakeDataRetrieval, 'Hilltop.DataFile': FakeDataFile, 'Hilltop.WQRetrieval': FakeWQRetrieval, 'Hilltop.WQInput': FakeWQInput}
+
+
+    def __init__(self):
+        self.files = {}
+
+
+    def add_hts(self, hts: str):
+        """
+        Add an empty fake hts file.
+
+        Parameters
+        ----------
+        hts : str
+            The path of the hts file as it will be passed to the com functions.
+
+        Returns
+        -------
+        FakeHts
+        """
+        self.files[hts] = FakeHts()
+
+        return self.files[hts]
+
+
+    def Dispatch(self, prog_id):
+        if prog_id not in self.objects:
+            raise ValueError(prog_id + ' is not available in the fake COM backend.')
+        if prog_id == 'Hilltop.WQRetrieval':
+            return FakeWQRetrieval(FakeHts(), None, None)
+        return self.objects[prog_id](self)
+
+
+    def strptime(self, text, fmt):
+        return datetime.strptime(text, fmt)
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpointed bulk extraction jobs that can be resumed after a crash or a server outage.
+"""
+import os
+import json
+import importlib.util
+import threading
+import pandas as pd
+from datetime import datetime
+from typing import List, Union
+
+############################################
+### Parameters
+
+manifest_name = 'manifest.json'
+progress_name = 'progress.jsonl'
+series_dir = 'series'
+series_formats = ['pkl', 'csv', 'parquet']
+
+status_cols = ['SiteName', 'MeasurementName', 'FromDate', 'ToDate', 'Status', 'Rows', 'Reason']
+
+
+############################################
+### Functions
+
+
+def _serialize_kwargs(get_data_kwargs):
+    """
+    Make the get_data keyword arguments JSON serializable for the manifest. The dtypes of a parameters schema are stored by their names (e.g. float64), which get_data accepts as well.
+    """
+    kwargs = dict(get_data_kwargs)
+
+    try:
+        if isinstance(kwargs.get('parameters'), dict):
+            kwargs['parameters'] = {name: str(pd.api.types.pandas_dtype(dtype)) for name, dtype in kwargs['parameters'].items()}
+        json.dumps(kwargs)
+    except TypeError as err:
+        raise ValueError('The get_data keyword arguments of a job must be JSON serializable. ' + str(err))
+
+    return kwargs
+
+
+def _write_manifest(path, manifest):
+    """
+    Write the manifest of a job atomically so that a crash never leaves a partial manifest.
+    """
+    manifest_text = json.dumps(manifest, indent=1)
+
+    tmp_path = os.path.join(path, manifest_name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(manifest_text)
+    os.replace(tmp_path, os.path.join(path, manifest_name))
+
+
+############################################
+### Class
+
+
+class ExtractionJob(object):
+    """
+    A bulk GetData extraction that is saved to a directory as it runs. The directory holds a manifest of all of the (site, measurement, date range) tasks, a progress log that is appended to as each task finishes (or fails), and a file per completed series. Running the job again only runs the outstanding tasks.
+    """
+    def __init__(self, path: str):
+        """
+        Open an existing job. Use ExtractionJob.create to make a new one.
+
+        Parameters
+        ----------
+        path : str
+            The directory of the job.
+        """
+        self.path = path
+
+        with open(os.path.join(path, manifest_name)) as f:
+            manifest = json.load(f)
+
+        self.tasks = manifest['tasks']
+        self.get_data_kwargs = manifest['get_data_kwargs']
+        self.created = manifest['created']
+        self.series_format = manifest.get('series_format', 'pkl')
+
+        self._lock = threading.Lock()
+        self._progress = {}
+
+        progress_path = os.path.join(path, progress_name)
+        if os.path.isfile(progress_path):
+            with open(progress_path) as f:
+                for line in f:
+                    ## The last line can be cut short by a crash
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._progress[record['task']] = record
+
+
+    @classmethod
+    def create(cls, path: str, sites: Union[str, List[str], pd.DataFrame], measurements: Union[str, List[str]] = None, from_date: str = None, to_date: str = None, series_format: str = 'pkl', **get_data_kwargs):
+        """
+        Create a new job of all of the combinations of the sites and measurements.
+
+        Parameters
+        ----------
+        path : str
+            The directory of the job. It will be created if it doesn't exist, but it must not already contain a job.
+        sites : str, list of str, or DataFrame
+            The site(s) to get the results. A DataFrame with SiteName and MeasurementName columns (e.g. from get_collection_list) makes a task of each row instead, and then measurements isn't needed.
+        measurements : str, list of str, or None
+            The measurement(s) to get the results.
+        from_date : str or None
+            The start date in the format 2001-01-01. None will put it to the beginning of the time series.
+        to_date : str or None
+            The end date in the format 2001-01-01. None will put it to the end of the time series.
+        series_format : str
+            The file format of the completed series. One of pkl, csv, or parquet. Parquet needs pyarrow or fastparquet.
+        **get_data_kwargs
+            Other keyword arguments passed to get_data for every task (e.g. agg_method, quality_codes, or parameters).
+
+        Returns
+        -------
+        ExtractionJob
+        """
+        if series_format not in series_formats:
+            raise ValueError('series_format must be one of ' + ', '.join(series_formats))
+        if (series_format == 'parquet') and (importlib.util.find_spec('pyarrow') is None) and (importlib.util.find_spec('fastparquet') is None):
+            raise ImportError('pyarrow or fastparquet must be installed for the parquet series_format.')
+
+        get_data_kwargs = _serialize_kwargs(get_data_kwargs)
+
+        if isinstance(sites, pd.DataFrame):
+            pairs = list(dict.fromkeys(zip(sites['SiteName'], sites['MeasurementName'])))
+        else:
+            if isinstance(sites, str):
+                sites = [sites]
+            if isinstance(measurements, str):
+                measurements = [measurements]
+            if measurements is None:
+                raise ValueError('The measurements must be passed unless sites is a DataFrame with a MeasurementName column.')
+            pairs = [(site, m) for site in sites for m in measurements]
+
+        if os.path.isfile(os.path.join(path, manifest_name)):
+            raise ValueError('A job already exists in ' + path + '. Open it with ExtractionJob(path).')
+
+        os.makedirs(os.path.join(path, series_dir), exist_ok=True)
+
+        tasks = [{'SiteName': site, 'MeasurementName': m, 'FromDate': from_date, 'ToDate': to_date} for site, m in pairs]
+        manifest = {'created': datetime.now().isoformat(timespec='seconds'), 'series_format': series_format, 'get_data_kwargs': get_data_kwargs, 'tasks': tasks}
+        _write_manifest(path, manifest)
+
+        return cls(path)
+
+
+    def _series_path(self, task, suffix=''):
+        """
+        The path to the file of a completed series.
+        """
+        return os.path.join(self.path, series_dir, str(task).zfill(6) + suffix + '.' + self.series_format)
+
+
+    def _record(self, task, status, rows=0, reason=None):
+        """
+        Append the outcome of a task to the progress log.
+        """
+        record = {'task': task, 'Status': status, 'Rows': rows, 'Reason': reason, 'time': datetime.now().isoformat(timespec='seconds')}
+
+        with self._lock:
+            with open(os.path.join(self.path, progress_name), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._progress[task] = record
+
+
+    def _write(self, df, path):
+        """
+        Write a DataFrame atomically so that a crash never leaves a partial file.
+        """
+        tmp_path = path + '.tmp'
+        if self.series_format == 'csv':
+            df.to_csv(tmp_path, index=False)
+        elif self.series_format == 'parquet':
+            df.to_parquet(tmp_path, index=False)
+        else:
+            df.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+
+
+    def _read(self, path):
+        """
+        Read the file of a completed series.
+        """
+        if self.series_format == 'csv':
+            return pd.read_csv(path, parse_dates=['Time'])
+        elif self.series_format == 'parquet':
+            return pd.read_parquet(path)
+        else:
+            return pd.read_pickle(path)
+
+
+    def _route(self, hilltop, outstanding):
+        """
+        Find the hts files of the outstanding tasks of a HilltopGroup with a single route_data call (rather than a plan_data in every get_data call) and save them with the tasks in the manifest, so a resumed job doesn't route them again.
+        """
+        unrouted = [i for i in outstanding if ('hts' not in self.tasks[i]) or not set(self.tasks[i]['hts']).issubset(hilltop.hilltops)]
+        if not unrouted:
+            return
+
+        routes = hilltop.route_data([(self.tasks[i]['SiteName'], self.tasks[i]['MeasurementName']) for i in unrouted])
+        for i, hts in zip(unrouted, routes):
+            self.tasks[i]['hts'] = hts
+
+        manifest = {'created': self.created, 'series_format': self.series_format, 'get_data_kwargs': self.get_data_kwargs, 'tasks': self.tasks}
+        with self._lock:
+            _write_manifest(self.path, manifest)
+
+
+    def _run_task(self, hilltop, task):
+        """
+        Run a single task and record the outcome. Any error is recorded as a failure rather than stopping the job. The routed tasks of a HilltopGroup only request the hts files that have them.
+        """
+        t = self.tasks[task]
+        try:
+            if hasattr(hilltop, 'route_data'):
+                res = hilltop.get_task_data([(h, t['SiteName'], t['MeasurementName']) for h in t['hts']], from_date=t['FromDate'], to_date=t['ToDate'], **self.get_data_kwargs)
+            else:
+                res = hilltop.get_data(t['SiteName'], t['MeasurementName'], from_date=t['FromDate'], to_date=t['ToDate'], **self.get_data_kwargs)
+        except Exception as err:
+            self._record(task, 'failed', reason=type(err).__name__ + ': ' + str(err))
+            return
+
+        if isinstance(res, tuple):
+            data, params = res
+            if not params.empty:
+                self._write(params, self._series_path(task, '_params'))
+        else:
+            data = res
+
+        if not data.empty:
+            self._write(data, self._series_path(task))
+
+        self._record(task, 'done', rows=len(data))
+
+
+    def outstanding(self, retry_failed: bool = True):
+        """
+        The positions of the tasks that still need to be run.
+
+        Parameters
+        ----------
+        retry_failed : bool
+            Should the failed tasks be included?
+
+        Returns
+        -------
+        list of int
+        """
+        skip = ['done'] if retry_failed else ['done', 'failed']
+
+        return [i for i in range(len(self.tasks)) if self._progress.get(i, {}).get('Status') not in skip]
+
+
+    def run(self, hilltop, retry_failed: bool = True, progress=None):
+        """
+        Run the outstanding tasks. The tasks are run concurrently using the max_workers of the hilltop object. The tasks of a HilltopGroup are first routed to the hts files that have them with one SiteList request per measurement and hts file, and the hts files of each task are saved in the manifest.
+
+        Parameters
+        ----------
+        hilltop : Hilltop or HilltopGroup
+            The object to get the data with.
+        retry_failed : bool
+            Should the tasks that failed in a previous run be tried again?
+        progress : callable or None
+            A function that is called as each task finishes with the number of finished tasks of this run, the number of tasks of this run, the task (a dict of the SiteName, MeasurementName, FromDate, and ToDate), and its progress record (a dict with the Status, Rows, and Reason). It's called from the worker threads.
+
+        Returns
+        -------
+        DataFrame
+            The status of all of the tasks.
+        """
+        outstanding = self.outstanding(retry_failed)
+        finished = [0]
+
+        if hasattr(hilltop, 'route_data'):
+            self._route(hilltop, outstanding)
+
+        def run_task(task):
+            self._run_task(hilltop, task)
+            if progress is not None:
+                with self._lock:
+                    finished[0] += 1
+                    progress(finished[0], len(outstanding), self.tasks[task], self._progress[task])
+
+        hilltop._map(run_task, outstanding)
+
+        return self.status
+
+
+    @property
+    def status(self):
+        """
+        The status of all of the tasks as a DataFrame. The Status is one of pending, done, or failed, and the Reason is the error of the failed tasks.
+        """
+        rows = []
+        for i, t in enumerate(self.tasks):
+            record = self._progress.get(i, {})
+            rows.append([t['SiteName'], t['MeasurementName'], t['FromDate'], t['ToDate'], record.get('Status', 'pending'), record.get('Rows', 0), record.get('Reason')])
+
+        return pd.DataFrame(rows, columns=status_cols)
+
+
+    def read(self):
+        """
+        Read all of the completed series.
+
+        Returns
+        -------
+        DataFrame
+            Or a tuple of the data and the parameters DataFrames if the job was run with parameters='long'.
+        """
+        done = [i for i in range(len(self.tasks)) if self._progress.get(i, {}).get('Status') == 'done']
+
+        data_list = [self._read(self._series_path(i)) for i in done if os.path.isfile(self._series_path(i))]
+        data = pd.concat(data_list) if data_list else pd.DataFrame(columns=['SiteName', 'MeasurementName', 'Time'])
+
+        if self.get_data_kwargs.get('parameters') == 'long':
+            params_list = [self._read(self._series_path(i, '_params')) for i in done if os.path.isfile(self._series_path(i, '_params'))]
+            params = pd.concat(params_list) if params_list else pd.DataFrame(columns=['SiteName', 'MeasurementName', 'Time', 'ParameterName', 'ParameterValue'])
+
+            return data, params
+
+        return data
+
+
+    def __len__(self):
+        return len(self.tasks)
+
+
+    def __repr__(self):
+        counts = self.status['Status'].value_counts()
+        return 'ExtractionJob(' + self.path + ', ' + ', '.join(str(counts.get(s, 0)) + ' ' + s for s in ['done', 'failed', 'pending']) + ')'
+
+
+############################################
+### Running jobs
+
+
+def run_job(hilltop, path: str, sites: Union[str, List[str]] = None, measurements: Union[str, List[str]] = None, from_date: str = None, to_date: str = None, retry_failed: bool = True, **get_data_kwargs):
+    """
+    Function to run a checkpointed bulk extraction of time series data. Every completed series is written to the path as soon as it finishes and failures are recorded with their reason, so if the job is stopped (or the server goes down) running it again with the same path only runs the outstanding tasks.
+
+    Parameters
+    ----------
+    hilltop : Hilltop or HilltopGroup
+        The object to get the data with.
+    path : str
+        The directory of the job.
+    sites : str, list of str, or None
+        The site(s) to get the results. Only needed when the job is created.
+    measurements : str, list of str, or None
+        The measurement(s) to get the results. Only needed when the job is created.
+    from_date : str or None
+        The start date in the format 2001-01-01. None will put it to the beginning of the time series.
+    to_date : str or None
+        The end date in the format 2001-01-01. None will put it to the end of the time series.
+    retry_failed : bool
+        Should the tasks that failed in a previous run be tried again?
+    **get_data_kwargs
+        Other keyword arguments passed to get_data (e.g. agg_method, quality_codes, or parameters).
+
+    Returns
+    -------
+    ExtractionJob
+        Use the status attribute for the status of all of the tasks and the read method to get the data.
+    """
+    if os.path.isfile(os.path.join(path, manifest_name)):
+        job = ExtractionJob(path)
+    else:
+        if (sites is None) or (measurements is None):
+            raise ValueError('The sites and measurements must be passed to create a new job.')
+        job = ExtractionJob.create(path, sites, measurements, from_date=from_date, to_date=to_date, **get_data_kwargs)
+
+    job.run(hilltop, retry_failed=retry_failed)
+
+    return job
@@ -4,14 +4,357 @@ Created on 2022-07-25
 
 @author: MichaelEK
 """
+import os
+import warnings
 import pandas as pd
 import numpy as np
-from hilltoppy.utils import convert_value, get_hilltop_xml, convert_mowsecs, build_url
+import threading
+import multiprocessing
+import weakref
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Executor
+from hilltoppy.utils import get_hilltop_xml, get_hilltop_bytes, build_url, RequestMetrics, parse_gauging_values, DataElementParser, greedy_set_cover, parse_data_source_info, resolve_dsn, DsnTree, SiteIndex, NameIndex, normalize_name
 from hilltoppy import web_service as ws
+from hilltoppy import jobs
+from hilltoppy.aggregate import aggregate_data, time_weighted_stats
+from hilltoppy.dataset import to_dataset
 from typing import List, Union
 ############################################
 ### Parameters
 
+data_cols = ['SiteName', 'MeasurementName', 'Time']
+param_cols = ['SiteName', 'MeasurementName', 'Time', 'ParameterName', 'ParameterValue']
+
+response_formats = [None, 'WML2']
+outputs = ['frame', 'xarray']
+
+_wml2_ns = '{http://www.opengis.net/waterml/2.0}'
+_wml2_series = _wml2_ns + 'MeasurementTimeseries'
+_wml2_tvp = _wml2_ns + 'MeasurementTVP'
+_wml2_time = _wml2_ns + 'time'
+_wml2_value = _wml2_ns + 'value'
+_wml2_metadata = _wml2_ns + 'metadata'
+_wml2_qualifier = _wml2_ns + 'qualifier'
+_xlink_title = '{http://www.w3.org/1999/xlink}title'
+
+
+def _empty_data(parameters=None):
+    """
+    The empty result of a GetData request.
+    """
+    if parameters == 'long':
+        return pd.DataFrame(columns=data_cols), pd.DataFrame(columns=param_cols)
+    else:
+        return pd.DataFrame(columns=data_cols)
+
+
+def _combine_data(res_df_list, parameters=None):
+    """
+    Concatenate the results of many GetData requests.
+    """
+    if not res_df_list:
+        return _empty_data(parameters)
+
+    if parameters == 'long':
+        res_df = pd.concat([r[0] for r in res_df_list])
+        params_df = pd.concat([r[1] for r in res_df_list])
+
+        return res_df, params_df
+
+    res_df = pd.concat(res_df_list)
+
+    return res_df
+
+
+def _label_data(output1, params_df, site, measurement, parameters=None):
+    """
+    Add the SiteName and MeasurementName to the parsed data (and parameters) of a GetData response.
+    """
+    if not output1.empty:
+        output1['Time'] = pd.to_datetime(output1['Time'])
+        output1['SiteName'] = site
+        output1['MeasurementName'] = measurement
+        output1 = output1.set_index(data_cols).reset_index()
+    else:
+        output1 = pd.DataFrame(columns=data_cols)
+
+    if parameters == 'long':
+        if (params_df is not None) and (not params_df.empty):
+            params_df['Time'] = pd.to_datetime(params_df['Time'])
+            params_df['SiteName'] = site
+            params_df['MeasurementName'] = measurement
+            params_df = params_df[param_cols]
+        else:
+            params_df = pd.DataFrame(columns=param_cols)
+
+        return output1, params_df
+
+    return output1
+
+
+def _map(func, items, max_workers=None):
+    """
+    Run func over the items using up to max_workers threads. The results are returned in the order of the items.
+    """
+    items = list(items)
+    if (max_workers is None) or (max_workers <= 1) or (len(items) <= 1):
+        return [func(i) for i in items]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        results = list(executor.map(func, items))
+
+    return results
+
+
+def _to_dataset(res_df_list, hilltops, skipped_df=None):
+    """
+    Assemble the results of the GetData requests into an xarray Dataset with the site locations, the units of the measurements, and the skipped combos. hilltops has the Hilltop object of each result.
+    """
+    res_df_list = [r[0] if isinstance(r, tuple) else r for r in res_df_list]
+
+    attrs = {}
+    for df, ht in zip(res_df_list, hilltops):
+        if not df.empty:
+            site = df['SiteName'].iloc[0]
+            m = df['MeasurementName'].iloc[0]
+            m_dict1 = ht._measurement_info(site, m)
+            if (m not in attrs) and (m_dict1 is not None):
+                attrs[m] = {'units': m_dict1.get('Units')}
+
+    hilltops1 = list({id(ht): ht for ht in hilltops}.values())
+    sites = pd.concat([ht.get_site_index(location=True).sites for ht in hilltops1]) if hilltops1 else None
+
+    ds = to_dataset(res_df_list, sites=sites, attrs=attrs)
+
+    ## netCDF attributes can't hold a DataFrame, so the skipped combos are stored as lines of text
+    if skipped_df is not None:
+        ds.attrs['skipped'] = '\n'.join(r[0] + ' | ' + r[1] + ': ' + r[2] for r in skipped_df[['SiteName', 'MeasurementName', 'Reason']].itertuples(index=False, name=None))
+
+    return ds
+
+
+def _is_gauging(m_dict1):
+    """
+    Is the measurement gauging data?
+    """
+    return (m_dict1['DataType'] in ['GaugingResults']) or (m_dict1['DataSourceName'] in ['Gauging Results'])
+
+
+def _url_format(m_dict1, response_format=None):
+    """
+    The format to request the GetData response in. Only the simple time series can be requested in other formats and the gauging data needs the Native format.
+    """
+    if m_dict1['DataType'] in ['HydSection', 'HydFacecard']:
+        raise NotImplementedError(' and '.join(['HydSection', 'HydFacecard']) +  ' Data Types have not been implemented.')
+
+    if _is_gauging(m_dict1):
+        return 'Native'
+    elif m_dict1['DataType'] == 'SimpleTimeSeries':
+        return response_format
+    else:
+        return None
+
+
+class _GetDataParser(object):
+    """
+    Incremental parser of a GetData response. The E and V elements are read and then dropped from the tree as the response streams in, so the full xml tree of a large response is never held in memory.
+    """
+    def __init__(self, site, measurement, m_dict1=None, apply_precision=False, parameters='wide'):
+        self.site = site
+        self.measurement = measurement
+        self.m_dict1 = m_dict1
+        self.apply_precision = apply_precision
+        self.parameters = parameters
+
+        self.status = 'ok'
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._meas = None
+        self._data = None
+        self._elements = None
+        self._gauging_texts = None
+
+
+    def _start_data(self):
+        """
+        Set up the reading of the values once the measurement info is known.
+        """
+        if self.m_dict1 is None:
+            self.status = 'error'
+            return
+
+        if _is_gauging(self.m_dict1):
+            self._gauging_texts = []
+        else:
+            self._elements = DataElementParser(self.m_dict1['DataType'], self.m_dict1['Item'], self.m_dict1['Precision'], self.apply_precision, self.parameters)
+
+
+    def feed(self, data):
+        if self.status != 'ok':
+            return
+        self._parser.feed(data)
+
+        for event, elem in self._parser.read_events():
+            tag = elem.tag
+            if event == 'start':
+                if tag == 'Measurement' and self._meas is None:
+                    self._meas = elem
+                elif (tag == 'Data') and (self._meas is not None) and (self._data is None):
+                    self._data = elem
+                    self._start_data()
+            elif elem is self._meas or self._data is None:
+                if tag == 'Error':
+                    self.status = 'error'
+                elif (tag == 'DataSource') and (self.m_dict1 is None) and (self._meas is not None):
+                    ## Get the measurement info from the response when it wasn't probed
+                    self.m_dict1 = parse_data_source_info(self._meas, self.measurement)
+
+                    if self.m_dict1 is None:
+                        self.status = 'error'
+                    elif self.m_dict1['DataType'] in ['HydSection', 'HydFacecard']:
+                        raise NotImplementedError(' and '.join(['HydSection', 'HydFacecard']) +  ' Data Types have not been implemented.')
+                    ## The gauging items and divisors need the full measurement info and the Native format
+                    elif _is_gauging(self.m_dict1):
+                        self.status = 'native'
+                    ## The item of a multi-item data source couldn't be matched to the measurement
+                    elif 'Item' not in self.m_dict1:
+                        self.status = 'probe'
+            elif tag == 'E' and self._elements is not None:
+                self._elements.add(elem)
+            elif tag == 'V' and self._gauging_texts is not None:
+                self._gauging_texts.append(elem.text)
+
+            if self.status != 'ok':
+                return
+
+        ## Release the values that have been read
+        if self._data is not None:
+            self._data.clear()
+
+
+    def close(self):
+        """
+        Finish parsing and return the status, the measurement info, and the data. The status is 'ok', 'error' if the response had no data, 'native' if the measurement turned out to be gauging data that needs to be requested in the Native format, or 'probe' if the item of the measurement needs to be taken from a MeasurementList request.
+        """
+        if self.status != 'ok':
+            return self.status, self.m_dict1, None
+
+        self._parser.close()
+        for event, elem in self._parser.read_events():
+            if elem.tag == 'Error':
+                return 'error', self.m_dict1, None
+
+        site = self.site
+        measurement = self.measurement
+        parameters = self.parameters
+        params_df = None
+
+        if self._gauging_texts is not None:
+            output1 = parse_gauging_values(self._gauging_texts, self.m_dict1['Item'], self.m_dict1.get('Divisor'))
+        elif self._elements is not None:
+            output1 = self._elements.to_frame()
+            if parameters == 'long':
+                output1, params_df = output1
+        else:
+            output1 = pd.DataFrame()
+
+        return 'ok', self.m_dict1, _label_data(output1, params_df, site, measurement, parameters)
+
+
+class _WML2Parser(object):
+    """
+    Incremental parser of a GetData response in the WaterML 2.0 format (Format=WML2). The MeasurementTVP elements are read and then dropped from the tree as the response streams in. The output is the same as _GetDataParser; the UTC offsets of the times are dropped so that they are the same local times as the Hilltop format.
+    """
+    def __init__(self, site, measurement, m_dict1=None, apply_precision=False, parameters='wide'):
+        self.site = site
+        self.measurement = measurement
+        self.m_dict1 = m_dict1
+        self.apply_precision = apply_precision
+        self.parameters = parameters
+
+        self.status = 'ok'
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._series = None
+
+        self.times = []
+        self.values = []
+        self.qual_codes = []
+
+
+    def _read_events(self):
+        """
+        Read the points that have been parsed so far.
+        """
+        for event, elem in self._parser.read_events():
+            tag = elem.tag
+            if event == 'start':
+                if (tag == _wml2_series) and (self._series is None):
+                    self._series = elem
+            elif tag == _wml2_tvp:
+                time = value = qual_code = None
+                for child in elem:
+                    if child.tag == _wml2_time:
+                        time = child.text
+                    elif child.tag == _wml2_value:
+                        value = child.text
+                    elif child.tag == _wml2_metadata:
+                        qual = next(child.iter(_wml2_qualifier), None)
+                        if qual is not None:
+                            qual_code = qual.get(_xlink_title, qual.text)
+                self.times.append(time)
+                self.values.append(value)
+                self.qual_codes.append(qual_code)
+            elif (tag == 'Error') or tag.endswith('ExceptionReport'):
+                self.status = 'error'
+                return
+
+
+    def feed(self, data):
+        if self.status != 'ok':
+            return
+        self._parser.feed(data)
+        self._read_events()
+
+        ## Release the points that have been read
+        if self._series is not None:
+            self._series.clear()
+
+
+    def close(self):
+        """
+        Finish parsing and return the status, the measurement info, and the data. See _GetDataParser.close.
+        """
+        if self.status == 'ok':
+            self._parser.close()
+            self._read_events()
+
+        if self.status != 'ok':
+            return self.status, self.m_dict1, None
+
+        output1 = pd.DataFrame({'Time': [t[:19] for t in self.times]})
+
+        if self.times:
+            values = pd.to_numeric(pd.Series(self.values, dtype=object), errors='coerce')
+            if self.apply_precision and (self.m_dict1 is not None) and ('Precision' in self.m_dict1):
+                values = values.round(self.m_dict1['Precision'])
+            output1['Value'] = values.values
+
+            if any(q is not None for q in self.qual_codes):
+                output1['QualityCode'] = pd.to_numeric(pd.Series(self.qual_codes, dtype=object), errors='coerce').values
+
+        return 'ok', self.m_dict1, _label_data(output1, None, self.site, self.measurement, self.parameters)
+
+
+_data_parsers = {'WML2': _WML2Parser}
+
+
+def _parse_get_data(content, site, measurement, m_dict1=None, apply_precision=False, parameters='wide', response_format=None):
+    """
+    Parse the bytes of a GetData response. It's a module level function so that it can be run in a process pool. See _GetDataParser.close for the output.
+    """
+    parser = _data_parsers.get(response_format, _GetDataParser)(site, measurement, m_dict1, apply_precision, parameters)
+    parser.feed(content)
+
+    return parser.close()
 
 
 ########################################
@@ -22,7 +365,7 @@ class Hilltop(object):
     """
 
     """
-    def __init__(self, base_url: str, hts: str, timeout: int = 60, **kwargs):
+    def __init__(self, base_url: str, hts: str, timeout: int = 60, compression: bool = True, validation: str = 'batch', max_workers: int = 4, parse_processes: Union[int, Executor] = None, **kwargs):
         """
         Base Hilltop class.
 
@@ -34,6 +377,14 @@ class Hilltop(object):
             hts file name including the .hts extension.
         timeout : int
             The http request timeout length in seconds.
+        compression : bool
+            Should gzip/deflate compression of the responses be requested from the server? Set to False for servers that misbehave with compressed responses.
+        validation : str
+            How the MeasurementList responses should be validated. 'batch' validates them against the data models and warns about any that fail, while 'trusted' skips the validation for servers that are known to return valid data.
+        max_workers : int
+            The max number of concurrent requests to the Hilltop server for the methods that run many requests.
+        parse_processes : int, Executor, or None
+            The number of processes to parse the GetData responses. Parsing the xml is CPU bound and holds the GIL, so with many concurrent requests of large responses the raw responses can be handed to a process pool while the requests continue in the threads. An existing executor (e.g. a ProcessPoolExecutor) can also be passed to share it. None parses in the request threads.
         **kwargs
             Optional keyword arguments passed to requests.
 
@@ -41,8 +392,18 @@ class Hilltop(object):
         self.timeout = timeout
         self.base_url = base_url
         self.hts = hts
+        self.compression = compression
+        self.validation = validation
+        self.max_workers = max_workers
+        self.metrics = RequestMetrics()
         self._measurements = {}
-        self._requests_kwargs = kwargs
+        self._data_measurements = {}
+        self._site_indexes = {}
+        self.parse_processes = parse_processes
+        self._parse_pool = parse_processes if isinstance(parse_processes, Executor) else None
+        self._pool_finalizer = None
+        self._pool_lock = threading.Lock()
+        self._requests_kwargs = dict(compression=compression, metrics=self.metrics, **kwargs)
 
         ## Test out Hilltop url
         sites = self.get_site_list()
@@ -55,6 +416,51 @@ class Hilltop(object):
         self.available_sites = sites
 
 
+    def _map(self, func, items):
+        """
+        Run func over the items using up to max_workers threads. The results are returned in the order of the items.
+        """
+        return _map(func, items, self.max_workers)
+
+
+    def _fetch_data(self, url, site, measurement, m_dict1=None, apply_precision=False, parameters='wide', response_format=None):
+        """
+        Request a GetData url and parse the response, either in this thread or in the process pool when parse_processes was set.
+        """
+        if not self.parse_processes:
+            parser = _data_parsers.get(response_format, _GetDataParser)
+            return get_hilltop_xml(url, timeout=self.timeout, parser=lambda: parser(site, measurement, m_dict1, apply_precision, parameters), **self._requests_kwargs)
+
+        with self._pool_lock:
+            if self._parse_pool is None:
+                self._parse_pool = ProcessPoolExecutor(max_workers=self.parse_processes, mp_context=multiprocessing.get_context('spawn'))
+                ## Shut the pool down if the object is garbage collected (or at exit) without close
+                self._pool_finalizer = weakref.finalize(self, self._parse_pool.shutdown)
+
+        content = get_hilltop_bytes(url, timeout=self.timeout, **self._requests_kwargs)
+        future = self._parse_pool.submit(_parse_get_data, content, site, measurement, m_dict1, apply_precision, parameters, response_format)
+
+        return future.result()
+
+
+    def close(self):
+        """
+        Shut down the process pool for parsing if this object created it. The object can also be used as a context manager to close it.
+        """
+        if self._pool_finalizer is not None:
+            self._pool_finalizer()
+            self._pool_finalizer = None
+            self._parse_pool = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
     def get_site_list(self, location: Union[str, bool] = None, measurement: str = None, collection: str = None, site_parameters: List[str] = None):
         """
         SiteList request function. Returns a list of sites associated with the hts file.
@@ -77,14 +483,91 @@ class Hilltop(object):
         return ws.site_list(self.base_url, self.hts, location=location, measurement=measurement, collection=collection, site_parameters=site_parameters, timeout=self.timeout, **self._requests_kwargs)
 
 
+    def get_site_index(self, location: Union[str, bool] = True):
+        """
+        Method to get the spatial index of the site locations. The index is built from a SiteList request the first time and is then cached on the object.
+
+        Parameters
+        ----------
+        location : str or bool
+            True uses the Easting and Northing, while 'LatLong' uses the NZGD2000 lat lon coordinates.
+
+        Returns
+        -------
+        SiteIndex
+        """
+        key = 'LatLong' if location == 'LatLong' else True
+        if key not in self._site_indexes:
+            sites = self.get_site_list(location=key)
+            if key == 'LatLong':
+                cols = ['Longitude', 'Latitude']
+            else:
+                cols = ['Easting', 'Northing']
+            for col in cols:
+                if col not in sites:
+                    sites[col] = np.nan
+            self._site_indexes[key] = SiteIndex(sites, *cols)
+
+        return self._site_indexes[key]
+
+
+    def sites_within(self, bbox, location: Union[str, bool] = True):
+        """
+        Method to get the sites within a bounding box. The SiteName column can be passed directly to get_data.
+
+        Parameters
+        ----------
+        bbox : tuple
+            The (min x, min y, max x, max y) of the bounding box. That's (min Easting, min Northing, max Easting, max Northing) or (min lon, min lat, max lon, max lat) when location='LatLong'.
+        location : str or bool
+            True uses the Easting and Northing, while 'LatLong' uses the NZGD2000 lat lon coordinates.
+
+        Returns
+        -------
+        DataFrame
+        """
+        index = self.get_site_index(location)
+
+        return index.sites.iloc[index.within(bbox)].reset_index(drop=True)
+
+
+    def nearest_sites(self, point, k: int = 1, location: Union[str, bool] = True):
+        """
+        Method to get the k nearest sites to a point or to many points. The SiteName column can be passed directly to get_data.
+
+        Parameters
+        ----------
+        point : tuple or array-like
+            An (x, y) point or an array of shape (n, 2) of points. That's (Easting, Northing) or (lon, lat) when location='LatLong'.
+        k : int
+            The number of nearest sites per point.
+        location : str or bool
+            True uses the Easting and Northing, while 'LatLong' uses the NZGD2000 lat lon coordinates.
+
+        Returns
+        -------
+        DataFrame
+            The sites sorted by distance with a Distance column (in metres for Easting/Northing and km for lat lon). When many points are passed, the Point column is the position of the query point.
+        """
+        index = self.get_site_index(location)
+        idx, dist = index.nearest(point, k)
+
+        sites = index.sites.iloc[idx.ravel()].reset_index(drop=True)
+        sites['Distance'] = dist.ravel()
+        if np.ndim(point) > 1:
+            sites.insert(0, 'Point', np.repeat(np.arange(len(idx)), idx.shape[1]))
+
+        return sites
+
+
     def get_measurement_names(self, detailed=False):
         """
-        Method to get all of the available Measurement Names in the hts. When detailed=False, then the request is relatively fast but only returns the names. When detailed=True, the method runs through as many sites as necessary to get additional data about the Measurements.
+        Method to get all of the available Measurement Names in the hts. When detailed=False, then the request is relatively fast but only returns the names. When detailed=True, the method finds the smallest set of sites that together have all of the Measurements and requests their MeasurementLists concurrently to get additional data about the Measurements.
 
         Parameters
         ----------
         detailed : bool
-            If True, the method runs through as many sites as necessary to get additional data about the Measurements. It may take several minutes to run this query.
+            If True, the method runs through as many sites as necessary to get additional data about the Measurements. This runs a SiteList request per Measurement Name and a MeasurementList request per selected site, so it can still take a while on large hts files.
 
         Returns
         -------
@@ -102,26 +585,48 @@ class Hilltop(object):
             raise ValueError(tree1.find('Error').text)
         meas1 = tree1.findall('Measurement')
 
-        if meas1:
-            meas_list = []
-            m_names = set()
-            for m in meas1:
-                m_name = m.attrib['Name']
-                if detailed:
-                    if m_name.lower() not in m_names:
-                        sites = self.get_site_list(measurement=m_name)['SiteName'].tolist()
-
-                        if sites:
-                            mtypes = self.get_measurement_list(sites[0])
-                            m_cols = mtypes.columns
-                            new_cols = m_cols[m_cols.isin(cols)]
-                            mtypes = mtypes[new_cols].drop_duplicates('MeasurementName').set_index('MeasurementName').reset_index()
-                            m_names.update(set(mtypes['MeasurementName'].str.lower().tolist()))
-                            meas_list.append(mtypes)
-                else:
-                    meas_list.append(pd.DataFrame([m_name], columns=cols))
+        if not meas1:
+            return pd.DataFrame(columns=cols)
+
+        m_names = list(dict.fromkeys(m.attrib['Name'] for m in meas1))
+
+        if not detailed:
+            return pd.DataFrame(m_names, columns=cols).drop_duplicates('MeasurementName')
+
+        ## Reuse the measurements that have already been cached
+        meas_list = []
+        cached = {}
+        for site_meas in self._measurements.values():
+            for m in m_names:
+                if m not in cached:
+                    row_dict = site_meas.get(m)
+                    if row_dict is not None:
+                        cached[m] = row_dict
+
+        remaining = [m for m in m_names if m not in cached]
+        if len(remaining) < len(m_names):
+            meas_list.append(pd.DataFrame([cached[m] for m in m_names if m in cached]))
+
+        ## Plan the smallest set of sites that covers the rest of the measurements
+        site_lists = self._map(lambda m: self.get_site_list(measurement=m)['SiteName'].tolist(), remaining)
+
+        available = set(self.available_sites)
+        site_meas = {}
+        for m_name, sites in zip(remaining, site_lists):
+            for site in sites:
+                if site in available:
+                    site_meas.setdefault(site, set()).add(normalize_name(m_name))
+
+        cover_sites = greedy_set_cover(site_meas)
+
+        meas_list.extend(self._map(self._get_measurement_list_single, cover_sites))
+
+        meas_list = [m for m in meas_list if not m.empty]
 
-            meas_df = pd.concat(meas_list).drop_duplicates('MeasurementName')
+        if meas_list:
+            meas_df = pd.concat(meas_list)
+            m_cols = meas_df.columns
+            meas_df = meas_df[m_cols[m_cols.isin(cols)]].drop_duplicates('MeasurementName').set_index('MeasurementName').reset_index()
         else:
             meas_df = pd.DataFrame(columns=cols)
 
@@ -207,22 +712,24 @@ class Hilltop(object):
             raise ValueError('Requested site is not in hts file.')
 
         if site not in self._measurements:
-            self._measurements[site] = {}
+            self._measurements[site] = NameIndex()
 
         try:
-            output1 = ws.measurement_list(self.base_url, self.hts, site, measurement=measurement, timeout=self.timeout, **self._requests_kwargs)
+            output1 = ws.measurement_list(self.base_url, self.hts, site, measurement=measurement, validation=self.validation, timeout=self.timeout, **self._requests_kwargs)
         except ValueError:
             return pd.DataFrame(columns=['SiteName', 'MeasurementName'])
 
         ## Populate cache
         if not output1.empty:
-            for _, row in output1.iterrows():
-                row_dict = {k: v for k, v in row.to_dict().items() if pd.notna(v)}
-                self._measurements[site][row['MeasurementName'].lower()] = row_dict
+            for row in output1.to_dict('records'):
+                row_dict = {k: v for k, v in row.items() if pd.notna(v)}
+                self._measurements[site].add(row_dict)
 
         ## Filter by measurement
         if isinstance(measurement, str):
-            output1 = output1[output1['MeasurementName'].str.lower() == measurement.lower()].copy()
+            row_dict = self._measurements[site].get(measurement)
+            m_name = row_dict['MeasurementName'] if row_dict is not None else None
+            output1 = output1[output1['MeasurementName'] == m_name].copy()
 
         return output1
 
@@ -261,7 +768,7 @@ class Hilltop(object):
         return m_df
 
 
-    def _get_data_single(self, site, measurement, from_date=None, to_date=None, agg_method=None, agg_interval=None, alignment='00:00', quality_codes=False, apply_precision=False, tstype=None):
+    def _get_data_single(self, site, measurement, from_date=None, to_date=None, agg_method=None, agg_interval=None, alignment='00:00', quality_codes=False, apply_precision=False, tstype=None, parameters='wide', probe=True, response_format=None):
         """
         Method to query a Hilltop web server for time series data associated with a Site and Measurement.
 
@@ -287,6 +794,12 @@ class Hilltop(object):
             Should the precision according to Hilltop be applied to the data? Only use True if you're confident that Hilltop stores the correct precision, because it is not always correct.
         tstype : str or None
             The time series type; one of Standard, Check, or Quality.
+        parameters : str, dict, or None
+            How the sample Parameters of WQ data should be returned. See get_data.
+        probe : bool
+            Should a MeasurementList request be made to check the site/measurement combo and get the measurement info when it isn't already cached? If False, the combo is assumed to exist and the info is taken from the GetData response.
+        response_format : str or None
+            The format of the GetData response. See get_data.
 
         Returns
         -------
@@ -296,146 +809,124 @@ class Hilltop(object):
         if site not in self.available_sites:
             raise ValueError('Requested site is not in hts file.')
 
+        if response_format not in response_formats:
+            raise ValueError('response_format must be one of ' + ', '.join(str(f) for f in response_formats))
+
         ## Make sure that the measurement data has already been stored
-        if site not in self._measurements:
-            _ = self._get_measurement_list_single(site, measurement)
+        m_dict1 = self._measurements.get(site, NameIndex()).get(measurement)
 
-        if measurement.lower() not in self._measurements[site]:
+        if (m_dict1 is None) and probe:
             _ = self._get_measurement_list_single(site, measurement)
+            m_dict1 = self._measurements[site].get(measurement)
 
-        if measurement.lower() not in self._measurements[site]:
-            return pd.DataFrame(columns=['SiteName', 'MeasurementName', 'Time'])
+            if m_dict1 is None:
+                return _empty_data(parameters)
 
-        ## Determine what response format to use
-        m_dict1 = self._measurements[site][measurement.lower()]
+        ## Only the simple time series can be requested in other formats, so the DataType must be known first. The MeasurementList of the whole site is cached for its other measurements
+        if (m_dict1 is None) and (response_format is not None):
+            _ = self._get_measurement_list_single(site)
+            m_dict1 = self._measurements[site].get(measurement)
 
-        if m_dict1['DataType'] in ['HydSection', 'HydFacecard']:
-            raise NotImplementedError(' and '.join(['HydSection', 'HydFacecard']) +  ' Data Types have not been implemented.')
+        ## Determine what response format to use
+        if m_dict1 is not None:
+            url_format = _url_format(m_dict1, response_format)
+        else:
+            url_format = None
 
-        if (m_dict1['DataType'] in ['GaugingResults']) or (m_dict1['DataSourceName'] in ['Gauging Results']):
-            response_format = 'Native'
+        ## Request the measurement by its canonical (RequestAs) name when it's known
+        if m_dict1 is not None:
+            request_as = m_dict1.get('MeasurementName', measurement)
         else:
-            response_format = None
+            request_as = measurement
 
         ## Make url
-        url = build_url(base_url=self.base_url, hts=self.hts, request='GetData', site=site, measurement=measurement, from_date=from_date, to_date=to_date, agg_method=agg_method, agg_interval=agg_interval, alignment=alignment, quality_codes=quality_codes, tstype=tstype, response_format=response_format)
+        url = build_url(base_url=self.base_url, hts=self.hts, request='GetData', site=site, measurement=request_as, from_date=from_date, to_date=to_date, agg_method=agg_method, agg_interval=agg_interval, alignment=alignment, quality_codes=quality_codes, tstype=tstype, response_format=url_format)
 
-        ## Request data and load in xml
-        tree1 = get_hilltop_xml(url, timeout=self.timeout, **self._requests_kwargs)
+        ## Request data and parse it
+        status, m_dict1, output1 = self._fetch_data(url, site, measurement, m_dict1, apply_precision, parameters, url_format)
 
-        if tree1.find('Error') is not None:
-            return pd.DataFrame(columns=['SiteName', 'MeasurementName', 'Time'])
-        meas1 = tree1.find('Measurement')
+        ## The gauging items and divisors (or an unmatched item) need the full measurement info
+        if status in ('native', 'probe'):
+            _ = self._get_measurement_list_single(site, measurement)
+            m_dict1 = self._measurements[site].get(measurement, m_dict1)
 
-        if meas1 is not None:
-            item_num = m_dict1['Item']
+            if 'Item' not in m_dict1:
+                warnings.warn('The item of ' + measurement + ' at ' + site + ' could not be found in the MeasurementList.')
+                return _empty_data(parameters)
 
-            if (m_dict1['DataType'] in ['GaugingResults']) or (m_dict1['DataSourceName'] in ['Gauging Results']):
-                data1 = meas1.find('Data').findall('V')
+            url_format = _url_format(m_dict1, response_format)
+            url = build_url(base_url=self.base_url, hts=self.hts, request='GetData', site=site, measurement=m_dict1.get('MeasurementName', measurement), from_date=from_date, to_date=to_date, agg_method=agg_method, agg_interval=agg_interval, alignment=alignment, quality_codes=quality_codes, tstype=tstype, response_format=url_format)
+            status, m_dict1, output1 = self._fetch_data(url, site, measurement, m_dict1, apply_precision, parameters, url_format)
 
-                data_list = []
-                append = data_list.append
+        if status == 'error':
+            return _empty_data(parameters)
 
-                for val in data1:
-                    val_text = val.text.encode('ascii', 'ignore').decode()
-                    mowsecs = int(val_text.split(' ')[0])
-                    time = convert_mowsecs(mowsecs)
+        ## Keep the measurement info of the response (e.g. the Interpolation and Units) for the combos that were requested without a MeasurementList
+        if m_dict1 is not None:
+            self._data_measurements[(site, measurement)] = m_dict1
 
-                    val_dict = {'Time': time}
+        return output1
 
-                    v1 = val_text.split(' ')[item_num]
 
-                    try:
-                        v1 = int(v1)
-                    except ValueError:
-                        v1 = float(v1)
+    def _measurement_info(self, site, measurement):
+        """
+        The cached measurement info of a Site and Measurement, from its MeasurementList or else from a GetData response.
+        """
+        m_dict1 = self._measurements.get(site, NameIndex()).get(measurement)
+        if m_dict1 is None:
+            m_dict1 = self._data_measurements.get((site, measurement))
 
-                    if v1 >= 0:
-                        if 'Divisor' in m_dict1:
-                            v1 = v1 / m_dict1['Divisor']
+        return m_dict1
 
-                        val_dict['Value'] = v1
 
-                        append(val_dict)
-            else:
-                data1 = meas1.find('Data').findall('E')
-
-                data_list = []
-                append = data_list.append
-
-                for val in data1:
-                    time = val.find('T').text.encode('ascii', 'ignore').decode()
-
-                    val_dict = {'Time': time}
-
-                    censor_code = None
-                    if m_dict1['DataType'] == 'WQData':
-                        v1 = convert_value(val.find('Value').text)
-                        if isinstance(v1, str):
-                            if '<' in v1:
-                                censor_code = 'less_than'
-                                v1 = convert_value(v1[1:])
-                            elif '>' in v1:
-                                censor_code = 'greater_than'
-                                v1 = convert_value(v1[1:])
-
-                        qual_code = val.find('QualityCode')
-                    elif m_dict1['DataType'] == 'WQSample':
-                        v1 = None
-                        qual_code = None
-                    else:
-                        v1 = convert_value(val.find('I' + str(item_num)).text)
-                        qual_code = val.find('Q' + str(item_num))
-
-                    if apply_precision and isinstance(v1, (int, float)) and (censor_code is None):
-                        v1 = np.round(v1, m_dict1['Precision'])
-                        if m_dict1['Precision'] == 0:
-                            v1 = int(v1)
-
-                    if v1 is not None:
-                        val_dict['Value'] = v1
-                    if censor_code is not None:
-                        val_dict['CensorCode'] = censor_code
-
-                    params = val.findall('Parameter')
-
-                    if params:
-                        for param in params:
-                            p_name = param.attrib['Name']
-                            p_val = convert_value(param.attrib['Value'])
-                            val_dict[p_name] = p_val
-
-                    if qual_code is not None:
-                        val_dict['QualityCode'] = convert_value(qual_code.text)
-
-                    append(val_dict)
-
-            if data_list:
-                output1 = pd.DataFrame(data_list)
-                output1['Time'] = pd.to_datetime(output1['Time'])
-                output1['SiteName'] = site
-                output1['MeasurementName'] = measurement
-                output1 = output1.set_index(['SiteName', 'MeasurementName', 'Time']).reset_index()
-
-                if 'CensorCode' in output1:
-                    output1.loc[output1['CensorCode'].isnull(), 'CensorCode'] = 'not_censored'
-            else:
-                output1 = pd.DataFrame(columns=['SiteName', 'MeasurementName', 'Time'])
+    def plan_data(self, sites: Union[str, List[str]], measurements: Union[str, List[str]]):
+        """
+        Method to find which of the Site and Measurement combos actually exist before requesting any data. It makes one SiteList request per measurement rather than a MeasurementList request per combo.
 
-        else:
-            output1 = pd.DataFrame(columns=['SiteName', 'MeasurementName', 'Time'])
+        Parameters
+        ----------
+        sites : str or list of str
+            The site(s).
+        measurements : str or list of str
+            The measurement(s).
 
-        return output1
+        Returns
+        -------
+        tuple of list and DataFrame
+            The list of (site, measurement) combos that exist and a DataFrame of the SiteName, MeasurementName, and Reason of the skipped combos.
+        """
+        if isinstance(sites, str):
+            sites = [sites]
+        if isinstance(measurements, str):
+            measurements = [measurements]
+
+        site_lists = self._map(lambda m: set(self.get_site_list(measurement=m)['SiteName'].tolist()), measurements)
+
+        available = set(self.available_sites)
+        valid = []
+        skipped = []
+        for site in sites:
+            for measurement, m_sites in zip(measurements, site_lists):
+                if site not in available:
+                    skipped.append((site, measurement, 'Site is not in hts file'))
+                elif site not in m_sites:
+                    skipped.append((site, measurement, 'Measurement not found at site'))
+                else:
+                    valid.append((site, measurement))
+
+        skipped_df = pd.DataFrame(skipped, columns=['SiteName', 'MeasurementName', 'Reason'])
 
+        return valid, skipped_df
 
-    def get_data(self, sites: Union[str, List[str]], measurements: Union[str, List[str]], from_date: str = None, to_date: str = None, agg_method: str = None, agg_interval: str = None, alignment: str = '00:00', quality_codes: bool = False, apply_precision: bool = False, tstype: str = None):
+
+    def get_data(self, sites: Union[str, List[str], pd.DataFrame], measurements: Union[str, List[str]], from_date: str = None, to_date: str = None, agg_method: str = None, agg_interval: str = None, alignment: str = '00:00', quality_codes: bool = False, apply_precision: bool = False, tstype: str = None, parameters: Union[str, dict, None] = 'wide', plan: bool = False, response_format: str = None, output: str = 'frame', concurrent: bool = False):
         """
-        Method to query a Hilltop web server for time series data associated with a Site and Measurement.
+        Method to query a Hilltop web server for time series data associated with a Site and Measurement. The requests of the Site and Measurement combos are made one at a time unless concurrent=True.
 
         Parameters
         ----------
-        sites : str or list of str
-            The site(s) to get the results. You can pass a single site as a string, or a list of sites.
+        sites : str, list of str, or DataFrame
+            The site(s) to get the results. You can pass a single site as a string, a list of sites, or a DataFrame with a SiteName column (e.g. from sites_within or nearest_sites).
         measurements : str or list of str
             The measurement(s) to get the results. If multiple sites and measurements are passed, all combinations must exist in Hilltop.
         from_date : str or None
@@ -454,22 +945,537 @@ class Hilltop(object):
             Should the precision according to Hilltop be applied to the data? Only use True if you're confident that Hilltop stores the correct precision, because it is not always correct.
         tstype : str or None
             The time series type; one of Standard, Check, or Quality.
+        parameters : str, dict, or None
+            How the sample Parameters (e.g. Lab, Sample ID) of WQ data should be returned. 'wide' adds all of them as columns to the data, a dict of {parameter name: dtype} only adds the declared Parameters as columns of that dtype, 'long' returns them as a separate tidy DataFrame of SiteName, MeasurementName, Time, ParameterName, and ParameterValue, and None ignores them.
+        plan : bool
+            Should the existing Site and Measurement combos be found first with plan_data (one SiteList request per measurement) so that only those combos are requested? This saves most of the requests when many of the combos don't exist. The skipped combos are stored in the attrs['skipped'] of the returned data.
+        response_format : str or None
+            The format of the GetData responses. None uses the Hilltop xml format and 'WML2' uses WaterML 2.0, which some servers return faster and smaller. The output is the same either way. Only the simple time series are requested as WML2; the gauging and WQ data always use the Hilltop formats. When the DataType of a measurement isn't cached yet (e.g. with plan=True), a MeasurementList request is made for its site first to find it.
+        output : str
+            'frame' returns a DataFrame and 'xarray' returns an xarray Dataset with time and site dimensions, one variable per measurement, and the site locations as coordinates (see dataset.to_dataset). The Dataset is best suited to regular series (e.g. with an agg_interval) and doesn't include the parameters or quality codes. With plan=True the skipped combos are stored in its attrs['skipped'] as lines of 'SiteName | MeasurementName: Reason'.
+        concurrent : bool
+            Should the requests of the Site and Measurement combos be run concurrently using up to the max_workers of the Hilltop object? The data is in the same order either way.
 
         Returns
         -------
         DataFrame
+            Or a tuple of the data and the parameters DataFrames if parameters='long', or an xarray Dataset if output='xarray'.
         """
+        if output not in outputs:
+            raise ValueError('output must be one of ' + ', '.join(outputs))
+
         if isinstance(sites, str):
             sites = [sites]
+        elif isinstance(sites, pd.DataFrame):
+            sites = list(dict.fromkeys(sites['SiteName']))
         if isinstance(measurements, str):
             measurements = [measurements]
 
-        res_df_list = []
-        for site in sites:
-            for measurement in measurements:
-                res_df0 = self._get_data_single(site, measurement, from_date=from_date, to_date=to_date, agg_method=agg_method, agg_interval=agg_interval, alignment=alignment, quality_codes=quality_codes, apply_precision=apply_precision, tstype=tstype)
-                res_df_list.append(res_df0)
+        if plan:
+            pairs, skipped_df = self.plan_data(sites, measurements)
+        else:
+            pairs = [(site, measurement) for site in sites for measurement in measurements]
+
+        def fetch(pair):
+            return self._get_data_single(pair[0], pair[1], from_date=from_date, to_date=to_date, agg_method=agg_method, agg_interval=agg_interval, alignment=alignment, quality_codes=quality_codes, apply_precision=apply_precision, tstype=tstype, parameters=parameters, probe=not plan, response_format=response_format)
+
+        res_df_list = _map(fetch, pairs, self.max_workers if concurrent else 1)
+
+        if output == 'xarray':
+            return _to_dataset(res_df_list, [self] * len(res_df_list), skipped_df if plan else None)
+
+        res_df = _combine_data(res_df_list, parameters)
+
+        if plan:
+            if parameters == 'long':
+                res_df[0].attrs['skipped'] = skipped_df
+            else:
+                res_df.attrs['skipped'] = skipped_df
+
+        return res_df
+
+
+    def get_collection_data(self, collection: str, from_date: str = None, to_date: str = None, agg_method: str = None, agg_interval: str = None, alignment: str = '00:00', quality_codes: bool = False, apply_precision: bool = False, tstype: str = None, parameters: Union[str, dict, None] = 'wide', response_format: str = None, output: str = 'frame'):
+        """
+        Method to get the time series data of all of the Site and Measurement combos in a collection. The CollectionList already says which combos exist, so the data is requested directly (without the MeasurementList checks that get_data makes) and concurrently using max_workers.
+
+        Parameters
+        ----------
+        collection : str
+            The collection name. Make a call to get_collection_list to see the available collections.
+        from_date : str or None
+            The start date in the format 2001-01-01. None will put it to the beginning of the time series.
+        to_date : str or None
+            The end date in the format 2001-01-01. None will put it to the end of the time series.
+        agg_method : str or None
+            The aggregation method to resample the data. e.g. Average, Total, Moving Average, Extrema.
+        agg_interval : str or None
+            The aggregation interval for the agg_method. e.g. '1 day', '1 week', '1 month'.
+        alignment : str or None
+            The start time alignment when agg_method is not None.
+        quality_codes : bool
+            Should the quality codes get returned?
+        apply_precision : bool
+            Should the precision according to Hilltop be applied to the data? Only use True if you're confident that Hilltop stores the correct precision, because it is not always correct.
+        tstype : str or None
+            The time series type; one of Standard, Check, or Quality.
+        parameters : str, dict, or None
+            How the sample Parameters of WQ data should be returned. See get_data.
+        response_format : str or None
+            The format of the GetData responses. None or 'WML2'. See get_data.
+        output : str
+            'frame' returns a DataFrame and 'xarray' returns an xarray Dataset. See get_data.
+
+        Returns
+        -------
+        DataFrame
+            Or a tuple of the data and the parameters DataFrames if parameters='long', or an xarray Dataset if output='xarray'.
+        """
+        if output not in outputs:
+            raise ValueError('output must be one of ' + ', '.join(outputs))
+
+        cl = self.get_collection_list()
+        cl = cl[cl['CollectionName'] == collection]
+
+        if cl.empty:
+            raise ValueError('Requested collection is not in the CollectionList.')
+
+        pairs = cl[['SiteName', 'MeasurementName']].dropna().drop_duplicates()
+        missing = pairs[~pairs['SiteName'].isin(self.available_sites)]
+        if not missing.empty:
+            warnings.warn('The following collection sites are not in the hts file and were skipped: ' + ', '.join(missing['SiteName'].unique()))
+            pairs = pairs[pairs['SiteName'].isin(self.available_sites)]
+
+        def fetch(pair):
+            return self._get_data_single(pair[0], pair[1], from_date=from_date, to_date=to_date, agg_method=agg_method, agg_interval=agg_interval, alignment=alignment, quality_codes=quality_codes, apply_precision=apply_precision, tstype=tstype, parameters=parameters, probe=False, response_format=response_format)
+
+        res_df_list = self._map(fetch, pairs.itertuples(index=False, name=None))
+
+        if output == 'xarray':
+            return _to_dataset(res_df_list, [self] * len(res_df_list))
+
+        return _combine_data(res_df_list, parameters)
+
 
-        res_df = pd.concat(res_df_list)
+    def run_job(self, path: str, sites: Union[str, List[str]] = None, measurements: Union[str, List[str]] = None, from_date: str = None, to_date: str = None, retry_failed: bool = True, **get_data_kwargs):
+        """
+        Method to run a checkpointed bulk extraction of time series data. Running it again with the same path only runs the outstanding tasks. See jobs.run_job for the parameters.
+
+        Returns
+        -------
+        ExtractionJob
+        """
+        return jobs.run_job(self, path, sites, measurements, from_date=from_date, to_date=to_date, retry_failed=retry_failed, **get_data_kwargs)
+
+
+    def _get_interpolation(self, data):
+        """
+        The Interpolation of the Site and Measurement combos in the data. The cached measurement info is used, and a MeasurementList request is made for the combos that aren't cached. The combos that still have no Interpolation raise a warning and are treated as Instant.
+        """
+        combos = list(data[['SiteName', 'MeasurementName']].drop_duplicates().itertuples(index=False, name=None))
+
+        available = set(self.available_sites)
+        missing = [c for c in combos if (c[0] in available) and ('Interpolation' not in (self._measurement_info(*c) or {}))]
+        self._map(lambda c: self._get_measurement_list_single(*c), missing)
+
+        rows = []
+        unknown = []
+        for site, m in combos:
+            m_dict1 = self._measurement_info(site, m)
+            if (m_dict1 is not None) and ('Interpolation' in m_dict1):
+                rows.append([site, m, m_dict1['Interpolation']])
+            else:
+                unknown.append(site + ' | ' + m)
+
+        if unknown:
+            warnings.warn('The Interpolation of the following series could not be found, so they are treated as Instant: ' + ', '.join(unknown))
+
+        return pd.DataFrame(rows, columns=['SiteName', 'MeasurementName', 'Interpolation'])
+
+
+    def aggregate_data(self, data: pd.DataFrame, agg_method: str, agg_interval: str, alignment: str = '00:00'):
+        """
+        Method to aggregate the raw data from get_data locally rather than making a new GetData request for every agg_method and agg_interval. The Interpolation of each Site and Measurement is taken from the measurement info that get_data has already cached (from the MeasurementList or the GetData response). The combos without it get a MeasurementList request, and any that still have none are treated as Instant with a warning. See aggregate.aggregate_data for how each Interpolation is aggregated.
+
+        Parameters
+        ----------
+        data : DataFrame
+            The raw data from get_data.
+        agg_method : str
+            The aggregation method. One of Average, Total, Moving Average, Extrema, or EP.
+        agg_interval : str
+            The aggregation interval for the agg_method. e.g. '1 day', '1 week', '1 month'.
+        alignment : str or None
+            The time of day that the intervals start in the form '00:00'.
+
+        Returns
+        -------
+        DataFrame
+        """
+        return aggregate_data(data, agg_method, agg_interval, alignment=alignment, interpolation=self._get_interpolation(data))
+
+
+    def time_weighted_stats(self, data: pd.DataFrame, max_gap: str = None):
+        """
+        Method to calculate the time weighted statistics (e.g. the mean and the integral) of each series of the raw data from get_data without resampling it. The Interpolation of each Site and Measurement is taken from the measurement info that get_data has already cached (from the MeasurementList or the GetData response). The combos without it get a MeasurementList request, and any that still have none are treated as Instant with a warning. See aggregate.time_weighted_stats.
+
+        Parameters
+        ----------
+        data : DataFrame
+            The raw data from get_data.
+        max_gap : str or None
+            The longest time between consecutive values that isn't a gap (e.g. '1 hour'). None has no gaps.
+
+        Returns
+        -------
+        DataFrame
+        """
+        return time_weighted_stats(data, interpolation=self._get_interpolation(data), max_gap=max_gap)
+
+
+class HilltopGroup(object):
+    """
+
+    """
+    def __init__(self, base_url: str, hts: Union[str, List[str]], timeout: int = 60, compression: bool = True, validation: str = 'batch', max_workers: int = 4, parse_processes: Union[int, Executor] = None, **kwargs):
+        """
+        Class to access many hts files on the same Hilltop server as if they were one. Each request is routed to the hts files that have the sites and measurements and the requests to all of the files are run concurrently.
+
+        Parameters
+        ----------
+        base_url : str
+            Root Hilltop url.
+        hts : str, list of str, or DsnTree
+            Either a list of hts file names (including the .hts extension), a path to a local copy of a dsn file, or a DsnTree from utils.resolve_dsn. The hts files of the dsn are accessed using their file names, so they must be available under those names on the Hilltop server.
+        timeout : int
+            The http request timeout length in seconds.
+        compression : bool
+            Should gzip/deflate compression of the responses be requested from the server?
+        validation : str
+            How the MeasurementList responses should be validated. See Hilltop.
+        max_workers : int
+            The max number of concurrent requests to the Hilltop server.
+        parse_processes : int, Executor, or None
+            The number of processes to parse the GetData responses. A single process pool is shared by all of the hts files. See Hilltop.
+        **kwargs
+            Optional keyword arguments passed to requests.
+
+        """
+        if isinstance(hts, str):
+            if hts.lower().endswith('.dsn'):
+                hts = resolve_dsn(hts)
+            else:
+                hts = [hts]
+        if isinstance(hts, DsnTree):
+            hts = [os.path.basename(h) for h in hts]
+
+        hts = list(dict.fromkeys(hts))
+        if not hts:
+            raise ValueError('No hts files were passed.')
+
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.parse_processes = parse_processes
+
+        self._pool_finalizer = None
+        if parse_processes and not isinstance(parse_processes, Executor):
+            self._parse_pool = ProcessPoolExecutor(max_workers=parse_processes, mp_context=multiprocessing.get_context('spawn'))
+            self._pool_finalizer = weakref.finalize(self, self._parse_pool.shutdown)
+        else:
+            self._parse_pool = parse_processes
+
+        hilltops = self._map(lambda h: Hilltop(base_url, h, timeout=timeout, compression=compression, validation=validation, max_workers=1, parse_processes=self._parse_pool, **kwargs), hts)
+        self.hilltops = dict(zip(hts, hilltops))
+
+        ## Merged site index
+        site_index = {}
+        for h, ht in self.hilltops.items():
+            for site in ht.available_sites:
+                site_index.setdefault(site, []).append(h)
+
+        self.site_index = site_index
+        self.available_sites = list(site_index)
+
+
+    def _map(self, func, items):
+        """
+        Run func over the items using up to max_workers threads. The results are returned in the order of the items.
+        """
+        return _map(func, items, self.max_workers)
+
+
+    def close(self):
+        """
+        Shut down the process pool for parsing if this object created it. The object can also be used as a context manager to close it.
+        """
+        if self._pool_finalizer is not None:
+            self._pool_finalizer()
+            self._pool_finalizer = None
+            self._parse_pool = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    @property
+    def metrics(self):
+        """
+        The combined RequestMetrics of all of the hts files. It's a new object with the totals at the time it's called, so use the metrics of each Hilltop in hilltops to reset them.
+        """
+        return RequestMetrics.combine(ht.metrics for ht in self.hilltops.values())
+
+
+    def get_site_list(self, location: Union[str, bool] = None, measurement: str = None, collection: str = None, site_parameters: List[str] = None):
+        """
+        SiteList request function. Returns the sites of all of the hts files with an additional hts column.
+
+        Parameters
+        ----------
+        location : str, bool, or None
+            Should the location be returned? 'Yes' returns the Easting and Northing, while 'LatLong' returns NZGD2000 lat lon coordinates.
+        measurement : str or None
+            The measurement name.
+        collection : str or None
+            Get site list via a collection.
+        site_parameters : list or None
+            A list of the site parameters to be returned with the SiteList request.
+
+        Returns
+        -------
+        DataFrame
+        """
+        def fetch(h):
+            sites = self.hilltops[h].get_site_list(location=location, measurement=measurement, collection=collection, site_parameters=site_parameters)
+            sites['hts'] = h
+            return sites
+
+        return pd.concat(self._map(fetch, self.hilltops)).reset_index(drop=True)
+
+
+    def get_measurement_list(self, sites: Union[str, List[str]] = None, measurement: str = None):
+        """
+        Method to query the Hilltop server for the measurement summary of a site or sites. Each site is only requested from the hts files that contain it.
+
+        Parameters
+        ----------
+        sites : str, list of str, or None
+            The site(s) to get the measurements. None gets the measurements for all available sites in all of the hts files.
+        measurement : str or None
+            The measurement name to filter the sites by.
+
+        Returns
+        -------
+        DataFrame
+            With an additional hts column.
+        """
+        if isinstance(sites, str):
+            sites = [sites]
+        elif sites is None:
+            sites = self.available_sites
+
+        tasks = [(h, site) for site in sites for h in self.site_index.get(site, [])]
+
+        def fetch(task):
+            m_df = self.hilltops[task[0]]._get_measurement_list_single(task[1], measurement=measurement)
+            m_df['hts'] = task[0]
+            return m_df
+
+        m_df_list = self._map(fetch, tasks)
+
+        if m_df_list:
+            m_df = pd.concat(m_df_list).reset_index(drop=True)
+        else:
+            m_df = pd.DataFrame(columns=['SiteName', 'MeasurementName', 'hts'])
+
+        return m_df
+
+
+    def route_data(self, pairs: List[tuple]):
+        """
+        Method to find the hts files that have each of the (site, measurement) pairs. It makes one SiteList request per measurement and hts file, however many pairs there are.
+
+        Parameters
+        ----------
+        pairs : list of tuple
+            The (site, measurement) pairs.
+
+        Returns
+        -------
+        list of list of str
+            The hts files of each pair, in the order of the pairs. The list is empty for the pairs that aren't in any hts file.
+        """
+        pairs = list(pairs)
+        measurements = list(dict.fromkeys(m for _, m in pairs))
+
+        tasks = [(h, m) for m in measurements for h in self.hilltops]
+        site_lists = self._map(lambda t: set(self.hilltops[t[0]].get_site_list(measurement=t[1])['SiteName'].tolist()), tasks)
+        m_sites = dict(zip(tasks, site_lists))
+
+        return [[h for h in self.site_index.get(site, []) if site in m_sites[(h, measurement)]] for site, measurement in pairs]
+
+
+    def plan_data(self, sites: Union[str, List[str]], measurements: Union[str, List[str]]):
+        """
+        Method to find which hts files have which of the Site and Measurement combos. It makes one SiteList request per measurement and hts file.
+
+        Parameters
+        ----------
+        sites : str or list of str
+            The site(s).
+        measurements : str or list of str
+            The measurement(s).
+
+        Returns
+        -------
+        tuple of list and DataFrame
+            The list of (hts, site, measurement) combos that exist and a DataFrame of the SiteName, MeasurementName, and Reason of the skipped combos.
+        """
+        if isinstance(sites, str):
+            sites = [sites]
+        if isinstance(measurements, str):
+            measurements = [measurements]
+
+        pairs = [(site, measurement) for site in sites for measurement in measurements]
+
+        valid = []
+        skipped = []
+        for (site, measurement), found in zip(pairs, self.route_data(pairs)):
+            if site not in self.site_index:
+                skipped.append((site, measurement, 'Site is not in any hts file'))
+            elif found:
+                valid.extend([(h, site, measurement) for h in found])
+            else:
+                skipped.append((site, measurement, 'Measurement not found at site'))
+
+        skipped_df = pd.DataFrame(skipped, columns=['SiteName', 'MeasurementName', 'Reason'])
+
+        return valid, skipped_df
+
+
+    def _fetch_tasks(self, tasks, from_date=None, to_date=None, agg_method=None, agg_interval=None, alignment='00:00', quality_codes=False, apply_precision=False, tstype=None, parameters='wide', response_format=None):
+        """
+        Run the GetData requests of the (hts, site, measurement) tasks concurrently and add the hts column to each result.
+        """
+        def fetch(task):
+            res = self.hilltops[task[0]]._get_data_single(task[1], task[2], from_date=from_date, to_date=to_date, agg_method=agg_method, agg_interval=agg_interval, alignment=alignment, quality_codes=quality_codes, apply_precision=apply_precision, tstype=tstype, parameters=parameters, probe=False, response_format=response_format)
+            if parameters == 'long':
+                res[0]['hts'] = task[0]
+                res[1]['hts'] = task[0]
+            else:
+                res['hts'] = task[0]
+            return res
+
+        return self._map(fetch, tasks)
+
+
+    def get_data(self, sites: Union[str, List[str]], measurements: Union[str, List[str]], from_date: str = None, to_date: str = None, agg_method: str = None, agg_interval: str = None, alignment: str = '00:00', quality_codes: bool = False, apply_precision: bool = False, tstype: str = None, parameters: Union[str, dict, None] = 'wide', response_format: str = None, output: str = 'frame'):
+        """
+        Method to query the Hilltop server for time series data of the sites and measurements across all of the hts files. The combos are first routed to the hts files that have them (see plan_data) and then all of the GetData requests are run concurrently. The skipped combos are stored in the attrs['skipped'] of the returned data.
+
+        Parameters
+        ----------
+        sites : str or list of str
+            The site(s) to get the results.
+        measurements : str or list of str
+            The measurement(s) to get the results.
+        from_date : str or None
+            The start date in the format 2001-01-01. None will put it to the beginning of the time series.
+        to_date : str or None
+            The end date in the format 2001-01-01. None will put it to the end of the time series.
+        agg_method : str or None
+            The aggregation method to resample the data. e.g. Average, Total, Moving Average, Extrema.
+        agg_interval : str or None
+            The aggregation interval for the agg_method. e.g. '1 day', '1 week', '1 month'.
+        alignment : str or None
+            The start time alignment when agg_method is not None.
+        quality_codes : bool
+            Should the quality codes get returned?
+        apply_precision : bool
+            Should the precision according to Hilltop be applied to the data?
+        tstype : str or None
+            The time series type; one of Standard, Check, or Quality.
+        parameters : str, dict, or None
+            How the sample Parameters of WQ data should be returned. See Hilltop.get_data.
+        response_format : str or None
+            The format of the GetData responses. None or 'WML2'. See Hilltop.get_data.
+        output : str
+            'frame' returns a DataFrame and 'xarray' returns an xarray Dataset (see Hilltop.get_data). The Dataset has no hts dimension, so a site with the same measurement in more than one hts file only keeps the values of the last file at the same times (with a warning).
+
+        Returns
+        -------
+        DataFrame
+            With an additional hts column. Or a tuple of the data and the parameters DataFrames if parameters='long', or an xarray Dataset if output='xarray'.
+        """
+        if output not in outputs:
+            raise ValueError('output must be one of ' + ', '.join(outputs))
+
+        tasks, skipped_df = self.plan_data(sites, measurements)
+
+        res_df_list = self._fetch_tasks(tasks, from_date=from_date, to_date=to_date, agg_method=agg_method, agg_interval=agg_interval, alignment=alignment, quality_codes=quality_codes, apply_precision=apply_precision, tstype=tstype, parameters=parameters, response_format=response_format)
+
+        if output == 'xarray':
+            return _to_dataset(res_df_list, [self.hilltops[t[0]] for t in tasks], skipped_df)
+
+        res_df = _combine_data(res_df_list, parameters)
+
+        if parameters == 'long':
+            res_df[0].attrs['skipped'] = skipped_df
+        else:
+            res_df.attrs['skipped'] = skipped_df
 
         return res_df
+
+
+    def get_task_data(self, tasks: List[tuple], from_date: str = None, to_date: str = None, agg_method: str = None, agg_interval: str = None, alignment: str = '00:00', quality_codes: bool = False, apply_precision: bool = False, tstype: str = None, parameters: Union[str, dict, None] = 'wide', response_format: str = None):
+        """
+        Method to get the time series data of (hts, site, measurement) tasks that have already been routed (e.g. by plan_data or route_data), so no SiteList requests are made. The GetData requests are run concurrently.
+
+        Parameters
+        ----------
+        tasks : list of tuple
+            The (hts, site, measurement) tasks.
+        from_date : str or None
+            The start date in the format 2001-01-01. None will put it to the beginning of the time series.
+        to_date : str or None
+            The end date in the format 2001-01-01. None will put it to the end of the time series.
+        agg_method : str or None
+            The aggregation method to resample the data. e.g. Average, Total, Moving Average, Extrema.
+        agg_interval : str or None
+            The aggregation interval for the agg_method. e.g. '1 day', '1 week', '1 month'.
+        alignment : str or None
+            The start time alignment when agg_method is not None.
+        quality_codes : bool
+            Should the quality codes get returned?
+        apply_precision : bool
+            Should the precision according to Hilltop be applied to the data?
+        tstype : str or None
+            The time series type; one of Standard, Check, or Quality.
+        parameters : str, dict, or None
+            How the sample Parameters of WQ data should be returned. See Hilltop.get_data.
+        response_format : str or None
+            The format of the GetData responses. None or 'WML2'. See Hilltop.get_data.
+
+        Returns
+        -------
+        DataFrame
+            With an additional hts column. Or a tuple of the data and the parameters DataFrames if parameters='long'.
+        """
+        res_df_list = self._fetch_tasks(list(tasks), from_date=from_date, to_date=to_date, agg_method=agg_method, agg_interval=agg_interval, alignment=alignment, quality_codes=quality_codes, apply_precision=apply_precision, tstype=tstype, parameters=parameters, response_format=response_format)
+
+        return _combine_data(res_df_list, parameters)
+
+
+    def run_job(self, path: str, sites: Union[str, List[str]] = None, measurements: Union[str, List[str]] = None, from_date: str = None, to_date: str = None, retry_failed: bool = True, **get_data_kwargs):
+        """
+        Method to run a checkpointed bulk extraction of time series data. Running it again with the same path only runs the outstanding tasks. See jobs.run_job for the parameters.
+
+        Returns
+        -------
+        ExtractionJob
+        """
+        return jobs.run_job(self, path, sites, measurements, from_date=from_date, to_date=to_date, retry_failed=retry_failed, **get_data_kwargs)
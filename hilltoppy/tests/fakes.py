@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+Fake http objects shared by the tests that don't need a Hilltop server.
+"""
+
+
+class FakeResponse(object):
+    """
+    A streamed requests response of a fixed body. The body is streamed in chunks of chunk_size bytes so that the parsers get it in pieces.
+    """
+    def __init__(self, body, chunk_size=64):
+        self.headers = {}
+        self.raw = self
+        self.body = body
+        self.chunk_size = chunk_size
+
+
+    def stream(self, chunk_size, decode_content=False):
+        for i in range(0, len(self.body), self.chunk_size):
+            yield self.body[i: i + self.chunk_size]
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        pass
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the client-side aggregation.
+"""
+import pytest
+import numpy as np
+import pandas as pd
+from hilltoppy.aggregate import aggregate_data, time_weighted_stats, Interval
+
+### Parameters
+
+times = pd.date_range('2020-01-01', '2020-01-03', freq='6h')
+
+flow = pd.DataFrame({'SiteName': 'Site A', 'MeasurementName': 'Flow', 'Time': times, 'Value': np.arange(len(times), dtype=float)})
+rain = pd.DataFrame({'SiteName': 'Site A', 'MeasurementName': 'Rainfall', 'Time': times, 'Value': 1.0})
+
+data = pd.concat([flow, rain])
+interpolation = {'Flow': 'Instant', 'Rainfall': 'Incremental'}
+
+### Tests
+
+
+def test_interval():
+    day = Interval('1 day', '09:00')
+    t = np.array([pd.Timestamp('2020-01-01 08:59').value, pd.Timestamp('2020-01-01 09:00').value])
+    assert (day.edge(day.bin(t)) == [pd.Timestamp('2019-12-31 09:00').value, pd.Timestamp('2020-01-01 09:00').value]).all()
+
+    month = Interval('3 months')
+    assert pd.Timestamp(month.edge(month.bin(np.array([pd.Timestamp('2020-05-15').value])))[0]) == pd.Timestamp('2020-04-01')
+
+    with pytest.raises(ValueError):
+        Interval('1 fortnight')
+
+
+def test_average_total():
+    res = aggregate_data(data, 'Average', '1 day', interpolation=interpolation)
+    f = res[res.MeasurementName == 'Flow']
+    assert f['Time'].tolist() == [pd.Timestamp('2020-01-02'), pd.Timestamp('2020-01-03')]
+    assert f['Value'].tolist() == [2.0, 6.0]
+
+    res = aggregate_data(data, 'Total', '1 day', interpolation=interpolation)
+    f = res[res.MeasurementName == 'Flow']
+    assert f['Value'].tolist() == [2.0 * 86400, 6.0 * 86400]
+
+    ## The incremental values at midnight belong to the day before
+    r = res[res.MeasurementName == 'Rainfall']
+    assert r['Value'].tolist() == [1.0, 4.0, 4.0]
+
+    ## A 12 hour interval aligned to 03:00 splits the segments at the edges
+    res = aggregate_data(flow, 'Average', '12 hours', alignment='03:00')
+    assert res['Value'].tolist() == [0.25, 1.5, 3.5, 5.5, 7.25]
+
+
+def test_ep_extrema_moving_average():
+    res = aggregate_data(flow, 'EP', '1 day')
+    assert res['Value'].tolist() == [0.0, 4.0, 8.0]
+
+    ## The same intervals as the Average and Total
+    res = aggregate_data(flow, 'Extrema', '1 day')
+    assert res['Time'].tolist() == aggregate_data(flow, 'Average', '1 day')['Time'].tolist()
+    assert res['Min'].tolist() == [0.0, 4.0]
+    assert res['Max'].tolist() == [4.0, 8.0]
+    assert res['MinTime'].iloc[1] == pd.Timestamp('2020-01-02')
+
+    ## The interpolated values at the edges are included
+    res = aggregate_data(flow, 'Extrema', '12 hours', alignment='03:00')
+    assert res['Min'].tolist() == [0.0, 0.5, 2.5, 4.5, 6.5]
+    assert res['MinTime'].iloc[1] == pd.Timestamp('2020-01-01 03:00')
+
+    res = aggregate_data(flow, 'Moving Average', '1 day')
+    assert len(res) == len(flow)
+    assert res['Value'].iloc[4] == 2.5
+
+    with pytest.raises(ValueError):
+        aggregate_data(flow, 'Moving Average', '1 month')
+
+
+def test_time_zones():
+    ## The local times are used
+    flow_tz = flow.assign(Time=flow['Time'].dt.tz_localize('Pacific/Auckland'))
+    res = aggregate_data(flow_tz, 'Average', '1 day')
+    assert res['Time'].tolist() == [pd.Timestamp('2020-01-02'), pd.Timestamp('2020-01-03')]
+    assert res['Value'].tolist() == [2.0, 6.0]
+
+
+def test_interpolation_frame():
+    m_list = pd.DataFrame({'SiteName': ['Site A'], 'MeasurementName': ['Rainfall'], 'Interpolation': ['Discrete']})
+    res = aggregate_data(data, 'Total', '1 month', interpolation=m_list)
+    assert res.set_index('MeasurementName')['Value'].to_dict() == {'Flow': 4.0 * 2 * 86400, 'Rainfall': 9.0}
+
+
+def test_time_weighted_stats():
+    ## Irregular times with a 12 hour gap
+    t = pd.to_datetime(['2020-01-01 00:00', '2020-01-01 01:00', '2020-01-01 03:00', '2020-01-01 15:00', '2020-01-01 16:00'])
+    irregular = pd.DataFrame({'SiteName': 'Site A', 'MeasurementName': 'Flow', 'Time': t, 'Value': [1.0, 3.0, 3.0, 5.0, 7.0]})
+
+    stats = time_weighted_stats(irregular).iloc[0]
+    assert stats['Count'] == 5
+    assert stats['Integral'] == (2 + 6 + 48 + 6) * 3600
+    assert stats['Mean'] == 62 / 16
+    assert stats['Coverage'] == 1
+
+    stats = time_weighted_stats(irregular, max_gap='1 hour').iloc[0]
+    assert stats['GapCount'] == 2
+    assert stats['GapDuration'] == pd.Timedelta('14 hours')
+    assert stats['Mean'] == 4.0
+    assert stats['Coverage'] == 2 / 16
+
+    ## Discrete values are held and incremental values are the totals since the previous time
+    stats = time_weighted_stats(irregular, interpolation='Discrete').iloc[0]
+    assert stats['Integral'] == (1 + 6 + 36 + 5) * 3600
+
+    stats = time_weighted_stats(irregular, interpolation='Incremental').iloc[0]
+    assert stats['Integral'] == 18.0
+
+    ## Every Event value is counted, even a single one
+    stats = time_weighted_stats(irregular, interpolation='Event').iloc[0]
+    assert stats['Integral'] == 19.0
+    stats = time_weighted_stats(irregular.iloc[:1], interpolation='Event').iloc[0]
+    assert stats['Integral'] == 1.0
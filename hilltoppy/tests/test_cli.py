@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the command line tool that don't need a Hilltop server.
+"""
+import os
+import pandas as pd
+from hilltoppy import cli, ExtractionJob
+
+### Parameters
+
+
+class FakeServer(object):
+    """
+    Stands in for the Hilltop class. Returns a small series for every site and measurement, except that the down sites raise an error.
+    """
+    down = set()
+
+    def __init__(self, base_url, hts, **kwargs):
+        self.available_sites = ['A', 'B', 'C']
+
+
+    def _map(self, func, items):
+        return [func(i) for i in items]
+
+
+    def get_site_list(self, location=None, measurement=None, collection=None):
+        return pd.DataFrame({'SiteName': self.available_sites})
+
+
+    def get_collection_list(self):
+        return pd.DataFrame({'SiteName': ['A', 'C'], 'MeasurementName': ['Flow', 'Stage'], 'FileName': 'data.hts', 'CollectionName': 'Mixed'})
+
+
+    def get_data(self, site, measurement, from_date=None, to_date=None, **kwargs):
+        if site in self.down:
+            raise ValueError('The server is down')
+        return pd.DataFrame({'SiteName': site, 'MeasurementName': measurement, 'Time': pd.date_range('2020-01-01', periods=3), 'Value': [1.0, 2.0, 3.0]})
+
+
+    def close(self):
+        pass
+
+### Tests
+
+
+def test_sites(monkeypatch, capsys):
+    monkeypatch.setattr(cli, 'Hilltop', FakeServer)
+    assert cli.main(['sites', 'http://example.com/', 'data.hts']) == 0
+    assert capsys.readouterr().out.split() == ['SiteName', 'A', 'B', 'C']
+
+
+def test_export(monkeypatch, capsys, tmp_path):
+    monkeypatch.setattr(cli, 'Hilltop', FakeServer)
+    monkeypatch.setattr(FakeServer, 'down', {'B'})
+    out_dir = str(tmp_path / 'export')
+
+    assert cli.main(['export', 'http://example.com/', 'data.hts', out_dir, '--measurement', 'Flow', '--from-date', '2020-01-01']) == 1
+    err = capsys.readouterr().err
+    assert '[3/3]' in err
+    assert 'B | Flow: failed (ValueError: The server is down)' in err
+
+    status = pd.read_csv(os.path.join(out_dir, cli.status_name))
+    assert status['Status'].tolist() == ['done', 'failed', 'done']
+
+    ## Resume once the server is back up
+    monkeypatch.setattr(FakeServer, 'down', set())
+    assert cli.main(['export', 'http://example.com/', 'data.hts', out_dir]) == 0
+    assert 'Exporting 1 of 3 series' in capsys.readouterr().err
+
+    job = ExtractionJob(out_dir)
+    assert job.series_format == 'csv'
+    data = job.read()
+    assert len(data) == 9
+    assert pd.api.types.is_datetime64_dtype(data['Time'])
+
+
+def test_export_collection(monkeypatch, tmp_path):
+    monkeypatch.setattr(cli, 'Hilltop', FakeServer)
+    out_dir = str(tmp_path / 'export')
+
+    assert cli.main(['export', 'http://example.com/', 'data.hts', out_dir, '--collection', 'Mixed', '--format', 'pkl', '--quiet']) == 0
+    data = ExtractionJob(out_dir).read()
+    assert list(zip(data['SiteName'], data['MeasurementName']))[::3] == [('A', 'Flow'), ('C', 'Stage')]
+
+    assert cli.main(['export', 'http://example.com/', 'data.hts', str(tmp_path / 'none')]) == 2
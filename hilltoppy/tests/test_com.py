@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the com functions using the fake COM backend.
+"""
+import pytest
+import numpy as np
+import pandas as pd
+from hilltoppy import com
+from hilltoppy.fake_com import FakeComBackend
+
+### Parameters
+
+hts = 'C:/fake/data.hts'
+
+
+@pytest.fixture
+def backend():
+    backend = FakeComBackend()
+    fake = backend.add_hts(hts)
+    times = pd.date_range('2020-01-01', periods=48, freq='h')
+    fake.add_series('Site A', 'Flow', times, np.arange(48) * 10.0, units='l/s')
+    fake.add_series('Site B', 'Flow', times, np.arange(48) * 0.5, units='l/s')
+    fake.add_sample('Site A', '2020-01-01 10:00', {'Total Phosphorus': {'Value': '<0.005', 'Lab': 'L1'}, 'Nitrate': {'Value': '0.5'}}, {'Sample ID': '123'})
+    fake.add_sample('Site A', '2020-02-01 10:00', {'Total Phosphorus': {'Value': '0.02', 'Lab': 'L2'}}, {'Sample ID': '124'})
+
+    com.set_backend(backend)
+    yield backend
+    com.set_backend()
+
+### Tests
+
+
+def test_measurement_list(backend):
+    sites = com.measurement_list(hts)
+    assert set(sites['mtype']) == {'Flow', 'Total Phosphorus', 'Nitrate'}
+    assert sites[sites['mtype'] == 'Flow']['unit'].tolist() == ['l/s', 'l/s']
+
+
+def test_get_data_quantity(backend):
+    data = com.get_data_quantity(hts, sites=['Site A'], mtypes=['Flow'])
+    assert len(data) == 48
+    assert np.issubdtype(data.index.get_level_values('time').dtype, np.datetime64)
+    assert np.allclose(data.values, np.arange(48) * 0.01)
+
+    data = com.get_data_quantity(hts, mtypes=['Flow'], start='2020-01-01 12:00', end='2020-01-01 23:00')
+    assert len(data) == 24
+
+
+def test_get_data_quality(backend):
+    data = com.get_data_quality(hts, sites=['Site A'], mtypes=['Total Phosphorus'])
+    assert data['data'].tolist() == ['<0.005', 0.02]
+    assert data['time'].tolist() == [pd.Timestamp('2020-01-01 10:00'), pd.Timestamp('2020-02-01 10:00')]
+
+    data = com.get_data_quality(hts, sites=['Site A'], mtypes=['Total Phosphorus', 'WQ Sample'], dtl_method='standard', mtype_params=['Lab'], sample_params=['Sample ID'])
+    assert data['data'].tolist() == [0.0025, 0.02]
+    assert data['Lab'].tolist() == ['L1', 'L2']
+    assert data['Sample ID'].tolist() == ['123', '124']
+
+
+def test_write_wq_data(backend):
+    data = {'Site C': {'2021-01-01 09:00:00': {'SiteParameter': {'Sample ID': '200'}, 'Measurement': {'Nitrate': {'Value': '1.5', 'Lab': 'L3'}}},
+                       '2021-01-02 09:00:00': {'Measurement': {'Nitrate': {'Value': '<0.1'}}}},
+            'Site A': {'2021-01-01 10:00:00': {'Measurement': {'Nitrate': {'Value': '0.7'}}}}}
+
+    fake = backend.files[hts]
+
+    assert com.write_wq_data(hts, data) == 3
+    assert fake.commits == 1
+
+    data = com.get_data_quality(hts, sites=['Site C'], mtypes=['Nitrate', 'WQ Sample'], mtype_params=['Lab'], sample_params=['Sample ID'])
+    assert data['data'].tolist() == [1.5, '<0.1']
+    assert data['Lab'].tolist() == ['L3', '']
+    assert data['Sample ID'].tolist() == ['200', '']
+
+    new_data = {'Site D': {'2021-01-0' + str(d) + ' 09:00:00': {'Measurement': {'Nitrate': {'Value': str(d)}}} for d in range(1, 6)}}
+    assert com.write_wq_data(hts, new_data, chunk_size=2) == 5
+    assert fake.commits == 4
+
+
+def test_write_wq_data_errors(backend):
+    bad = {'Site Z': {'not a time': {'Measurement': {'Nitrate': {'Value': '1'}}},
+                      '2021-01-01': {'Measurement': {'Nitrate': {'Lab': 'L1'}}}}}
+
+    with pytest.raises(ValueError, match='2 error'):
+        com.write_wq_data(hts, bad)
+
+    assert 'Site Z' not in backend.files[hts].samples
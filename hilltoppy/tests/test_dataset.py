@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the xarray Dataset output.
+"""
+import pytest
+import numpy as np
+import pandas as pd
+from hilltoppy.dataset import to_dataset, write_dataset
+
+xr = pytest.importorskip('xarray')
+
+### Parameters
+
+times = pd.date_range('2020-01-01', periods=4, freq='D')
+
+flow_a = pd.DataFrame({'SiteName': 'Site A', 'MeasurementName': 'Flow', 'Time': times, 'Value': [1.0, 2.0, 3.0, 4.0]})
+flow_b = pd.DataFrame({'SiteName': 'Site B', 'MeasurementName': 'Flow', 'Time': times[1:], 'Value': [5.0, 6.0, 7.0]})
+rain_b = pd.DataFrame({'SiteName': 'Site B', 'MeasurementName': 'Rainfall', 'Time': times[:2], 'Value': ['0.5', '1.5']})
+
+sites = pd.DataFrame({'SiteName': ['Site B', 'Site A'], 'Easting': [1760000.0, 1750000.0], 'Northing': [5460000.0, 5450000.0]})
+
+### Tests
+
+
+def test_to_dataset():
+    data = pd.concat([flow_a, flow_b, rain_b])
+    ds = to_dataset(data, sites, attrs={'Flow': {'units': 'm3/s'}})
+
+    assert dict(ds.sizes) == {'time': 4, 'site': 2}
+    assert list(ds.site.values) == ['Site A', 'Site B']
+    assert ds.Flow.attrs['units'] == 'm3/s'
+    assert ds.Easting.values.tolist() == [1750000.0, 1760000.0]
+    assert np.isnan(ds.Flow.sel(site='Site B').values[0])
+    assert ds.Flow.sel(site='Site B').values[1:].tolist() == [5.0, 6.0, 7.0]
+    assert ds.Rainfall.sel(site='Site B').values[:2].tolist() == [0.5, 1.5]
+    assert np.isnan(ds.Rainfall.sel(site='Site A').values).all()
+
+    ds2 = to_dataset([flow_a, flow_b, rain_b], sites, attrs={'Flow': {'units': 'm3/s'}})
+    assert ds2.identical(ds)
+
+
+def test_write_dataset(tmp_path):
+    ds = to_dataset([flow_a, flow_b, rain_b], sites)
+
+    engines = xr.backends.list_engines()
+    paths = []
+    if ('netcdf4' in engines) or ('scipy' in engines):
+        paths.append(tmp_path / 'flow.nc')
+    if 'zarr' in engines:
+        paths.append(tmp_path / 'flow.zarr')
+    if not paths:
+        pytest.skip('No netCDF or Zarr backend installed')
+
+    for path in paths:
+        write_dataset(ds, str(path))
+        ds2 = xr.open_dataset(str(path), engine='zarr' if path.suffix == '.zarr' else None).load()
+        assert np.allclose(ds2.Flow.values, ds.Flow.values, equal_nan=True)
+        assert list(ds2.site.values) == list(ds.site.values)
+
+
+def test_to_dataset_duplicates():
+    ## Duplicates within a series and across the series of the same site are counted
+    dup_a = pd.concat([flow_a, flow_a.iloc[[2]].assign(Value=9.0)])
+    with pytest.warns(UserWarning, match=r'Flow \(1\)'):
+        ds = to_dataset(dup_a)
+    assert ds.Flow.values[:, 0].tolist() == [1.0, 2.0, 9.0, 4.0]
+
+    with pytest.warns(UserWarning, match=r'Flow \(4\)'):
+        to_dataset([flow_a, flow_a])
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the Hilltop and HilltopGroup classes that don't need a Hilltop server. The requests are answered by a small fake server.
+"""
+import os
+import gc
+import threading
+import pytest
+import urllib.parse
+import numpy as np
+import pandas as pd
+from hilltoppy import utils, Hilltop, HilltopGroup, ExtractionJob
+from hilltoppy.mountain_top import _WML2Parser
+from hilltoppy.utils import RequestMetrics
+from hilltoppy.jobs import progress_name
+from hilltoppy.tests.fakes import FakeResponse
+
+### Parameters
+
+sites = {'Site A': (1750000, 5450000), 'Site B': (1760000, 5460000), 'Site C': (1770000, 5470000)}
+
+## hts file: site: [(data source, data type, interpolation, [measurements])]
+data_sources = {
+    'data.hts': {
+        'Site A': [('Flow', 'SimpleTimeSeries', 'Instant', ['Flow']), ('Total Phosphorus', 'WQData', 'Discrete', ['Total Phosphorus'])],
+        'Site B': [('Flow', 'SimpleTimeSeries', 'Instant', ['Flow']), ('Rainfall', 'SimpleTimeSeries', 'Incremental', ['Rainfall'])],
+        },
+    'other.hts': {
+        'Site A': [('Rainfall', 'SimpleTimeSeries', 'Incremental', ['Rainfall'])],
+        'Site C': [('Flow', 'SimpleTimeSeries', 'Instant', ['Flow'])],
+        },
+    }
+
+wml2_head = '''<wml2:Collection xmlns:wml2="http://www.opengis.net/waterml/2.0" xmlns:gml="http://www.opengis.net/gml/3.2" xmlns:om="http://www.opengis.net/om/2.0" xmlns:xlink="http://www.w3.org/1999/xlink">
+<wml2:observationMember><om:OM_Observation gml:id="obs"><om:result><wml2:MeasurementTimeseries gml:id="ts">'''
+
+wml2_tail = '</wml2:MeasurementTimeseries></om:result></om:OM_Observation></wml2:observationMember></wml2:Collection>'
+
+wml2_xml1 = wml2_head + '''
+<wml2:point><wml2:MeasurementTVP><wml2:time>2015-01-01T00:00:00+12:00</wml2:time><wml2:value>1.5</wml2:value>
+<wml2:metadata><wml2:TVPMeasurementMetadata><wml2:qualifier xlink:title="600"/></wml2:TVPMeasurementMetadata></wml2:metadata></wml2:MeasurementTVP></wml2:point>
+<wml2:point><wml2:MeasurementTVP><wml2:time>2015-01-01T00:15:00+12:00</wml2:time><wml2:value>2.5</wml2:value></wml2:MeasurementTVP></wml2:point>
+<wml2:point><wml2:MeasurementTVP><wml2:time>2015-01-01T00:30:00+12:00</wml2:time><wml2:value>3.5</wml2:value>
+<wml2:metadata><wml2:TVPMeasurementMetadata><wml2:qualifier xlink:title="400"/></wml2:TVPMeasurementMetadata></wml2:metadata></wml2:MeasurementTVP></wml2:point>
+''' + wml2_tail
+
+wml2_error1 = '''<ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows/1.1"><ows:Exception exceptionCode="InvalidParameterValue"><ows:ExceptionText>No data</ows:ExceptionText></ows:Exception></ows:ExceptionReport>'''
+
+
+class FakeServer(object):
+    """
+    Stands in for requests.get and answers the Hilltop requests of each hts file from the sites and data_sources above. The hts file, query, and thread of every request are kept in requests.
+    """
+    def __init__(self, n_values=4):
+        self.n_values = n_values
+        self.requests = []
+
+
+    def __call__(self, url, **kwargs):
+        url1 = urllib.parse.urlsplit(url)
+        query = dict(urllib.parse.parse_qsl(url1.query))
+        query['hts'] = url1.path.rsplit('/', 1)[-1]
+        query['thread'] = threading.get_ident()
+        self.requests.append(query)
+
+        return FakeResponse(getattr(self, query['Request'])(query).encode(), 100)
+
+
+    def _find(self, hts, site, measurement):
+        for ds in data_sources[hts].get(site, []):
+            if measurement in ds[3]:
+                return ds
+
+
+    def SiteList(self, query):
+        out = '<HilltopServer>'
+        for site, (e, n) in sites.items():
+            if site not in data_sources[query['hts']]:
+                continue
+            if ('Measurement' in query) and (self._find(query['hts'], site, query['Measurement']) is None):
+                continue
+            loc = '<Easting>' + str(e) + '</Easting><Northing>' + str(n) + '</Northing>' if query.get('Location') == 'Yes' else ''
+            out += '<Site Name="' + site + '">' + loc + '</Site>'
+
+        return out + '</HilltopServer>'
+
+
+    def MeasurementList(self, query):
+        site = query['Site']
+        out = '<HilltopServer>'
+        for ds, data_type, interp, ms in data_sources[query['hts']][site]:
+            if ('Measurement' in query) and (query['Measurement'] not in ms):
+                continue
+            out += '<DataSource Name="' + ds + '"><NumItems>1</NumItems><TSType>StdSeries</TSType><DataType>' + data_type + '</DataType><Interpolation>' + interp + '</Interpolation><From>2015-01-01T00:00:00</From><To>2015-01-02T00:00:00</To>'
+            out += ''.join('<Measurement Name="' + m + '"><RequestAs>' + m + '</RequestAs><Item>1</Item><Units>m3/s</Units><Format>#.###</Format></Measurement>' for m in ms)
+            out += '</DataSource>'
+
+        return out + '</HilltopServer>'
+
+
+    def GetData(self, query):
+        ds = self._find(query['hts'], query['Site'], query['Measurement'])
+        if ds is None:
+            return '<HilltopServer><Error>No data</Error></HilltopServer>'
+
+        times = pd.date_range('2015-01-01', periods=self.n_values, freq='6h').strftime('%Y-%m-%dT%H:%M:%S')
+
+        if query.get('Format') == 'WML2':
+            body = ''.join('<wml2:point><wml2:MeasurementTVP><wml2:time>' + t + '+12:00</wml2:time><wml2:value>' + str(i + 1.5) + '</wml2:value></wml2:MeasurementTVP></wml2:point>' for i, t in enumerate(times))
+            return wml2_head + body + wml2_tail
+
+        out = '<Hilltop><Agency>X</Agency><Measurement SiteName="' + query['Site'] + '"><DataSource Name="' + ds[0] + '" NumItems="1"><TSType>StdSeries</TSType><DataType>' + ds[1] + '</DataType><Interpolation>' + ds[2] + '</Interpolation><ItemInfo ItemNumber="1"><ItemName>' + query['Measurement'] + '</ItemName><Units>m3/s</Units><Format>#.###</Format></ItemInfo></DataSource><Data DateFormat="Calendar" NumItems="1">'
+        if ds[1] == 'WQData':
+            out += ''.join('<E><T>' + t + '</T><Value>' + ('&lt;0.005' if i == 0 else str(0.01 * i)) + '</Value><Parameter Name="Lab" Value="L' + str(i) + '"/></E>' for i, t in enumerate(times))
+        else:
+            out += ''.join('<E><T>' + t + '</T><I1>' + str(i + 1.5) + '</I1></E>' for i, t in enumerate(times))
+
+        return out + '</Data></Measurement></Hilltop>'
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = FakeServer()
+    monkeypatch.setattr(utils.requests, 'get', server)
+    return server
+
+### Tests
+
+
+def test_wml2_parser():
+    parser = _WML2Parser('Site A', 'Flow')
+    content = wml2_xml1.encode()
+    for i in range(0, len(content), 50):
+        parser.feed(content[i: i + 50])
+    status, m_dict1, data = parser.close()
+
+    assert status == 'ok'
+    assert data['Time'].tolist() == list(pd.to_datetime(['2015-01-01 00:00', '2015-01-01 00:15', '2015-01-01 00:30']))
+    assert data['Value'].tolist() == [1.5, 2.5, 3.5]
+    assert data['QualityCode'].iloc[[0, 2]].tolist() == [600, 400]
+    assert np.isnan(data['QualityCode'].iloc[1])
+    assert (data['SiteName'] == 'Site A').all()
+
+    parser = _WML2Parser('Site A', 'Flow')
+    parser.feed(wml2_error1.encode())
+    assert parser.close()[0] == 'error'
+
+
+def test_get_data_wml2_data_types(server):
+    ht = Hilltop('http://example.com/', 'data.hts', max_workers=1)
+
+    ## plan=True doesn't probe each combo, so the DataType of the site is checked before the WQ data is requested
+    data = ht.get_data('Site A', ['Flow', 'Total Phosphorus'], plan=True, response_format='WML2')
+    formats = {r['Measurement']: r.get('Format') for r in server.requests if r['Request'] == 'GetData'}
+    assert formats == {'Flow': 'WML2', 'Total Phosphorus': None}
+
+    tp = data[data['MeasurementName'] == 'Total Phosphorus']
+    assert tp['CensorCode'].iloc[0] == 'less_than'
+    assert tp['Lab'].tolist() == ['L0', 'L1', 'L2', 'L3']
+    assert data.loc[data['MeasurementName'] == 'Flow', 'Value'].tolist() == [1.5, 2.5, 3.5, 4.5]
+
+
+def test_get_data_concurrent(server):
+    ht = Hilltop('http://example.com/', 'data.hts', max_workers=4)
+
+    ## The combos are requested one at a time unless concurrent=True
+    data = ht.get_data(['Site A', 'Site B'], 'Flow', plan=True)
+    assert {r['thread'] for r in server.requests if r['Request'] == 'GetData'} == {threading.get_ident()}
+
+    server.requests.clear()
+    data2 = ht.get_data(['Site A', 'Site B'], 'Flow', plan=True, concurrent=True)
+    assert threading.get_ident() not in {r['thread'] for r in server.requests if r['Request'] == 'GetData'}
+    assert data2.equals(data)
+
+
+def test_hilltop_group(server):
+    group = HilltopGroup('http://example.com/', ['data.hts', 'other.hts'], max_workers=2)
+    assert group.site_index == {'Site A': ['data.hts', 'other.hts'], 'Site B': ['data.hts'], 'Site C': ['other.hts']}
+
+    ## The combos are routed to the hts files that have them
+    valid, skipped = group.plan_data(['Site A', 'Site C', 'Site Z'], ['Flow', 'Rainfall'])
+    assert sorted(valid) == [('data.hts', 'Site A', 'Flow'), ('other.hts', 'Site A', 'Rainfall'), ('other.hts', 'Site C', 'Flow')]
+    assert skipped.values.tolist() == [['Site C', 'Rainfall', 'Measurement not found at site'], ['Site Z', 'Flow', 'Site is not in any hts file'], ['Site Z', 'Rainfall', 'Site is not in any hts file']]
+
+    data = group.get_data(['Site A', 'Site C', 'Site Z'], ['Flow', 'Rainfall'])
+    assert sorted(set(zip(data['hts'], data['SiteName'], data['MeasurementName']))) == sorted(valid)
+    assert len(data) == 12
+    assert data.attrs['skipped'].equals(skipped)
+
+    ## Only the files with the site get the GetData requests
+    get_data = [(r['hts'], r['Site'], r['Measurement']) for r in server.requests if r['Request'] == 'GetData']
+    assert sorted(get_data) == sorted(valid)
+
+    ## The metrics are the totals of the hts files
+    metrics = group.metrics
+    assert isinstance(metrics, RequestMetrics)
+    assert metrics.requests == len(server.requests)
+    assert metrics.bytes_received == sum(ht.metrics.bytes_received for ht in group.hilltops.values()) > 0
+
+
+def test_get_data_xarray(server):
+    pytest.importorskip('xarray')
+    ht = Hilltop('http://example.com/', 'data.hts', max_workers=1)
+    ds = ht.get_data(['Site A', 'Site B'], ['Flow', 'Rainfall'], plan=True, output='xarray')
+    assert list(ds.site.values) == ['Site A', 'Site B']
+    assert ds.Flow.values.tolist() == [[1.5, 1.5], [2.5, 2.5], [3.5, 3.5], [4.5, 4.5]]
+    assert ds.Easting.values.tolist() == [1750000.0, 1760000.0]
+    assert ds.attrs['skipped'] == 'Site A | Rainfall: Measurement not found at site'
+
+    ## Site A has Flow in data.hts and Rainfall in other.hts, and both end up in the group Dataset
+    group = HilltopGroup('http://example.com/', ['data.hts', 'other.hts'], max_workers=2)
+    ds = group.get_data(['Site A', 'Site C', 'Site Z'], ['Flow', 'Rainfall'], output='xarray')
+    assert list(ds.site.values) == ['Site A', 'Site C']
+    assert ds.Rainfall.sel(site='Site A').values.tolist() == [1.5, 2.5, 3.5, 4.5]
+    assert ds.Northing.values.tolist() == [5450000.0, 5470000.0]
+    assert ds.Rainfall.attrs['units'] == 'm3/s'
+    assert ds.attrs['skipped'].split('\n') == ['Site C | Rainfall: Measurement not found at site', 'Site Z | Flow: Site is not in any hts file', 'Site Z | Rainfall: Site is not in any hts file']
+
+    with pytest.raises(ValueError):
+        group.get_data('Site A', 'Flow', output='table')
+
+
+def test_hilltop_group_job(server, tmp_path):
+    group = HilltopGroup('http://example.com/', ['data.hts', 'other.hts'], max_workers=2)
+    server.requests.clear()
+
+    ## The tasks are routed once with a SiteList request per measurement and hts file, rather than in every get_data call
+    path = str(tmp_path / 'job')
+    job = group.run_job(path, ['Site A', 'Site B', 'Site C'], ['Flow', 'Rainfall'])
+    assert len([r for r in server.requests if r['Request'] == 'SiteList']) == 4
+    assert [t['hts'] for t in ExtractionJob(path).tasks] == [['data.hts'], ['other.hts'], ['data.hts'], ['data.hts'], ['other.hts'], []]
+
+    status = job.status
+    assert (status['Status'] == 'done').all()
+    assert status['Rows'].tolist() == [4, 4, 4, 4, 4, 0]
+    data = job.read()
+    assert sorted(set(zip(data['hts'], data['SiteName'], data['MeasurementName']))) == [('data.hts', 'Site A', 'Flow'), ('data.hts', 'Site B', 'Flow'), ('data.hts', 'Site B', 'Rainfall'), ('other.hts', 'Site A', 'Rainfall'), ('other.hts', 'Site C', 'Flow')]
+
+    ## A resumed job uses the saved routes
+    server.requests.clear()
+    with open(os.path.join(path, progress_name), 'w'):
+        pass
+    ExtractionJob(path).run(group)
+    assert not [r for r in server.requests if r['Request'] == 'SiteList']
+    assert len([r for r in server.requests if r['Request'] == 'GetData']) == 5
+
+
+def test_parse_processes_close(server):
+    with Hilltop('http://example.com/', 'data.hts', parse_processes=1) as ht:
+        data = ht.get_data('Site B', 'Flow')
+        pool = ht._parse_pool
+    assert data['Value'].tolist() == [1.5, 2.5, 3.5, 4.5]
+    assert ht._parse_pool is None
+    assert pool._shutdown_thread
+
+    ## The pool is also shut down when the object is garbage collected without close
+    ht = Hilltop('http://example.com/', 'data.hts', parse_processes=1)
+    ht.get_data('Site B', 'Flow')
+    pool = ht._parse_pool
+    del ht
+    gc.collect()
+    assert pool._shutdown_thread
+
+
+def test_aggregate_data(server):
+    ht = Hilltop('http://example.com/', 'data.hts')
+    data = ht.get_data('Site B', ['Flow', 'Rainfall'])
+
+    ## The Rainfall is Incremental in the cached measurement info, so the value at midnight is the total of the day before
+    res = ht.aggregate_data(data, 'Total', '1 day')
+    rain = res[res['MeasurementName'] == 'Rainfall']
+    assert rain['Time'].tolist() == [pd.Timestamp('2015-01-01'), pd.Timestamp('2015-01-02')]
+    assert rain['Value'].tolist() == [1.5, 10.5]
+
+    flow = res[res['MeasurementName'] == 'Flow']
+    assert flow['Value'].tolist() == [(2.0 + 3.0 + 4.0) * 6 * 3600]
+
+
+def test_aggregate_data_without_probe(server):
+    ht = Hilltop('http://example.com/', 'data.hts')
+
+    ## plan=True doesn't make MeasurementList requests, so the Interpolation comes from the GetData responses
+    data = ht.get_data('Site B', ['Flow', 'Rainfall'], plan=True)
+    res = ht.aggregate_data(data, 'Total', '1 day')
+    assert res.loc[res['MeasurementName'] == 'Rainfall', 'Value'].tolist() == [1.5, 10.5]
+    assert not [r for r in server.requests if r['Request'] == 'MeasurementList']
+
+    ## Data that this object didn't request gets a MeasurementList request, and series that still have no Interpolation warn
+    ht = Hilltop('http://example.com/', 'data.hts')
+    res = ht.time_weighted_stats(data)
+    assert res.loc[res['MeasurementName'] == 'Rainfall', 'Integral'].tolist() == [10.5]
+    assert [r['Site'] for r in server.requests if r['Request'] == 'MeasurementList'] == ['Site B', 'Site B']
+
+    with pytest.warns(UserWarning, match='Site Z'):
+        ht.aggregate_data(data.assign(SiteName='Site Z'), 'Total', '1 day')
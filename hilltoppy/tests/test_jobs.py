@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the extraction jobs that don't need a Hilltop server.
+"""
+import pytest
+import pandas as pd
+from hilltoppy import ExtractionJob
+from hilltoppy.jobs import run_job
+
+### Parameters
+
+
+class FlakyServer(object):
+    """
+    Returns a small series for every site and measurement, except that the down sites raise an error.
+    """
+    def __init__(self, down):
+        self.down = set(down)
+        self.calls = []
+
+
+    def _map(self, func, items):
+        return [func(i) for i in items]
+
+
+    def get_data(self, site, measurement, from_date=None, to_date=None, **kwargs):
+        self.calls.append((site, measurement))
+        if site in self.down:
+            raise ValueError('The server is down')
+        return pd.DataFrame({'SiteName': site, 'MeasurementName': measurement, 'Time': pd.date_range('2020-01-01', periods=3), 'Value': [1.0, 2.0, 3.0]})
+
+### Tests
+
+
+def test_extraction_job(tmp_path):
+    path = str(tmp_path / 'job')
+    job = ExtractionJob.create(path, ['A', 'B', 'C'], ['Flow', 'Stage'], from_date='2020-01-01')
+    assert len(job) == 6
+
+    server = FlakyServer(down=['B'])
+    status = job.run(server)
+    assert (status['Status'] == 'done').sum() == 4
+    failed = status[status['Status'] == 'failed']
+    assert failed['SiteName'].tolist() == ['B', 'B']
+    assert failed['Reason'].iloc[0] == 'ValueError: The server is down'
+
+    with pytest.raises(ValueError, match='already exists'):
+        ExtractionJob.create(path, ['A'], ['Flow'])
+
+    ## Resume with a new object as if the process had crashed
+    job = ExtractionJob(path)
+    assert job.outstanding(retry_failed=False) == []
+    server = FlakyServer(down=[])
+    status = job.run(server)
+    assert server.calls == [('B', 'Flow'), ('B', 'Stage')]
+    assert (status['Status'] == 'done').all()
+
+    data = job.read()
+    assert len(data) == 18
+    assert set(data['SiteName']) == {'A', 'B', 'C'}
+
+
+def test_extraction_job_kwargs(tmp_path):
+    path = str(tmp_path / 'job')
+
+    ## Anything that can't be saved to the manifest is rejected before the job is made
+    with pytest.raises(ValueError, match='JSON serializable'):
+        ExtractionJob.create(path, ['A'], ['Flow'], agg_interval=object())
+    assert not (tmp_path / 'job').exists()
+
+    ## The dtypes of a parameters schema are saved by name
+    server = FlakyServer(down=[])
+    job = run_job(server, path, ['A'], ['Flow'], parameters={'Lab': str, 'Depth': float})
+    assert ExtractionJob(path).get_data_kwargs['parameters'] == {'Lab': 'str', 'Depth': 'float64'}
+    assert (job.status['Status'] == 'done').all()
@@ -61,6 +61,12 @@ def test_available_sites():
     assert len(self.available_sites) > 1000
 
 
+def test_request_metrics():
+    metrics = self.metrics.to_dict()
+    assert metrics['requests'] > 0
+    assert metrics['bytes_decoded'] >= metrics['bytes_received'] > 0
+
+
 @pytest.mark.parametrize('data', [test_data1])
 def test_site_list(data):
     sites = self.get_site_list(True)
@@ -169,6 +175,43 @@ def test_get_data_quality_codes(data):
         assert col in tsdata.columns
 
 
+@pytest.mark.parametrize('data', [test_data1])
+def test_get_collection_data(data):
+    cl = self.get_collection_list()
+    pairs = cl[cl['CollectionName'] == data['collection']]
+    tsdata = self.get_collection_data(data['collection'], from_date='2018-01-01', to_date='2018-02-01')
+    for col in ['SiteName', 'MeasurementName', 'Time']:
+        assert col in tsdata.columns
+    assert set(tsdata['SiteName']).issubset(set(pairs['SiteName']))
+
+
+@pytest.mark.parametrize('data', [test_data1])
+def test_get_data_plan(data):
+    pairs, skipped = self.plan_data([data['site'], 'This Site Does Not Exist 12345'], data['measurement'])
+    assert pairs == [(data['site'], data['measurement'])]
+    assert len(skipped) == 1
+
+    tsdata = self.get_data([data['site'], 'This Site Does Not Exist 12345'], data['measurement'], from_date=data['from_date'], to_date=data['to_date'], plan=True)
+    assert len(tsdata) > 70
+    assert len(tsdata.attrs['skipped']) == 1
+
+
+@pytest.mark.parametrize('data', [test_data1])
+def test_get_data_parse_processes(data):
+    ht = Hilltop(base_url, hts, parse_processes=2)
+    tsdata = ht.get_data(data['site'], data['measurement'], from_date=data['from_date'], to_date=data['to_date'])
+    ht.close()
+    tsdata1 = self.get_data(data['site'], data['measurement'], from_date=data['from_date'], to_date=data['to_date'])
+    assert tsdata.reset_index(drop=True).equals(tsdata1.reset_index(drop=True))
+
+
+@pytest.mark.parametrize('data', [test_data1])
+def test_get_data_wml2(data):
+    tsdata = self.get_data(data['site'], data['measurement'], from_date=data['from_date'], to_date=data['to_date'], response_format='WML2')
+    tsdata1 = self.get_data(data['site'], data['measurement'], from_date=data['from_date'], to_date=data['to_date'])
+    assert tsdata.reset_index(drop=True).equals(tsdata1.reset_index(drop=True))
+
+
 def test_invalid_site_raises():
     with pytest.raises(ValueError, match='not in hts file'):
         self.get_site_info('This Site Does Not Exist 12345')
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the utils functions that don't need a Hilltop server.
+"""
+import pytest
+import numpy as np
+import pandas as pd
+import xml.etree.ElementTree as ET
+from hilltoppy import utils
+from hilltoppy.utils import get_hilltop_xml, parse_gauging_values, convert_mowsecs, parse_wq_values, parse_data_elements, validate_records, Measurement, greedy_set_cover, parse_data_source_info, parse_dsn, resolve_dsn, SiteIndex, NameIndex, normalize_name, proc_ht_use_data, convert_site_names, convert_detection_limits
+from hilltoppy.tests.fakes import FakeResponse
+
+### Parameters
+
+gauging_data1 = dict(
+    texts = ['2000000000 1234 56 -1', '2000000600 1500 60.5 2', '2000001200 -5 1 3'],
+    item_num = 1,
+    divisor = 1000,
+    )
+
+wq_data1 = dict(
+    texts = ['<0.005', '0.0123', '>2400', None, '0.5'],
+    precision = 2,
+    )
+
+wq_xml1 = '''<Data>
+<E><T>2015-01-01T10:00:00</T><Value>&lt;0.005</Value><Parameter Name="Lab" Value="L0"/><Parameter Name="Depth" Value="0.5"/></E>
+<E><T>2015-01-02T10:00:00</T><Value>0.012</Value><Parameter Name="Depth" Value="1.5"/></E>
+<E><T>2015-01-03T10:00:00</T><Value>0.02</Value></E>
+</Data>'''
+
+get_data_xml1 = '''<Measurement SiteName="Site A">
+<DataSource Name="Gauging Results" NumItems="2">
+<TSType>StdSeries</TSType><DataType>GaugingResults</DataType><Interpolation>Discrete</Interpolation>
+<ItemInfo ItemNumber="1"><ItemName>Stage</ItemName><Units>mm</Units><Format>#</Format></ItemInfo>
+<ItemInfo ItemNumber="2"><ItemName>Flow</ItemName><Units>l/s</Units><Format>#.###</Format><Divisor>1000</Divisor></ItemInfo>
+</DataSource>
+<Data DateFormat="mowsecs" NumItems="2"></Data>
+</Measurement>'''
+
+hyd_section_xml1 = b'''<Hilltop><Measurement SiteName="Site A">
+<DataSource Name="Section" NumItems="1"><TSType>StdSeries</TSType><DataType>HydSection</DataType><Interpolation>Discrete</Interpolation>
+<ItemInfo ItemNumber="1"><ItemName>Section</ItemName><Units>m</Units><Format>#.##</Format></ItemInfo></DataSource>
+<Data DateFormat="Calendar" NumItems="1"><E><T>2015-01-01T10:00:00</T><I1>1.5</I1></E></Data></Measurement></Hilltop>'''
+
+
+class FakeGet(object):
+    """
+    Stands in for requests.get and returns the bodies in turn.
+    """
+    def __init__(self, *bodies):
+        self.bodies = list(bodies)
+        self.calls = 0
+
+
+    def __call__(self, url, **kwargs):
+        self.calls += 1
+        return FakeResponse(self.bodies.pop(0))
+
+### Tests
+
+
+@pytest.mark.parametrize('data', [gauging_data1])
+def test_parse_gauging_values(data):
+    out1 = parse_gauging_values(data['texts'], data['item_num'], data['divisor'])
+    assert len(out1) == 2
+    assert np.issubdtype(out1['Time'].dtype, np.datetime64)
+    assert out1['Time'].iloc[0] == convert_mowsecs(2000000000)
+    assert np.allclose(out1['Value'], [1.234, 1.5])
+
+    out2 = parse_gauging_values(data['texts'], 3)
+    assert out2['Value'].tolist() == [2, 3]
+
+
+def test_parse_gauging_values_empty():
+    out1 = parse_gauging_values([], 1)
+    assert out1.empty
+    assert list(out1.columns) == ['Time', 'Value']
+
+
+@pytest.mark.parametrize('data', [wq_data1])
+def test_parse_wq_values(data):
+    values, censor_code = parse_wq_values(data['texts'], True, data['precision'])
+    assert censor_code.tolist() == ['less_than', 'not_censored', 'greater_than', 'not_censored', 'not_censored']
+    assert values.iloc[0] == 0.005
+    assert values.iloc[1] == 0.01
+    assert values.iloc[2] == 2400
+    assert np.isnan(values.iloc[3])
+
+
+def test_parse_wq_values_not_censored():
+    values, censor_code = parse_wq_values(['1', '2', 'N/A'])
+    assert censor_code is None
+    assert values.tolist() == [1, 2, 'N/A']
+
+    ## The precision is still applied to the numeric values when some are text
+    values, censor_code = parse_wq_values(['1.234', 'N/A', '2.345', '<0.125'], True, 1)
+    assert values.tolist() == [1.2, 'N/A', 2.3, 0.125]
+
+
+@pytest.mark.parametrize('xml', [wq_xml1])
+def test_parse_data_elements_parameters(xml):
+    elements = ET.fromstring(xml).findall('E')
+
+    wide = parse_data_elements(elements, 'WQData', 1)
+    assert list(wide.columns) == ['Time', 'Value', 'CensorCode', 'Lab', 'Depth']
+    assert wide['Depth'].dtype == 'float64'
+
+    schema = parse_data_elements(elements, 'WQData', 1, parameters={'Depth': 'float32'})
+    assert list(schema.columns) == ['Time', 'Value', 'CensorCode', 'Depth']
+    assert schema['Depth'].dtype == 'float32'
+
+    data, params = parse_data_elements(elements, 'WQData', 1, parameters='long')
+    assert 'Lab' not in data
+    assert len(params) == 3
+    assert params['ParameterName'].tolist() == ['Lab', 'Depth', 'Depth']
+
+    none = parse_data_elements(elements, 'WQData', 1, parameters=None)
+    assert list(none.columns) == ['Time', 'Value', 'CensorCode']
+
+    ## Samples without any Parameter elements
+    data, params = parse_data_elements(elements[2:], 'WQData', 1, parameters='long')
+    assert len(data) == 1
+    assert params.empty
+    assert list(params.columns) == ['Time', 'ParameterName', 'ParameterValue']
+
+
+def test_validate_records():
+    records = [{'MeasurementName': 'Flow', 'Precision': 3, 'Format': '#.###'}, {'MeasurementName': 'Stage', 'Precision': 'high'}, {'MeasurementName': 'Rain', 'Precision': 1, 'Item': 2}]
+
+    out1, invalid = validate_records(records, Measurement)
+    assert list(invalid) == [1]
+    assert out1[1] is None
+    assert out1[0] == {'MeasurementName': 'Flow', 'Precision': 3}
+    assert out1[2]['Item'] == 2
+
+    out2, invalid = validate_records(records, Measurement, 'trusted')
+    assert not invalid
+    assert out2[1] == {'MeasurementName': 'Stage', 'Precision': 'high'}
+
+
+def test_greedy_set_cover():
+    sets = {'a': {1, 2}, 'b': {2, 3, 4}, 'c': {4}, 'd': {1, 5}}
+    selected = greedy_set_cover(sets)
+    assert selected == ['b', 'd']
+    assert greedy_set_cover({}) == []
+
+
+@pytest.mark.parametrize('xml', [get_data_xml1])
+def test_parse_data_source_info(xml):
+    info = parse_data_source_info(ET.fromstring(xml), 'Flow [Gauging Results]')
+    assert info['DataType'] == 'GaugingResults'
+    assert info['DataSourceName'] == 'Gauging Results'
+    assert info['Item'] == 2
+    assert info['Precision'] == 3
+    assert info['Divisor'] == 1000
+
+    ## Don't guess the item of a multi-item data source
+    info = parse_data_source_info(ET.fromstring(xml), 'Velocity [Gauging Results]')
+    assert 'Item' not in info
+    assert 'Precision' not in info
+
+
+def test_resolve_dsn(tmp_path):
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'top.dsn').write_text('[Hilltop]\nFile1=a.hts\nFile2=sub/b.dsn\nFile3=sub/c.dsn\n')
+    (tmp_path / 'sub' / 'b.dsn').write_text('[Hilltop]\nFile1=b.hts\nFile2=c.dsn\n')
+    (tmp_path / 'sub' / 'c.dsn').write_text('[Hilltop]\nFile1=c.hts\n')
+
+    tree = resolve_dsn(str(tmp_path / 'top.dsn'))
+    assert [p.rsplit('/', 1)[-1] for p in tree] == ['a.hts', 'b.hts', 'c.hts']
+    assert len(tree.dsn_files) == 3
+    assert parse_dsn(str(tmp_path / 'top.dsn')) == tree.hts_files
+
+    (tmp_path / 'sub' / 'c.dsn').write_text('[Hilltop]\nFile1=c.hts\nFile2=../top.dsn\n')
+    with pytest.raises(ValueError, match='cycle'):
+        resolve_dsn(str(tmp_path / 'sub' / 'b.dsn'))
+
+
+def test_site_index():
+    rng = np.random.default_rng(1)
+    sites = pd.DataFrame({'SiteName': ['site' + str(i) for i in range(500)], 'Easting': rng.uniform(1.1e6, 2.1e6, 500), 'Northing': rng.uniform(4.7e6, 6.2e6, 500)})
+    sites.loc[3, 'Easting'] = np.nan
+    index = SiteIndex(sites)
+    assert len(index) == 499
+
+    xy = index.sites[['Easting', 'Northing']].to_numpy()
+    points = rng.uniform([1e6, 4.6e6], [2.2e6, 6.3e6], (50, 2))
+    idx, dist = index.nearest(points, 5)
+    for p, i, d in zip(points, idx, dist):
+        brute = np.hypot(*(xy - p).T)
+        assert np.allclose(np.sort(brute)[:5], d)
+        assert np.allclose(brute[i], d)
+
+    bbox = (1.3e6, 5e6, 1.6e6, 5.5e6)
+    inside = index.within(bbox)
+    mask = (xy[:, 0] >= bbox[0]) & (xy[:, 0] <= bbox[2]) & (xy[:, 1] >= bbox[1]) & (xy[:, 1] <= bbox[3])
+    assert inside.tolist() == np.flatnonzero(mask).tolist()
+
+
+def test_site_index_degenerate():
+    ## A single site and a point 1 km away
+    index = SiteIndex(pd.DataFrame({'SiteName': ['site0'], 'Easting': [1500000.0], 'Northing': [5200000.0]}))
+    idx, dist = index.nearest([1501000.0, 5200000.0], 3)
+    assert idx.tolist() == [[0]]
+    assert dist.tolist() == [[1000.0]]
+
+    ## Sites on one line (e.g. along a river) and points off the line
+    sites = pd.DataFrame({'SiteName': ['site' + str(i) for i in range(200)], 'Easting': np.linspace(1.5e6, 1.6e6, 200), 'Northing': 5200000.0})
+    index = SiteIndex(sites)
+    assert index._shape.prod() <= 200
+
+    xy = index.sites[['Easting', 'Northing']].to_numpy()
+    points = [[1.55e6, 5.2e6], [1.55e6, 5.21e6], [1.4e6, 5.3e6], [1.7e6, 5.2e6]]
+    idx, dist = index.nearest(points, 3)
+    for p, i, d in zip(points, idx, dist):
+        brute = np.hypot(*(xy - p).T)
+        assert np.allclose(np.sort(brute)[:3], d)
+        assert np.allclose(brute[i], d)
+
+
+def test_name_index():
+    assert normalize_name(' Elevation Above Sea Level[Recorder  Water Level] ') == 'elevation above sea level [recorder water level]'
+
+    records = [{'MeasurementName': 'Flow', 'DataSourceName': 'Flow', 'Item': 1}, {'MeasurementName': 'Stage [Gauging Results]', 'DataSourceName': 'Gauging Results', 'Item': 1}, {'MeasurementName': 'Flow [Gauging Results]', 'DataSourceName': 'Gauging Results', 'Item': 2}, {'MeasurementName': 'Nitrate [Lab A]', 'DataSourceName': 'Lab A'}, {'MeasurementName': 'Nitrate [Lab B]', 'DataSourceName': 'Lab B'}]
+    index = NameIndex(records)
+
+    assert index.get('FLOW')['Item'] == 1
+    assert index.get('Flow [Flow]')['MeasurementName'] == 'Flow'
+    assert index.get('flow[gauging results]')['Item'] == 2
+    assert index.get('stage')['MeasurementName'] == 'Stage [Gauging Results]'
+    assert 'Nitrate' not in index
+    assert index.prefix('nit') == ['Nitrate [Lab A]', 'Nitrate [Lab B]']
+    assert index.fuzzy('Flowe') == ['Flow']
+
+
+def test_proc_ht_use_data():
+    times = pd.date_range('2020-01-01', periods=4, freq='D')
+    index = pd.MultiIndex.from_tuples([(m, s, t) for m, s in [('Water Meter', 'l36/0001'), ('Average Flow', 'k37/0002'), ('Water Meter', 'k37/0003'), ('Rainfall', 'k37/0004')] for t in times], names=['Measurement', 'Site', 'DateTime'])
+    ht_data = pd.Series([10, 15, 15, 20, 1, -1, 2, 3, 5, 1, 6, 2, 1, 1, 1, 1], index=index, name='Value', dtype='float64')
+
+    out1 = proc_ht_use_data(ht_data)
+    assert out1.index.names == ['Site', 'DateTime']
+    assert set(out1.index.get_level_values('Site')) == {'L36/0001', 'K37/0002', 'K37/0003'}
+    ## Cumulative meter
+    assert out1.loc['L36/0001'].dropna().tolist() == [5, 0, 5]
+    ## Negative flows are dropped and the rest converted to volume
+    assert out1.loc['K37/0002'].dropna().tolist() == [24, 48, 72]
+    ## Period volume meter (more than 10% negative diffs)
+    assert out1.loc['K37/0003'].tolist() == [5, 1, 6, 2]
+
+
+def test_convert_site_names():
+    names = pd.Series(['l36:0001', 'K37.1234-M1', 'BENNETT K38/0190 - M2', 'A1/2 B3/4', 'foo', None])
+
+    out1 = convert_site_names(names)
+    assert out1.iloc[:3].tolist() == ['L36/0001', 'K37/1234', 'K38/0190']
+    assert out1.iloc[3:].isnull().all()
+
+    out2 = convert_site_names(names, rem_m=False)
+    assert out2.iloc[1:3].tolist() == ['K37/1234-M1', 'K38/0190 - M2']
+    assert out2.iloc[[0, 3, 4, 5]].isnull().all()
+
+
+def test_convert_site_names_cache_overflow(monkeypatch):
+    monkeypatch.setattr(utils, '_site_name_cache', {True: {}, False: {}})
+    monkeypatch.setattr(utils, '_site_name_cache_size', 3)
+
+    convert_site_names(pd.Series(['K38/0190-M1', 'L36/0001-M1']), rem_m=False)
+
+    ## The overflow must not drop the names of this call that were already cached
+    out1 = convert_site_names(pd.Series(['K38/0190-M1', 'K37/1234-M1', 'L35/0002-M1']), rem_m=False)
+    assert out1.tolist() == ['K38/0190-M1', 'K37/1234-M1', 'L35/0002-M1']
+    assert len(utils._site_name_cache[False]) <= 3
+
+
+def test_convert_detection_limits():
+    data = pd.DataFrame({'MeasurementName': ['TP'] * 5 + ['TN'] * 2, 'Value': [0.01, 0.02, 0.5, 0.01, 0.3, 0.1, 0.2], 'CensorCode': pd.Categorical(['less_than', 'less_than', 'not_censored', 'less_than', 'not_censored', 'not_censored', 'not_censored'], categories=['less_than', 'greater_than', 'not_censored'])})
+
+    out1 = convert_detection_limits(data)
+    assert np.allclose(out1['Value'], [0.005, 0.01, 0.5, 0.005, 0.3, 0.1, 0.2])
+
+    out2 = convert_detection_limits(data, 'trend')
+    assert out2['Value'].equals(data['Value'])
+    assert out2['dtl_ratio'].iloc[0] == 0.6
+    assert out2['dtl_ratio'].iloc[5:].isnull().all()
+    assert np.allclose(out2['Value_dtl'], [0.01, 0.01, 0.5, 0.01, 0.3, 0.1, 0.2])
+
+    text_data = pd.DataFrame({'mtype': ['TP', 'TP', 'TP'], 'data': pd.Series(['<0.01', 0.5, '<0.02'], dtype=object)})
+    out3 = convert_detection_limits(text_data, value_col='data', censor_col=None, group_cols='mtype')
+    assert out3['data'].tolist() == [0.005, 0.5, 0.01]
+
+    ## Numeric values without a CensorCode column are returned as is
+    flow = pd.DataFrame({'MeasurementName': 'Flow', 'Value': [1.5, 2.5]})
+    assert convert_detection_limits(flow) is flow
+
+
+def test_get_hilltop_xml_retries(monkeypatch):
+    from hilltoppy.mountain_top import _GetDataParser
+    monkeypatch.setattr(utils, 'sleep', lambda c: None)
+
+    ## Errors of the parser aren't retried
+    get = FakeGet(hyd_section_xml1)
+    monkeypatch.setattr(utils.requests, 'get', get)
+    with pytest.raises(NotImplementedError):
+        get_hilltop_xml('http://example.com/data.hts?Request=GetData', parser=lambda: _GetDataParser('Site A', 'Section'))
+    assert get.calls == 1
+
+    ## Truncated responses are
+    get = FakeGet(b'<HilltopServer><Site Name="A"', b'<HilltopServer><Site Name="A"/></HilltopServer>')
+    monkeypatch.setattr(utils.requests, 'get', get)
+    tree = get_hilltop_xml('http://example.com/data.hts?Request=SiteList')
+    assert get.calls == 2
+    assert tree.find('Site').attrib['Name'] == 'A'
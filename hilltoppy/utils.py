@@ -11,18 +11,31 @@ try:
 except ImportError:
     from ConfigParser import SafeConfigParser as ConfigParser
 from typing import List, Optional, Union
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
 from enum import Enum
 import requests
+import urllib3
 import xml.etree.ElementTree as ET
 from time import sleep
 import urllib.parse
+import threading
+import zlib
+import io
+import re
+import bisect
+import difflib
 
 ##############################################
 ### Parameters
 
 available_requests = ['SiteList', 'MeasurementList', 'CollectionList', 'GetData', 'SiteInfo']
 
+chunk_size = 2**16
+
+_bracket_open = re.compile(r'\s*\[\s*')
+_bracket_close = re.compile(r'\s*\]')
+_ambiguous = object()
+
 
 ##############################################
 ### Data models
@@ -107,6 +120,68 @@ class DataSource(BaseModel):
 ### Functions
 
 
+_adapters = {}
+
+
+def validate_records(records: List[dict], model, validation: str = 'batch'):
+    """
+    Function to validate a list of dicts against a pydantic model in a single batch rather than instantiating the model for every record.
+
+    Parameters
+    ----------
+    records : list of dict
+        The records to validate.
+    model : pydantic.BaseModel
+        The model class to validate against.
+    validation : str
+        Either 'batch' to validate all of the records with a TypeAdapter over a list, or 'trusted' to skip the validation and only keep the fields of the model.
+
+    Returns
+    -------
+    tuple of list and dict
+        The list of validated records dumped to json mode dicts without the None values (None for the records that failed validation), and a dict of {record index: error message} for the failed records.
+    """
+    if validation == 'trusted':
+        fields = model.model_fields
+        out_list = [{k: v for k, v in r.items() if (k in fields) and (v is not None)} for r in records]
+
+        return out_list, {}
+
+    elif validation != 'batch':
+        raise ValueError("validation must be either 'batch' or 'trusted'.")
+
+    if model not in _adapters:
+        _adapters[model] = TypeAdapter(List[model])
+    adapter = _adapters[model]
+
+    invalid = {}
+    index = list(range(len(records)))
+
+    while index:
+        try:
+            models = adapter.validate_python([records[i] for i in index])
+            break
+        except ValidationError as err:
+            bad = set()
+            for e in err.errors():
+                i = index[e['loc'][0]]
+                bad.add(i)
+                msg = ' '.join(str(l) for l in e['loc'][1:]) + ': ' + e['msg']
+                if i in invalid:
+                    invalid[i] = invalid[i] + '; ' + msg
+                else:
+                    invalid[i] = msg
+            index = [i for i in index if i not in bad]
+    else:
+        models = []
+
+    out_list = [None] * len(records)
+    for i, m in zip(index, adapter.dump_python(models, mode='json', exclude_none=True)):
+        out_list[i] = m
+
+    return out_list, invalid
+
+
 def build_url(base_url: str, hts: str, request: str, site: str = None, measurement: str = None, collection: str = None, from_date: str = None, to_date: str = None, location: Union[str, bool] = None, site_parameters: List[str] = None, agg_method: str = None, agg_interval: str = None, alignment: str = None, quality_codes: bool = False, tstype: str = None, response_format: str = None, units: bool = None):
     """
     Function to generate the Hilltop url for the web service.
@@ -218,15 +293,176 @@ def build_url(base_url: str, hts: str, request: str, site: str = None, measureme
     return base_url + hts + '?' + encoded_data
 
 
-def get_hilltop_xml(url, timeout=60, **kwargs):
+class RequestMetrics(object):
+    """
+    Running totals of the http traffic between the client and a Hilltop server. The bytes_received are the bytes that came over the wire (compressed if the server compressed the response) and bytes_decoded are the bytes of xml after decompression.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        """
+        Set all of the counters back to zero.
+        """
+        with self._lock:
+            self.requests = 0
+            self.compressed_requests = 0
+            self.bytes_received = 0
+            self.bytes_decoded = 0
+
+
+    def add(self, bytes_received: int, bytes_decoded: int, content_encoding: str = None):
+        """
+        Add a single response to the totals.
+        """
+        with self._lock:
+            self.requests += 1
+            if content_encoding:
+                self.compressed_requests += 1
+            self.bytes_received += bytes_received
+            self.bytes_decoded += bytes_decoded
+
+
+    @classmethod
+    def combine(cls, metrics_list):
+        """
+        Make a new RequestMetrics with the totals of several RequestMetrics (e.g. of the hts files of a HilltopGroup).
+        """
+        out = cls()
+        for m in metrics_list:
+            d = m.to_dict()
+            out.requests += d['requests']
+            out.compressed_requests += d['compressed_requests']
+            out.bytes_received += d['bytes_received']
+            out.bytes_decoded += d['bytes_decoded']
+
+        return out
+
+
+    @property
+    def compression_ratio(self):
+        """
+        The ratio of decoded bytes to received bytes. None if nothing has been received yet.
+        """
+        if self.bytes_received == 0:
+            return None
+
+        return self.bytes_decoded / self.bytes_received
+
+
+    def to_dict(self):
+        """
+        Return the counters as a dict.
+        """
+        with self._lock:
+            return {'requests': self.requests, 'compressed_requests': self.compressed_requests, 'bytes_received': self.bytes_received, 'bytes_decoded': self.bytes_decoded, 'compression_ratio': self.compression_ratio}
+
+
+    def __repr__(self):
+        return 'RequestMetrics(' + ', '.join(k + '=' + str(v) for k, v in self.to_dict().items()) + ')'
+
+
+class _Decoder(object):
     """
+    Incremental decoder for the Content-Encoding of a response body.
+    """
+    def __init__(self, content_encoding):
+        self.content_encoding = content_encoding
+        if content_encoding in ('gzip', 'x-gzip'):
+            self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif content_encoding == 'deflate':
+            self._obj = zlib.decompressobj()
+        else:
+            self._obj = None
+        self._first = True
+
+
+    def decompress(self, chunk):
+        if self._obj is None:
+            return chunk
+        if self._first:
+            self._first = False
+            ## Some servers send raw deflate streams without the zlib header
+            try:
+                return self._obj.decompress(chunk)
+            except zlib.error:
+                if self.content_encoding != 'deflate':
+                    raise
+                self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._obj.decompress(chunk)
+
+
+    def flush(self):
+        if self._obj is None:
+            return b''
+        return self._obj.flush()
+
+
+def _stream_response(req, feed, metrics=None):
+    """
+    Stream the body of a requests response through the decoder and into the feed function (e.g. the feed of an xml parser).
+    """
+    content_encoding = req.headers.get('Content-Encoding', '').strip().lower()
+    if content_encoding == 'identity':
+        content_encoding = ''
+    decoder = _Decoder(content_encoding)
+
+    bytes_received = 0
+    bytes_decoded = 0
+    for chunk in req.raw.stream(chunk_size, decode_content=False):
+        bytes_received += len(chunk)
+        data = decoder.decompress(chunk)
+        bytes_decoded += len(data)
+        feed(data)
+
+    data = decoder.flush()
+    bytes_decoded += len(data)
+    feed(data)
+
+    if metrics is not None:
+        metrics.add(bytes_received, bytes_decoded, content_encoding)
+
+
+def _parse_response(req, metrics=None, parser=ET.XMLParser):
+    """
+    Stream the body of a requests response into a new parser from the parser function. Returns the output of the parser's close method (the root Element for the default xml parser).
+    """
+    parser1 = parser()
+    _stream_response(req, parser1.feed, metrics)
+
+    return parser1.close()
+
 
+def _read_response(req, metrics=None):
     """
+    Stream the decoded body of a requests response into a bytearray.
+    """
+    content = bytearray()
+    _stream_response(req, content.extend, metrics)
+
+    return content
+
+
+_retry_errors = (requests.RequestException, urllib3.exceptions.HTTPError, zlib.error, ET.ParseError)
+
+
+def _request(url, read, timeout=60, compression=True, metrics=None, **kwargs):
+    """
+    Request a Hilltop url with retries and read the response with the read function.
+    """
+    headers = dict(kwargs.pop('headers', None) or {})
+    if compression:
+        headers['Accept-Encoding'] = 'gzip, deflate'
+    else:
+        headers['Accept-Encoding'] = 'identity'
+
     counter = [10, 20, 30, None]
     for c in counter:
         try:
-            with requests.get(url, timeout=timeout, **kwargs) as req:
-                tree1 = ET.fromstring(req.content)
+            with requests.get(url, timeout=timeout, headers=headers, stream=True, **kwargs) as req:
+                output = read(req, metrics)
             break
         # except ET.ParseError:
         #     raise ET.ParseError('Could not parse xml. Check to make sure the URL is correct.')
@@ -243,7 +479,8 @@ def get_hilltop_xml(url, timeout=60, **kwargs):
         # except requests.exceptions.ConnectionError:
         #     raise requests.exceptions.ConnectionError('Could not read the URL. Check to make sure the URL is correct.')
 
-        except Exception as err:
+        ## Only retry the transport errors and truncated responses. Errors of the parsers are raised as is.
+        except _retry_errors as err:
             print(str(err))
 
             if c is None:
@@ -252,7 +489,61 @@ def get_hilltop_xml(url, timeout=60, **kwargs):
             print('Trying again in ' + str(c) + ' seconds.')
             sleep(c)
 
-    return tree1
+    return output
+
+
+def get_hilltop_xml(url, timeout=60, compression=True, metrics=None, parser=None, **kwargs):
+    """
+    Function to request a Hilltop url and parse the response as xml. The response body is decompressed and parsed as it streams in, so the full body is never held in memory.
+
+    Parameters
+    ----------
+    url : str
+        The Hilltop url.
+    timeout : int
+        The http request timeout in seconds.
+    compression : bool
+        Should gzip/deflate compression of the response be requested from the server? Set to False for servers that send broken compressed responses.
+    metrics : RequestMetrics or None
+        If a RequestMetrics object is passed, the compressed and uncompressed byte counts of the response are added to it.
+    parser : callable or None
+        A function that returns a new parser with feed and close methods (like xml.etree.ElementTree.XMLParser) for parsing the response as it streams in. A new parser is made for every try. None uses the xml.etree.ElementTree.XMLParser.
+    **kwargs
+        Optional keyword arguments passed to requests.
+
+    Returns
+    -------
+    xml.etree.ElementTree.Element
+        Or the output of the close method of the parser.
+    """
+    if parser is None:
+        parser = ET.XMLParser
+
+    return _request(url, lambda req, metrics: _parse_response(req, metrics, parser), timeout=timeout, compression=compression, metrics=metrics, **kwargs)
+
+
+def get_hilltop_bytes(url, timeout=60, compression=True, metrics=None, **kwargs):
+    """
+    Function to request a Hilltop url and return the decompressed response body without parsing it (e.g. to parse it in another process).
+
+    Parameters
+    ----------
+    url : str
+        The Hilltop url.
+    timeout : int
+        The http request timeout in seconds.
+    compression : bool
+        Should gzip/deflate compression of the response be requested from the server?
+    metrics : RequestMetrics or None
+        If a RequestMetrics object is passed, the compressed and uncompressed byte counts of the response are added to it.
+    **kwargs
+        Optional keyword arguments passed to requests.
+
+    Returns
+    -------
+    bytearray
+    """
+    return _request(url, _read_response, timeout=timeout, compression=compression, metrics=metrics, **kwargs)
 
 
 def convert_mowsecs(mowsecs: int):
@@ -264,6 +555,43 @@ def convert_mowsecs(mowsecs: int):
     return time
 
 
+def parse_gauging_values(texts: List[str], item_num: int, divisor: Union[int, float] = None):
+    """
+    Function to parse the V element texts of a GaugingResults (Native format) GetData response. All of the texts are parsed together as a single whitespace delimited table rather than row by row.
+
+    Parameters
+    ----------
+    texts : list of str
+        The texts of the V elements. Each text is the mowsecs followed by the item values.
+    item_num : int
+        The item number (column position after the mowsecs) of the measurement.
+    divisor : int, float, or None
+        Divide the values by the divisor to get the appropriate Units.
+
+    Returns
+    -------
+    DataFrame
+        With Time and Value columns. Rows with negative values are removed.
+    """
+    if not texts:
+        return pd.DataFrame(columns=['Time', 'Value'])
+
+    text = '\n'.join(texts).encode('ascii', 'ignore').decode()
+    table = pd.read_csv(io.StringIO(text), sep=r'\s+', header=None, usecols=[0, item_num])
+
+    mowsecs = table[0].to_numpy('int64')
+    values = table[item_num].to_numpy()
+
+    mask = values >= 0
+    values = values[mask]
+    if divisor is not None:
+        values = values / divisor
+
+    output1 = pd.DataFrame({'Time': pd.to_datetime(mowsecs[mask] - 946771200, unit='s'), 'Value': values})
+
+    return output1
+
+
 def convert_value(text):
     """
 
@@ -292,6 +620,752 @@ def convert_value(text):
     return val
 
 
+def parse_wq_values(texts: List[str], apply_precision: bool = False, precision: int = None):
+    """
+    Function to convert the Value texts of a WQData GetData response. The censored values (with a < or > prefix) are split out and the precision is applied on the whole column at once.
+
+    Parameters
+    ----------
+    texts : list of str
+        The texts of the Value elements. None for missing values.
+    apply_precision : bool
+        Should the precision be applied to the non-censored values?
+    precision : int or None
+        The precision as the number of decimal places.
+
+    Returns
+    -------
+    tuple of Series and Categorical
+        The values and the CensorCode. The CensorCode is None if none of the values are censored.
+    """
+    raw = pd.Series(texts, dtype=object).str.encode('ascii', 'ignore').str.decode('ascii')
+
+    less = raw.str.contains('<', regex=False).fillna(False).astype(bool)
+    greater = raw.str.contains('>', regex=False).fillna(False).astype(bool) & ~less
+    censored = less | greater
+
+    stripped = raw.where(~censored, raw.str.slice(1))
+    stripped = stripped.where(stripped != '-0')
+
+    values = pd.to_numeric(stripped, errors='coerce')
+
+    if apply_precision and (precision is not None):
+        values = values.where(censored, values.round(precision))
+
+    ## Keep any non-numeric text as is
+    non_numeric = values.isnull() & stripped.notnull()
+    if non_numeric.any():
+        values = values.astype(object)
+        values[non_numeric] = stripped[non_numeric]
+    elif apply_precision and (precision == 0) and values.notnull().all() and (values == values.round()).all():
+        values = values.astype('int64')
+
+    if censored.any():
+        censor_code = pd.Categorical(np.select([less, greater], ['less_than', 'greater_than'], 'not_censored'), categories=['less_than', 'greater_than', 'not_censored'])
+    else:
+        censor_code = None
+
+    return values, censor_code
+
+
+def convert_detection_limits(data: pd.DataFrame, dtl_method: str = 'standard', value_col: str = 'Value', censor_col: str = 'CensorCode', group_cols: Union[str, List[str]] = 'MeasurementName'):
+    """
+    Function to convert the values under the detection limit to numeric values. It works on any WQ data with either a CensorCode column (like the output of Hilltop.get_data) or values with a < prefix (like the output of com.get_data_quality). All of the group stats are calculated in a single grouped pass.
+
+    Parameters
+    ----------
+    data : DataFrame
+        The WQ data.
+    dtl_method : 'standard' or 'trend'
+        'standard' takes half of the detection limit. 'trend' is meant as an output for trend analysis and leaves the value_col as is, but adds a dtl_ratio column of the ratio of values under the detection limit per group and a value_col + '_dtl' column of the converted values. In the groups with more than 40% of the values under the detection limit (and more than one detection limit), the values under the detection limit are all replaced with the max of the halved detection limits.
+    value_col : str
+        The column of the values.
+    censor_col : str or None
+        The column of the censor codes. If it isn't in the data, the values with a < prefix are taken as under the detection limit.
+    group_cols : str or list of str
+        The column(s) to group the data by for the trend stats.
+
+    Returns
+    -------
+    DataFrame
+        A copy of the data. If there are no values under the detection limit the data is returned as is.
+    """
+    values = data[value_col]
+
+    if (censor_col is not None) and (censor_col in data):
+        less = (data[censor_col] == 'less_than').to_numpy()
+        dtl = pd.to_numeric(values.where(less), errors='coerce') * 0.5
+    elif pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+        less = values.str.startswith('<').fillna(False).astype(bool).to_numpy()
+        dtl = pd.to_numeric(values.where(less).str.replace('<', '', regex=False), errors='coerce') * 0.5
+    else:
+        ## Numeric values without censor codes can't be under the detection limit
+        return data
+
+    if not less.any():
+        return data
+
+    data3 = data.copy()
+    converted = values.mask(less, dtl)
+
+    if dtl_method == 'standard':
+        data3[value_col] = converted
+        return data3
+    elif dtl_method != 'trend':
+        raise ValueError("dtl_method must be either 'standard' or 'trend'.")
+
+    ## Group stats in one pass
+    codes = data.groupby(group_cols, sort=False, dropna=False).ngroup().to_numpy()
+    stats = pd.DataFrame({'tot_count': values.notnull().to_numpy(), 'less_count': less, 'dtl': dtl.to_numpy()}).groupby(codes).agg(tot_count=('tot_count', 'sum'), less_count=('less_count', 'sum'), dtl_count=('dtl', 'count'), dtl_val_count=('dtl', 'nunique'), dtl_max=('dtl', 'max'))
+
+    dtl_ratio = (stats['dtl_count'] / stats['tot_count']).round(2).where(stats['less_count'] > 0)
+    over_40 = ((dtl_ratio > 0.4) & (stats['dtl_val_count'] != 1)).to_numpy()[codes]
+
+    data3['dtl_ratio'] = dtl_ratio.to_numpy()[codes]
+    data3[value_col + '_dtl'] = converted.mask(over_40 & less, stats['dtl_max'].to_numpy()[codes])
+
+    return data3
+
+
+def convert_values(texts):
+    """
+    Function to convert a whole column of texts to a single type. It's the column version of convert_value. The column becomes numeric if all of the values are numbers, bool if all are True/False, datetime if all are dates, otherwise the texts are returned.
+
+    Parameters
+    ----------
+    texts : list of str or Series
+        The texts to convert. None is treated as missing.
+
+    Returns
+    -------
+    Series
+    """
+    vals = pd.Series(texts, dtype=object).str.encode('ascii', 'ignore').str.decode('ascii')
+    vals = vals.where(vals != '-0')
+    n_vals = vals.notnull().sum()
+
+    if n_vals == 0:
+        return vals
+
+    num = pd.to_numeric(vals, errors='coerce')
+    if num.notnull().sum() == n_vals:
+        return num
+
+    non_null = vals.dropna()
+    if non_null.isin(['True', 'False']).all():
+        return vals.map({'True': True, 'False': False})
+
+    dt = pd.to_datetime(vals, errors='coerce', format='mixed')
+    if dt.notnull().sum() == n_vals:
+        return dt
+
+    return vals
+
+
+def parameters_to_frame(rows, names, texts, n_rows, parameters='wide'):
+    """
+    Function to convert the flat lists of the Parameter elements of a GetData response into wide columns.
+
+    Parameters
+    ----------
+    rows : list of int
+        The row (sample) index of each Parameter.
+    names : list of str
+        The Name attribute of each Parameter.
+    texts : list of str
+        The Value attribute of each Parameter.
+    n_rows : int
+        The number of rows (samples) in the data.
+    parameters : str or dict
+        'wide' returns all of the Parameters as columns with the type determined by convert_values. A dict of {parameter name: dtype} only returns the declared Parameters with the declared dtypes.
+
+    Returns
+    -------
+    DataFrame
+        Indexed by the row number.
+    """
+    tidy = pd.DataFrame({'row': rows, 'name': names, 'value': texts}).drop_duplicates(['row', 'name'], keep='last')
+
+    if isinstance(parameters, dict):
+        tidy = tidy[tidy['name'].isin(list(parameters))]
+        col_names = [n for n in parameters if n in set(tidy['name'])]
+    else:
+        col_names = tidy['name'].unique().tolist()
+
+    wide = tidy.pivot(index='row', columns='name', values='value').reindex(index=range(n_rows), columns=col_names)
+    wide.columns.name = None
+
+    for col in col_names:
+        if isinstance(parameters, dict):
+            dtype = parameters[col]
+            if pd.api.types.is_datetime64_any_dtype(dtype):
+                wide[col] = pd.to_datetime(wide[col], errors='coerce')
+            elif pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+                wide[col] = pd.to_numeric(wide[col], errors='coerce').astype(dtype)
+            else:
+                wide[col] = wide[col].astype(dtype)
+        else:
+            wide[col] = convert_values(wide[col].tolist())
+
+    return wide
+
+
+class DataElementParser(object):
+    """
+    Accumulates the values of the E elements of a GetData response one element at a time, so that the elements can be released as soon as they have been read (e.g. while the response is still streaming in).
+    """
+    def __init__(self, data_type: str, item_num: int, precision: int = None, apply_precision: bool = False, parameters: Union[str, dict, None] = 'wide'):
+        """
+        Parameters
+        ----------
+        data_type : str
+            The DataType of the DataSource.
+        item_num : int
+            The item number of the measurement.
+        precision : int or None
+            The precision as the number of decimal places.
+        apply_precision : bool
+            Should the precision be applied to the data?
+        parameters : str, dict, or None
+            How the Parameter elements should be returned. See parse_data_elements.
+        """
+        self.data_type = data_type
+        self.precision = precision
+        self.apply_precision = apply_precision
+        self.parameters = parameters
+
+        self.item_tag = 'I' + str(item_num)
+        self.qual_tag = 'Q' + str(item_num)
+
+        self.times = []
+        self.values = []
+        self.qual_codes = []
+        self.wq_texts = []
+
+        self.p_rows = []
+        self.p_names = []
+        self.p_texts = []
+
+
+    def add(self, val):
+        """
+        Read the values of an E element.
+        """
+        i = len(self.times)
+        self.times.append(val.find('T').text.encode('ascii', 'ignore').decode())
+
+        if self.data_type == 'WQData':
+            wq_value = val.find('Value')
+            self.wq_texts.append(wq_value.text if wq_value is not None else None)
+            qual_code = val.find('QualityCode')
+        elif self.data_type == 'WQSample':
+            qual_code = None
+        else:
+            v1 = convert_value(val.find(self.item_tag).text)
+
+            if self.apply_precision and isinstance(v1, (int, float)):
+                v1 = np.round(v1, self.precision)
+                if self.precision == 0:
+                    v1 = int(v1)
+
+            self.values.append(v1)
+            qual_code = val.find(self.qual_tag)
+
+        if self.parameters is not None:
+            for param in val.iterfind('Parameter'):
+                self.p_rows.append(i)
+                self.p_names.append(param.attrib['Name'])
+                self.p_texts.append(param.attrib['Value'])
+
+        self.qual_codes.append(convert_value(qual_code.text) if qual_code is not None else None)
+
+
+    def to_frame(self):
+        """
+        Convert the values that have been read into a DataFrame. Or a tuple of the data and the parameters DataFrames if parameters='long'.
+        """
+        times = self.times
+        values = self.values
+        parameters = self.parameters
+        p_rows = self.p_rows
+
+        output1 = pd.DataFrame({'Time': times})
+
+        if self.wq_texts:
+            values, censor_code = parse_wq_values(self.wq_texts, self.apply_precision, self.precision)
+            if values.notnull().any():
+                output1['Value'] = values
+            if censor_code is not None:
+                output1['CensorCode'] = censor_code
+        elif any(v is not None for v in values):
+            output1['Value'] = values
+
+        if p_rows and (parameters != 'long'):
+            output1 = pd.concat([output1, parameters_to_frame(p_rows, self.p_names, self.p_texts, len(times), parameters)], axis=1)
+
+        if any(q is not None for q in self.qual_codes):
+            output1['QualityCode'] = self.qual_codes
+
+        if parameters == 'long':
+            params_df = pd.DataFrame({'Time': [times[r] for r in p_rows], 'ParameterName': self.p_names, 'ParameterValue': pd.Series(self.p_texts, dtype=object).str.encode('ascii', 'ignore').str.decode('ascii')})
+
+            return output1, params_df
+
+        return output1
+
+
+def parse_data_elements(elements, data_type: str, item_num: int, precision: int = None, apply_precision: bool = False, parameters: Union[str, dict, None] = 'wide'):
+    """
+    Function to parse the E elements of a GetData response into a DataFrame.
+
+    Parameters
+    ----------
+    elements : list of xml.etree.ElementTree.Element
+        The E elements under the Data element.
+    data_type : str
+        The DataType of the DataSource.
+    item_num : int
+        The item number of the measurement.
+    precision : int or None
+        The precision as the number of decimal places.
+    apply_precision : bool
+        Should the precision be applied to the data?
+    parameters : str, dict, or None
+        How the Parameter elements of each sample (mostly WQ data) should be returned. 'wide' adds all of them as columns to the output, a dict of {parameter name: dtype} only adds the declared Parameters as columns of that dtype, 'long' returns them as a separate tidy DataFrame of Time, ParameterName, and ParameterValue, and None ignores them.
+
+    Returns
+    -------
+    DataFrame
+        Or a tuple of the data and the parameters DataFrames if parameters='long'.
+    """
+    parser = DataElementParser(data_type, item_num, precision, apply_precision, parameters)
+    for val in elements:
+        parser.add(val)
+
+    return parser.to_frame()
+
+
+def normalize_name(name: str):
+    """
+    Function to normalize a site or measurement name for matching. It ignores case and extra whitespace and puts a single space before the data source in brackets (e.g. 'Elevation Above Sea Level[Recorder Water Level]' -> 'elevation above sea level [recorder water level]').
+
+    Parameters
+    ----------
+    name : str
+        The name.
+
+    Returns
+    -------
+    str
+    """
+    name = _bracket_open.sub(' [', name)
+    name = _bracket_close.sub(']', name)
+
+    return ' '.join(name.split()).casefold()
+
+
+class NameIndex(object):
+    """
+    An index of the measurements of a catalogue (e.g. a MeasurementList) by their normalized names. Each measurement can be found by its normalized MeasurementName (the RequestAs name), by its name with the data source in brackets (e.g. 'Flow [Flow]'), and by the name without the data source when that isn't ambiguous.
+    """
+    def __init__(self, records: List[dict] = None):
+        """
+        Parameters
+        ----------
+        records : list of dict
+            The measurements with at least a MeasurementName and ideally the DataSourceName and Item.
+        """
+        self.records = {}
+        self.aliases = {}
+        self._keys = None
+
+        if records:
+            for row in records:
+                self.add(row)
+
+
+    def add(self, row: dict):
+        """
+        Add a measurement to the index. Exact names always take precedence over the aliases.
+        """
+        m_name = row['MeasurementName']
+        key = normalize_name(m_name)
+        self.records[key] = row
+        self.aliases.pop(key, None)
+        self._keys = None
+
+        base = key.split(' [')[0]
+        alias_keys = [base]
+        if 'DataSourceName' in row:
+            alias_keys.append(base + ' [' + normalize_name(row['DataSourceName']) + ']')
+
+        for alias in alias_keys:
+            if alias in self.records:
+                continue
+            other = self.aliases.get(alias)
+            if other is None:
+                self.aliases[alias] = row
+            elif (other is not _ambiguous) and (other['MeasurementName'] != m_name):
+                ## Ambiguous aliases can't be resolved
+                self.aliases[alias] = _ambiguous
+
+
+    def get(self, name: str, default=None):
+        """
+        Get the measurement of a name.
+
+        Parameters
+        ----------
+        name : str
+            The measurement name.
+        default
+            What to return if the name isn't found.
+
+        Returns
+        -------
+        dict
+        """
+        key = normalize_name(name)
+        row = self.records.get(key)
+        if row is None:
+            row = self.aliases.get(key)
+            if (row is None) or (row is _ambiguous):
+                return default
+
+        return row
+
+
+    def prefix(self, text: str):
+        """
+        Find the measurement names that start with the text.
+
+        Parameters
+        ----------
+        text : str
+            The start of the names.
+
+        Returns
+        -------
+        list of str
+            The MeasurementNames in sorted order.
+        """
+        if self._keys is None:
+            self._keys = sorted(self.records)
+
+        key = normalize_name(text)
+        start = bisect.bisect_left(self._keys, key)
+        names = []
+        for k in self._keys[start:]:
+            if not k.startswith(key):
+                break
+            names.append(self.records[k]['MeasurementName'])
+
+        return names
+
+
+    def fuzzy(self, name: str, n: int = 3, cutoff: float = 0.8):
+        """
+        Find the measurement names that are closest to the name (e.g. to suggest names for a misspelt measurement).
+
+        Parameters
+        ----------
+        name : str
+            The measurement name.
+        n : int
+            The max number of names to return.
+        cutoff : float
+            The min similarity between 0 and 1.
+
+        Returns
+        -------
+        list of str
+            The MeasurementNames from most to least similar.
+        """
+        keys = difflib.get_close_matches(normalize_name(name), list(self.records), n=n, cutoff=cutoff)
+
+        return [self.records[k]['MeasurementName'] for k in keys]
+
+
+    def items(self):
+        return self.records.items()
+
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def __repr__(self):
+        return 'NameIndex(' + str(len(self)) + ' measurements)'
+
+
+def parse_data_source_info(meas_elem, measurement: str):
+    """
+    Function to get the DataSource and Measurement info of a GetData response. This is the info that would otherwise come from a MeasurementList request.
+
+    Parameters
+    ----------
+    meas_elem : xml.etree.ElementTree.Element
+        The Measurement element of the GetData response.
+    measurement : str
+        The requested measurement name.
+
+    Returns
+    -------
+    dict or None
+        None if the response has no DataSource. The Item and Precision are left out when the DataSource has many items and none of them match the measurement, so that they can be taken from a MeasurementList request instead.
+    """
+    ds = meas_elem.find('DataSource')
+    if ds is None:
+        return None
+
+    info = {c.tag: c.text.encode('ascii', 'ignore').decode() for c in ds if (c.text is not None) and (len(c) == 0)}
+    info['DataSourceName'] = ds.attrib['Name']
+
+    items = ds.findall('ItemInfo')
+    item = None
+    if len(items) == 1:
+        item = items[0]
+    else:
+        m_names = [normalize_name(measurement), normalize_name(measurement).split(' [')[0]]
+        for m in items:
+            item_name = m.find('ItemName')
+            if (item_name is not None) and (normalize_name(item_name.text) in m_names):
+                item = m
+                break
+
+    if item is not None:
+        m_dict = {c.tag: convert_value(c.text) for c in item}
+
+        if isinstance(m_dict.get('Format'), str):
+            f_text_list = m_dict['Format'].split('.')
+            if len(f_text_list) == 2:
+                precision = len(f_text_list[1])
+            else:
+                precision = 0
+        else:
+            precision = 0
+
+        info['Item'] = int(item.attrib.get('ItemNumber', 1))
+        info['Precision'] = precision
+        if 'Units' in m_dict:
+            info['Units'] = m_dict['Units']
+        if 'Divisor' in m_dict:
+            info['Divisor'] = m_dict['Divisor']
+    elif not items:
+        info['Item'] = 1
+        info['Precision'] = 0
+
+    return info
+
+
+def greedy_set_cover(sets: dict):
+    """
+    Function to find a small set of keys whose values together cover all of the values in the sets. It uses the greedy approximation by picking the key that covers the most uncovered values each time.
+
+    Parameters
+    ----------
+    sets : dict of sets
+        e.g. {site name: set of measurement names}.
+
+    Returns
+    -------
+    list
+        The selected keys in the order they were selected.
+    """
+    uncovered = set().union(*sets.values()) if sets else set()
+    remaining = dict(sets)
+
+    selected = []
+    while uncovered and remaining:
+        key = max(remaining, key=lambda k: len(remaining[k] & uncovered))
+        covers = remaining.pop(key) & uncovered
+        if not covers:
+            break
+        selected.append(key)
+        uncovered -= covers
+
+    return selected
+
+
+class SiteIndex(object):
+    """
+    A uniform grid spatial index of site locations for fast bounding box and nearest site queries. The sites are bucketed into square cells (about two sites per cell) and the queries only look at the cells near the query point or box.
+    """
+    def __init__(self, sites: pd.DataFrame, x_col: str = 'Easting', y_col: str = 'Northing'):
+        """
+        Parameters
+        ----------
+        sites : DataFrame
+            The sites with the SiteName and the x_col and y_col coordinate columns (e.g. from a SiteList request with location=True). Sites without coordinates are dropped.
+        x_col : str
+            The x coordinate column name.
+        y_col : str
+            The y coordinate column name.
+        """
+        sites = sites.dropna(subset=[x_col, y_col]).reset_index(drop=True)
+        self.sites = sites
+        self.x_col = x_col
+        self.y_col = y_col
+
+        ## Latitude/longitude is projected to an equirectangular grid in km so that the distances are sensible
+        if (x_col, y_col) == ('Longitude', 'Latitude'):
+            self._scale = (111.32 * np.cos(np.radians(sites[y_col].mean())), 110.574) if len(sites) else (1.0, 1.0)
+        else:
+            self._scale = (1.0, 1.0)
+
+        self.xy = self._project(sites[[x_col, y_col]].to_numpy(dtype='float64'))
+
+        n = len(self.xy)
+        if n:
+            self._origin = self.xy.min(axis=0)
+            extent = self.xy.max(axis=0) - self._origin
+            ## Each extent is at least the larger extent / n, so sites on a line get about n cells along it. A single site (or sites in one spot) gets a single cell
+            max_extent = extent.max()
+            if max_extent > 0:
+                min_extent = max_extent / n
+                area = max(extent[0], min_extent) * max(extent[1], min_extent)
+                self._cell = np.sqrt(2 * area / n)
+            else:
+                self._cell = 1.0
+        else:
+            self._origin = np.zeros(2)
+            self._cell = 1.0
+
+        cells = np.floor((self.xy - self._origin) / self._cell).astype('int64')
+        self._shape = cells.max(axis=0) + 1 if n else np.zeros(2, dtype='int64')
+        keys = cells[:, 0] * (self._shape[1] + 1) + cells[:, 1]
+        self._order = np.argsort(keys, kind='stable')
+        uniq, starts, counts = np.unique(keys[self._order], return_index=True, return_counts=True)
+        self._buckets = {k: (s, s + c) for k, s, c in zip(uniq.tolist(), starts.tolist(), counts.tolist())}
+
+        ## Sorted x for the bbox queries
+        self._x_order = np.argsort(self.xy[:, 0], kind='stable')
+        self._x_sorted = self.xy[self._x_order, 0]
+
+
+    def __len__(self):
+        return len(self.sites)
+
+
+    def __repr__(self):
+        return 'SiteIndex(' + str(len(self)) + ' sites, ' + self.x_col + '/' + self.y_col + ')'
+
+
+    def _project(self, xy):
+        """
+        Scale the coordinates to the grid of the index.
+        """
+        return np.asarray(xy, dtype='float64') * np.asarray(self._scale)
+
+
+    def _ring(self, cell, r):
+        """
+        The site positions in the cells that are exactly r cells away from the cell.
+        """
+        cx, cy = cell
+        if r == 0:
+            cells = [(cx, cy)]
+        else:
+            xs = range(cx - r, cx + r + 1)
+            ys = range(cy - r + 1, cy + r)
+            cells = [(x, cy - r) for x in xs] + [(x, cy + r) for x in xs] + [(cx - r, y) for y in ys] + [(cx + r, y) for y in ys]
+
+        idx = []
+        for x, y in cells:
+            if (0 <= x < self._shape[0]) and (0 <= y < self._shape[1]):
+                b = self._buckets.get(x * (self._shape[1] + 1) + y)
+                if b is not None:
+                    idx.append(self._order[b[0]:b[1]])
+
+        return idx
+
+
+    def _nearest_single(self, point, k):
+        """
+        Search the rings of cells out from the point until the kth nearest site is closer than any unsearched cell. The number of rings is limited, as each ring has more cells than the last, so points far from the sites or few sites fall back to the distances to all of the sites.
+        """
+        cell = np.floor((point - self._origin) / self._cell).astype('int64')
+        max_r = int(max(abs(cell[0]), abs(cell[0] - self._shape[0]), abs(cell[1]), abs(cell[1] - self._shape[1]))) + 1
+        max_r = min(max_r, int(np.sqrt(len(self._buckets))) + 1)
+
+        cand = []
+        n_cand = 0
+        for r in range(max_r + 1):
+            ring = self._ring(cell, r)
+            cand.extend(ring)
+            n_cand += sum(len(i) for i in ring)
+            if n_cand >= k:
+                idx = np.concatenate(cand)
+                dist = np.hypot(*(self.xy[idx] - point).T)
+                ## Every site in the next ring is at least r cells away from the point
+                if np.partition(dist, k - 1)[k - 1] <= r * self._cell:
+                    break
+        else:
+            idx = np.arange(len(self.xy))
+            dist = np.hypot(*(self.xy - point).T)
+
+        order = np.lexsort((idx, dist))[:k]
+
+        return idx[order], dist[order]
+
+
+    def nearest(self, points, k: int = 1):
+        """
+        Find the k nearest sites to each of the points.
+
+        Parameters
+        ----------
+        points : array-like
+            A single (x, y) point or an array of shape (n, 2) of points in the coordinates of the index.
+        k : int
+            The number of nearest sites to return per point.
+
+        Returns
+        -------
+        tuple of arrays
+            The positions of the sites in self.sites and their distances, both of shape (n, k). The distances are in the units of the coordinates, except for lat/lon which are in km.
+        """
+        points = self._project(np.atleast_2d(points))
+        k = min(k, len(self))
+
+        idx = np.zeros((len(points), k), dtype='int64')
+        dist = np.zeros((len(points), k))
+        if k < 1:
+            return idx, dist
+
+        for i, point in enumerate(points):
+            idx[i], dist[i] = self._nearest_single(point, k)
+
+        return idx, dist
+
+
+    def within(self, bbox):
+        """
+        Find the sites within a bounding box.
+
+        Parameters
+        ----------
+        bbox : tuple
+            The (min x, min y, max x, max y) of the bounding box in the coordinates of the index. The edges are included.
+
+        Returns
+        -------
+        array
+            The positions of the sites in self.sites.
+        """
+        (x0, y0), (x1, y1) = self._project([bbox[:2], bbox[2:]])
+        start = np.searchsorted(self._x_sorted, x0, side='left')
+        end = np.searchsorted(self._x_sorted, x1, side='right')
+        idx = self._x_order[start:end]
+        y = self.xy[idx, 1]
+
+        return np.sort(idx[(y >= y0) & (y <= y1)])
+
+
 # def parse_data_source(measurement):
 #     """
 
@@ -304,6 +1378,102 @@ def convert_value(text):
 #     return m_name, ds_name
 
 
+_dsn_cache = {}
+_dsn_lock = threading.Lock()
+
+
+def _read_dsn(dsn_path):
+    """
+    Read the file paths of a single dsn file. The results are cached by the path, modification time, and size of the file.
+    """
+    stat = os.stat(dsn_path)
+    key = (dsn_path, stat.st_mtime_ns, stat.st_size)
+
+    with _dsn_lock:
+        if key in _dsn_cache:
+            return _dsn_cache[key]
+
+    base_path = os.path.dirname(dsn_path)
+    dsn = ConfigParser()
+    dsn.read(dsn_path)
+    files1 = [os.path.abspath(os.path.join(base_path, i[1])) for i in dsn.items('Hilltop') if 'file' in i[0]]
+
+    with _dsn_lock:
+        for k in [k for k in _dsn_cache if k[0] == dsn_path]:
+            del _dsn_cache[k]
+        _dsn_cache[key] = files1
+
+    return files1
+
+
+class DsnTree(object):
+    """
+    The resolved tree of a dsn file and all of its sub-dsn files. Iterating over it gives the paths to the hts files, so it can be passed anywhere a list of hts paths is used (e.g. looping over the com functions or to HilltopGroup).
+    """
+    def __init__(self, path: str, hts_files: List[str], includes: dict):
+        self.path = path
+        self.hts_files = hts_files
+        self.includes = includes
+
+
+    @property
+    def dsn_files(self):
+        """
+        The paths of all of the dsn files in the tree, starting with the root.
+        """
+        return list(self.includes)
+
+
+    def __iter__(self):
+        return iter(self.hts_files)
+
+
+    def __len__(self):
+        return len(self.hts_files)
+
+
+    def __repr__(self):
+        return 'DsnTree(' + self.path + ', ' + str(len(self.dsn_files)) + ' dsn files, ' + str(len(self.hts_files)) + ' hts files)'
+
+
+def resolve_dsn(dsn_path: str):
+    """
+    Function to resolve a dsn file and all sub-dsn files into a DsnTree. Each dsn file is only read once (and is cached by its modification time) and cyclic includes raise a ValueError.
+
+    Parameters
+    ----------
+    dsn_path : str
+        Path to the dsn file.
+
+    Returns
+    -------
+    DsnTree
+    """
+    root = os.path.abspath(dsn_path)
+
+    hts1 = []
+    includes = {}
+    stack = [(root, ())]
+
+    while stack:
+        path, ancestors = stack.pop()
+
+        if path in ancestors:
+            raise ValueError('The dsn files include each other in a cycle: ' + ' -> '.join(ancestors + (path,)))
+        if path in includes:
+            continue
+
+        files1 = _read_dsn(path)
+        includes[path] = files1
+
+        hts1.extend([i for i in files1 if i.endswith('.hts') and i not in hts1])
+
+        children = [i for i in files1 if i.endswith('.dsn')]
+        stack.extend([(c, ancestors + (path,)) for c in reversed(children)])
+
+    return DsnTree(root, hts1, includes)
+
+
 def parse_dsn(dsn_path):
     """
     Function to parse a dsn file and all sub-dsn files into paths to hts files. Returns a list of hts paths.
@@ -317,24 +1487,7 @@ def parse_dsn(dsn_path):
     -------
     List of path strings to hts files.
     """
-
-    base_path = os.path.dirname(dsn_path)
-
-    dsn = ConfigParser()
-    dsn.read(dsn_path)
-    files1 = [os.path.join(base_path, i[1]) for i in dsn.items('Hilltop') if 'file' in i[0]]
-    hts1 = [i for i in files1 if i.endswith('.hts')]
-    dsn1 = [i for i in files1 if i.endswith('.dsn')]
-    while dsn1:
-        for f in dsn1:
-            base_path = os.path.dirname(f)
-            p1 = ConfigParser()
-            p1.read(f)
-            files1 = [os.path.join(base_path, i[1]) for i in p1.items('Hilltop') if 'file' in i[0]]
-            hts1.extend([i for i in files1 if i.endswith('.hts')])
-            dsn1.remove(f)
-            dsn1[0:0] = [i for i in files1 if i.endswith('.dsn')]
-    return hts1
+    return resolve_dsn(dsn_path).hts_files
 
 
 def pytime_to_datetime(pytime):
@@ -370,78 +1523,77 @@ def time_switch(x):
     }.get(x, 'A')
 
 
+def _single_match(pattern):
+    """
+    Make a regex that only matches (and extracts) the pattern when it's found exactly once in the text.
+    """
+    return re.compile(r'(?s)^(?:(?!' + pattern + r').)*(' + pattern + r')(?:(?!' + pattern + r').)*$')
+
+
+_site_name_patterns = {True: _single_match(r'[A-Z]+\d+/\d+'), False: _single_match(r'[A-Z]+\d+/\d+\s*-\s*M\d*')}
+_site_name_cache = {True: {}, False: {}}
+_site_name_cache_size = 2**20
+
+
 def convert_site_names(names, rem_m=True):
     """
-    Function to convert water usage site names.
+    Function to convert water usage site names. Each unique name is only converted once and the conversions are cached between calls.
     """
+    cache = _site_name_cache[bool(rem_m)]
+
+    u_names = names.dropna().drop_duplicates()
+    new_names = u_names[~u_names.isin(cache)]
 
-    names1 = names.str.replace(r'[:\.]', '/')
+    ## Start the cache again with all of the names of this call, so the names that were already cached aren't lost with the rest
+    if len(cache) + len(new_names) > _site_name_cache_size:
+        cache.clear()
+        new_names = u_names
+
+    if not new_names.empty:
+        names1 = new_names.str.replace(r'[:\.]', '/', regex=True)
 #    names1.loc[names1 == 'L35183/580-M1'] = 'L35/183/580-M1' What to do with this one?
 #    names1.loc[names1 == 'L370557-M1'] = 'L37/0557-M1'
 #    names1.loc[names1 == 'L370557-M72'] = 'L37/0557-M72'
 #    names1.loc[names1 == 'BENNETT K38/0190-M1'] = 'K38/0190-M1'
-    names1 = names1.str.upper()
-    if rem_m:
-        list_names1 = names1.str.findall(r'[A-Z]+\d+/\d+')
-        names_len_bool = list_names1.apply(lambda x: len(x)) == 1
-        names2 = names1.copy()
-        names2[names_len_bool] = list_names1[names_len_bool].apply(lambda x: x[0])
-        names2[~names_len_bool] = np.nan
-    else:
-        list_names1 = names1.str.findall(r'[A-Z]+\d+/\d+\s*-\s*M\d*')
-        names_len_bool = list_names1.apply(lambda x: len(x)) == 1
-        names2 = names1.copy()
-        names2[names_len_bool] = list_names1[names_len_bool].apply(lambda x: x[0])
-        names2[~names_len_bool] = np.nan
+        names1 = names1.str.upper()
+        names2 = names1.str.extract(_site_name_patterns[bool(rem_m)], expand=False)
 
-    return names2
+        cache.update(zip(new_names, names2))
 
+    return names.map(cache)
 
-def proc_ht_use_data_ws(ht_data):
+
+def _proc_ht_use_data(ht_data, flow_mtype):
     """
-    Function to process the water usage data at daily resolution.
+    Convert the water usage data of all of the Measurements and Sites to period volumes with grouped operations over the whole Series.
     """
+    ### Put the rows in the order of the Measurement and Site groups
+    ht_data = ht_data[ht_data.index.get_level_values('Measurement').isin(['Water Meter', 'Compliance Volume', 'Volume', flow_mtype, 'Average Flow'])]
+    group = ht_data.groupby(level=['Measurement', 'Site']).ngroup().values
+    data = ht_data.iloc[np.argsort(group, kind='stable')]
+    mtype = data.index.get_level_values('Measurement')
 
-    ### Groupby mtypes and sites
-    grp = ht_data.groupby(level=['Measurement', 'Site'])
+    data = data.where(~(data < 0))
+    grp = data.groupby(level=['Measurement', 'Site'])
 
-    res1 = []
-    for index, data1 in grp:
-        data = data1.copy()
-        mtype, site = index
-#        units = sites[(sites.site == site) & (sites.mtype == mtype)].unit
+    ### Select the process sequence based on the mtype and convert to period volume
+    vol = data.copy()
 
-        ### Select the process sequence based on the mtype and convert to period volume
+    ## Check to determine whether the water meters are cumulative or period volume
+    diff1 = grp.diff()
+    neg_ratio = (diff1 < 0).groupby(level=['Measurement', 'Site']).transform('sum') / grp.transform('count')
+    cumulative = (mtype == 'Water Meter') & ~(neg_ratio > 0.1).values
 
-        data[data < 0] = np.nan
+    # Replace the negative values with zero and the very large values
+    vol[cumulative] = diff1.mask(diff1 < 0, data)[cumulative]
 
-        if mtype == 'Water Meter':
-            ## Check to determine whether it is cumulative or period volume
-            count1 = float(data.count())
-            diff1 = data.diff()
-            neg_index = diff1 < 0
-            neg_ratio = sum(neg_index.values)/count1
-            if neg_ratio > 0.1:
-                vol = data
-            else:
-                # Replace the negative values with zero and the very large values
-                diff1[diff1 < 0] = data[diff1 < 0]
-                vol = diff1
-        elif mtype in ['Compliance Volume', 'Volume']:
-            vol = data
-        elif mtype == 'Flow [Flow]':
-#            vol = (data * 60*60*24).fillna(method='ffill').round(4)
-            vol = (data * 60*60*24)
-        elif mtype == 'Average Flow':
-#            vol = (data * 24).fillna(method='ffill').round(4)
-            vol = (data * 24)
-        else:
-            continue
-
-        res1.append(vol)
+    flow = mtype == flow_mtype
+    vol[flow] = data[flow] * 60*60*24
+    avg_flow = mtype == 'Average Flow'
+    vol[avg_flow] = data[avg_flow] * 24
 
     ### Convert to dataframe
-    df1 = pd.concat(res1).reset_index()
+    df1 = vol.reset_index()
 
     ### Drop the mtypes level and uppercase the sites
     df2 = df1.drop('Measurement', axis=1)
@@ -453,57 +1605,15 @@ def proc_ht_use_data_ws(ht_data):
     return df3
 
 
-def proc_ht_use_data(ht_data):
+def proc_ht_use_data_ws(ht_data):
     """
     Function to process the water usage data at daily resolution.
     """
+    return _proc_ht_use_data(ht_data, 'Flow [Flow]')
 
-    ### Groupby mtypes and sites
-    grp = ht_data.groupby(level=['Measurement', 'Site'])
 
-    res1 = []
-    for index, data1 in grp:
-        data = data1.copy()
-        mtype, site = index
-#        units = sites[(sites.site == site) & (sites.mtype == mtype)].unit
-
-        ### Select the process sequence based on the mtype and convert to period volume
-
-        data[data < 0] = np.nan
-
-        if mtype == 'Water Meter':
-            ## Check to determine whether it is cumulative or period volume
-            count1 = float(data.count())
-            diff1 = data.diff()
-            neg_index = diff1 < 0
-            neg_ratio = sum(neg_index.values)/count1
-            if neg_ratio > 0.1:
-                vol = data
-            else:
-                # Replace the negative values with zero and the very large values
-                diff1[diff1 < 0] = data[diff1 < 0]
-                vol = diff1
-        elif mtype in ['Compliance Volume', 'Volume']:
-            vol = data
-        elif mtype == 'Flow':
-#            vol = (data * 60*60*24).fillna(method='ffill').round(4)
-            vol = (data * 60*60*24)
-        elif mtype == 'Average Flow':
-#            vol = (data * 24).fillna(method='ffill').round(4)
-            vol = (data * 24)
-        else:
-            continue
-
-        res1.append(vol)
-
-    ### Convert to dataframe
-    df1 = pd.concat(res1).reset_index()
-
-    ### Drop the mtypes level and uppercase the sites
-    df2 = df1.drop('Measurement', axis=1)
-    df2.loc[:, 'Site'] = df2.loc[:, 'Site'].str.upper()
-
-    ### Remove duplicate WAPs
-    df3 = df2.groupby(['Site', 'DateTime']).Value.last()
-
-    return df3
+def proc_ht_use_data(ht_data):
+    """
+    Function to process the water usage data at daily resolution.
+    """
+    return _proc_ht_use_data(ht_data, 'Flow')
@@ -4,9 +4,9 @@ Created on Tue May 29 10:12:11 2018
 
 @author: MichaelEK
 """
+import warnings
 import pandas as pd
-import numpy as np
-from hilltoppy.utils import convert_value, DataSource, Measurement, get_hilltop_xml, build_url
+from hilltoppy.utils import convert_value, DataSource, Measurement, get_hilltop_xml, build_url, parse_data_elements, validate_records, NameIndex
 
 
 ########################################
@@ -32,7 +32,7 @@ def site_list(base_url, hts, location=None, measurement=None, collection=None, s
     timeout : int
         The http request timeout in seconds.
     **kwargs
-        Optional keyword arguments passed to requests.
+        Optional keyword arguments passed to get_hilltop_xml (e.g. compression and metrics) and then on to requests.
 
     Returns
     -------
@@ -74,7 +74,7 @@ def site_info(base_url, hts, site, timeout=60, **kwargs):
     timeout : int
         The http request timeout in seconds.
     **kwargs
-        Optional keyword arguments passed to requests.
+        Optional keyword arguments passed to get_hilltop_xml (e.g. compression and metrics) and then on to requests.
 
     Returns
     -------
@@ -114,7 +114,7 @@ def collection_list(base_url, hts, timeout=60, **kwargs):
     timeout : int
         The http request timeout in seconds.
     **kwargs
-        Optional keyword arguments passed to requests.
+        Optional keyword arguments passed to get_hilltop_xml (e.g. compression and metrics) and then on to requests.
 
     Returns
     -------
@@ -145,7 +145,7 @@ def collection_list(base_url, hts, timeout=60, **kwargs):
     return collection_df
 
 
-def measurement_list(base_url, hts, site, measurement=None, timeout=60, **kwargs):
+def measurement_list(base_url, hts, site, measurement=None, validation='batch', timeout=60, **kwargs):
     """
     Function to query a Hilltop server for the measurement summary of a site.
 
@@ -159,10 +159,12 @@ def measurement_list(base_url, hts, site, measurement=None, timeout=60, **kwargs
         The site to be extracted.
     measurement : str or None
         The measurement type name.
+    validation : str
+        How the DataSources and Measurements returned by the server should be validated. 'batch' validates all of them at once against the data models and warns about (and drops) any that fail. 'trusted' skips the validation for servers that are known to return valid data.
     timeout : int
         The http request timeout in seconds.
     **kwargs
-        Optional keyword arguments passed to requests.
+        Optional keyword arguments passed to get_hilltop_xml (e.g. compression and metrics) and then on to requests.
 
     Returns
     -------
@@ -178,8 +180,10 @@ def measurement_list(base_url, hts, site, measurement=None, timeout=60, **kwargs
         raise ValueError('No results returned from URL request')
     data_sources = tree1.findall('DataSource')
 
-    ### Extract data into list of dict - to represent the Hilltop structure
-    data_list = []
+    ### Extract data into lists of dict - to represent the Hilltop structure
+    ds_list = []
+    m_list = []
+    m_ds_index = []
 
     if data_sources:
         for d in data_sources:
@@ -189,32 +193,44 @@ def measurement_list(base_url, hts, site, measurement=None, timeout=60, **kwargs
                     ds_dict['SiteName'] = site
                     data_source_name = d.attrib['Name']
                     ds_dict['DataSourceName'] = data_source_name
-                    try:
-                        ds_dict1 = DataSource(**ds_dict).model_dump(exclude_none=True, mode='json')
-
-                        m_all = d.findall('Measurement')
-                        for m in m_all:
-                            m_dict = {c.tag: convert_value(c.text) for c in m}
-
-                            if 'Format' in m_dict:
-                                f_text_list = m_dict['Format'].split('.')
-                                if len(f_text_list) == 2:
-                                    precision = len(f_text_list[1])
-                                else:
-                                    precision = 0
+                    ds_index = len(ds_list)
+                    ds_list.append(ds_dict)
+
+                    m_all = d.findall('Measurement')
+                    for m in m_all:
+                        m_dict = {c.tag: convert_value(c.text) for c in m}
+
+                        if isinstance(m_dict.get('Format'), str):
+                            f_text_list = m_dict['Format'].split('.')
+                            if len(f_text_list) == 2:
+                                precision = len(f_text_list[1])
                             else:
                                 precision = 0
+                        else:
+                            precision = 0
 
-                            m_dict['Precision'] = precision
+                        m_dict['Precision'] = precision
 
-                            m_dict['MeasurementName'] = m_dict.pop('RequestAs')
+                        m_dict['MeasurementName'] = m_dict.pop('RequestAs', None)
 
-                            m_dict1 = Measurement(**m_dict).model_dump(exclude_none=True, mode='json')
-                            m_dict1.update(ds_dict1)
+                        m_list.append(m_dict)
+                        m_ds_index.append(ds_index)
 
-                            data_list.append(m_dict1)
-                    except Exception:
-                        pass
+    ### Validate the DataSources and Measurements in batches
+    ds_list1, ds_invalid = validate_records(ds_list, DataSource, validation)
+    m_list1, m_invalid = validate_records(m_list, Measurement, validation)
+
+    if ds_invalid or m_invalid:
+        msgs = ['DataSource ' + str(ds_list[i]['DataSourceName']) + ' (' + e + ')' for i, e in ds_invalid.items()]
+        msgs.extend(['Measurement ' + str(m_list[i]['MeasurementName']) + ' (' + e + ')' for i, e in m_invalid.items()])
+        warnings.warn('The following failed validation for site ' + str(site) + ' and were dropped: ' + ', '.join(msgs))
+
+    data_list = []
+    for m_dict1, ds_index in zip(m_list1, m_ds_index):
+        ds_dict1 = ds_list1[ds_index]
+        if (m_dict1 is not None) and (ds_dict1 is not None):
+            m_dict1.update(ds_dict1)
+            data_list.append(m_dict1)
 
     ## Convert output
     if data_list:
@@ -235,7 +251,7 @@ def measurement_list(base_url, hts, site, measurement=None, timeout=60, **kwargs
     return output1
 
 
-def get_data(base_url, hts, site, measurement, from_date=None, to_date=None, agg_method=None, agg_interval=None, alignment='00:00', quality_codes=False, apply_precision=False, tstype=None, timeout=60, **kwargs):
+def get_data(base_url, hts, site, measurement, from_date=None, to_date=None, agg_method=None, agg_interval=None, alignment='00:00', quality_codes=False, apply_precision=False, tstype=None, parameters='wide', timeout=60, **kwargs):
     """
     Function to query a Hilltop web server for time series data associated with a Site and Measurement.
 
@@ -267,10 +283,12 @@ def get_data(base_url, hts, site, measurement, from_date=None, to_date=None, agg
         Should the precision according to Hilltop be applied to the data? Only use True if you're confident that Hilltop stores the correct precision, because it is not always correct.
     tstype : str or None
         The time series type; one of Standard, Check, or Quality.
+    parameters : str, dict, or None
+        How the sample Parameters of WQ data should be returned. 'wide' adds all of them as columns to the data, a dict of {parameter name: dtype} only adds the declared Parameters as columns of that dtype, 'long' returns them as a separate tidy DataFrame, and None ignores them.
     timeout : int
         The http request timeout in seconds.
     **kwargs
-        Optional keyword arguments passed to requests.
+        Optional keyword arguments passed to get_hilltop_xml (e.g. compression and metrics) and then on to requests.
 
     Returns
     -------
@@ -302,101 +320,61 @@ def get_data(base_url, hts, site, measurement, from_date=None, to_date=None, agg
         ## Get the measurement info
         measurements = ds.findall('ItemInfo')
 
-        for m in measurements:
+        items = NameIndex([{'MeasurementName': m.find('ItemName').text, 'DataSourceName': data_source_name, 'Element': m} for m in measurements if m.find('ItemName') is not None])
+        item = items.get(measurement)
+
+        if item is not None:
+            m = item['Element']
             m_dict = {c.tag: convert_value(c.text) for c in m}
             m_name = m_dict.pop('ItemName')
 
-            if measurement.lower() == m_name.lower():
-                if 'Format' in m_dict:
-                    f_text_list = m_dict['Format'].split('.')
-                    if len(f_text_list) == 2:
-                        precision = len(f_text_list[1])
-                    else:
-                        precision = 0
+            if 'Format' in m_dict:
+                f_text_list = m_dict['Format'].split('.')
+                if len(f_text_list) == 2:
+                    precision = len(f_text_list[1])
                 else:
                     precision = 0
+            else:
+                precision = 0
 
-                m_dict['Precision'] = precision
-                m_dict['MeasurementName'] = m_name
-                m_dict['Item'] = int(m.attrib['ItemNumber'])
+            m_dict['Precision'] = precision
+            m_dict['MeasurementName'] = m_name
+            m_dict['Item'] = int(m.attrib['ItemNumber'])
 
-                m_dict1 = Measurement(**m_dict).model_dump(exclude_none=True, mode='json')
+            m_dict1 = Measurement(**m_dict).model_dump(exclude_none=True, mode='json')
 
-                ds_dict1.update(m_dict1)
+            ds_dict1.update(m_dict1)
 
         ## Check if the measurement actually came through with the GetData request
         ## Hilltop seems oddly inconsistant when it returns the measurements...
         ## If not, then get the measurement data from the measurement_list function
         if 'Item' not in ds_dict1:
-            ml = measurement_list(base_url, hts, site, measurement=measurement, output='dict', timeout=timeout)
-            for m in ml:
-                if m['MeasurementName'].lower() == measurement.lower():
-                    ds_dict1.update(m)
+            ml = measurement_list(base_url, hts, site, measurement=measurement, timeout=timeout, **kwargs)
+            m = NameIndex(ml.to_dict('records')).get(measurement)
+            if m is not None:
+                ds_dict1.update({k: v for k, v in m.items() if pd.notna(v)})
 
         ## Parse the ts data
-        item_num = str(ds_dict1['Item'])
         data1 = meas1.find('Data').findall('E')
 
-        data_list = []
-        append = data_list.append
-
-        for val in data1:
-            time = val.find('T').text.encode('ascii', 'ignore').decode()
-
-            val_dict = {'Time': time}
-
-            censor_code = None
-            if ds_dict1['DataType'] == 'WQData':
-                v1 = convert_value(val.find('Value').text)
-                if isinstance(v1, str):
-                    if '<' in v1:
-                        censor_code = 'less_than'
-                        v1 = convert_value(v1[1:])
-                    elif '>' in v1:
-                        censor_code = 'greater_than'
-                        v1 = convert_value(v1[1:])
-
-                qual_code = val.find('QualityCode')
-            elif ds_dict1['DataType'] == 'WQSample':
-                v1 = None
-                qual_code = None
-            else:
-                v1 = convert_value(val.find('I' + item_num).text)
-                qual_code = val.find('Q' + item_num)
-
-            if apply_precision and isinstance(v1, (int, float)) and (censor_code is None):
-                v1 = np.round(v1, ds_dict1['Precision'])
-                if ds_dict1['Precision'] == 0:
-                    v1 = int(v1)
-
-            if v1 is not None:
-                val_dict['Value'] = v1
-            if censor_code is not None:
-                val_dict['CensorCode'] = censor_code
-
-            params = val.findall('Parameter')
-
-            if params:
-                for param in params:
-                    p_name = param.attrib['Name']
-                    p_val = convert_value(param.attrib['Value'])
-                    val_dict[p_name] = p_val
-
-            if qual_code is not None:
-                val_dict['QualityCode'] = convert_value(qual_code.text)
+        output1 = parse_data_elements(data1, ds_dict1['DataType'], ds_dict1['Item'], ds_dict1['Precision'], apply_precision, parameters)
+        if parameters == 'long':
+            output1, params_df = output1
+            params_df['Time'] = pd.to_datetime(params_df['Time'])
+            params_df['SiteName'] = site
+            params_df['MeasurementName'] = measurement
+            params_df = params_df.set_index(['SiteName', 'MeasurementName', 'Time']).reset_index()
 
-            append(val_dict)
-
-        output1 = pd.DataFrame(data_list)
         output1['Time'] = pd.to_datetime(output1['Time'])
         output1['SiteName'] = site
         output1['MeasurementName'] = measurement
         output1 = output1.set_index(['SiteName', 'MeasurementName', 'Time']).reset_index()
 
-        if 'CensorCode' in output1:
-            output1.loc[output1['CensorCode'].isnull(), 'CensorCode'] = 'not_censored'
-
     else:
         output1 = pd.DataFrame(columns=['SiteName', 'MeasurementName', 'Time'])
+        params_df = pd.DataFrame(columns=['SiteName', 'MeasurementName', 'Time', 'ParameterName', 'ParameterValue'])
+
+    if parameters == 'long':
+        return output1, params_df
 
     return output1